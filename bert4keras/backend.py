@@ -2,7 +2,7 @@
 # 分离后端函数，主要是为了同时兼容原生keras和tf.keras
 # 通过设置环境变量TF_KERAS=1来切换tf.keras
 
-import os, sys
+import os, sys, inspect
 from distutils.util import strtobool
 import numpy as np
 import tensorflow as tf
@@ -19,6 +19,10 @@ else:
     import keras
     import keras.backend as K
 
+# tf.custom_gradient只能正确处理资源变量（resource variable），而原生
+# keras在TF1下创建的是ref变量，此时重计算退化为普通的梯度
+do_recompute = is_tf_keras or int(tf.__version__.split('.')[0]) >= 2
+
 
 def gelu_erf(x):
     """基于Erf直接计算的gelu函数
@@ -140,6 +144,17 @@ def batch_gather(params, indices):
             raise ValueError('%s\n%s\n' % (e1.message, e2.message))
 
 
+def relative_ids(q_len, k_len, max_relative_position, q_start=0):
+    """截断的相对位置id，形状为(q_len, k_len)
+    q_start为第一个query的位置（如分块计算时每块的起点）。
+    """
+    q_idxs = K.expand_dims(K.arange(0, q_len, dtype='int32'), 1) + q_start
+    k_idxs = K.expand_dims(K.arange(0, k_len, dtype='int32'), 0)
+    r_ids = K.clip(k_idxs - q_idxs, -max_relative_position,
+                   max_relative_position)
+    return r_ids + max_relative_position
+
+
 def pool1d(x,
            pool_size,
            strides=1,
@@ -184,6 +199,258 @@ def symbolic(f):
     return f
 
 
+def recompute_grad(call):
+    """重计算装饰器（用来装饰Keras层的call函数）
+    层的recompute属性为True时，前向只保存层的输入，反向传播时重新
+    计算层内部的中间结果，以计算时间换取显存（内存）。
+    说明：原生keras + TF1下不生效（见do_recompute），照常计算梯度。
+    """
+    if hasattr(inspect, 'getfullargspec'):
+        call_args = inspect.getfullargspec(call).args
+    else:
+        call_args = inspect.getargspec(call).args
+
+    def inner(self, inputs, **kwargs):
+        for key in ['mask', 'training']:
+            if key not in call_args:
+                kwargs.pop(key, None)
+        if not (do_recompute and getattr(self, 'recompute', False)):
+            return call(self, inputs, **kwargs)
+        is_list = isinstance(inputs, list)
+        flat_inputs = inputs if is_list else [inputs]
+
+        @tf.custom_gradient
+        def forward(*flat_inputs):
+            outputs = call(self, inputs, **kwargs)  # 这里不保存中间结果
+
+            def grad(doutputs, variables=None):
+                with tf.GradientTape() as tape:
+                    # 依赖于doutputs，保证在反向传播时才重新计算
+                    with tf.control_dependencies([doutputs]):
+                        xs = [tf.identity(x) for x in flat_inputs]
+                    for x in xs:
+                        # 避免tf.keras把重计算部分当作函数式模型来构建
+                        x._keras_history_checked = True
+                    tape.watch([x for x in xs if x.dtype.is_floating])
+                    outputs = call(self, xs if is_list else xs[0], **kwargs)
+                watches = xs + list(variables or [])
+                grads = tape.gradient(outputs, watches, doutputs)
+                if variables is None:
+                    return grads
+                return grads[:len(flat_inputs)], grads[len(flat_inputs):]
+
+            return outputs, grad
+
+        return forward(*flat_inputs)
+
+    return inner
+
+
+def chunked_sparse_categorical_crossentropy(y_true,
+                                            x,
+                                            kernel,
+                                            bias=None,
+                                            chunk_size=8192):
+    """等价于K.sparse_categorical_crossentropy(y_true, softmax(x·kernel + bias))
+    词表按chunk_size分块计算logits，用流式的logsumexp累加，反向传播时
+    逐块重新计算，完整的(num_tokens, vocab_size)矩阵始终不会出现。
+    x: (num_tokens, hidden_size)；kernel: (hidden_size, vocab_size)；
+    y_true: (num_tokens, )；返回每个token的交叉熵，形状为(num_tokens, )。
+    """
+    if bias is None:
+        bias = tf.zeros_like(kernel[0])
+    vocab_size = K.shape(kernel)[1]
+    num_chunks = (vocab_size + chunk_size - 1) // chunk_size
+
+    def chunk_logits(x, kernel, bias, i):
+        start = i * chunk_size
+        k = kernel[:, start:start + chunk_size]
+        b = bias[start:start + chunk_size]
+        return K.dot(x, k) + b, k
+
+    @tf.custom_gradient
+    def logsumexp(x, kernel, bias):
+        def body(i, m, s):
+            logits = chunk_logits(x, kernel, bias, i)[0]
+            new_m = K.maximum(m, K.max(logits, 1))
+            s = s * K.exp(m - new_m)
+            s = s + K.sum(K.exp(logits - K.expand_dims(new_m, 1)), 1)
+            return i + 1, new_m, s
+
+        m = tf.fill([K.shape(x)[0]], tf.constant(-np.inf, x.dtype))
+        _, m, s = tf.while_loop(lambda i, m, s: i < num_chunks, body,
+                                [0, m, K.zeros_like(m)])
+        lse = m + K.log(s)
+
+        def grad(dlse):
+            def body(i, dx, dk, db):
+                logits, k = chunk_logits(x, kernel, bias, i)
+                p = K.exp(logits - K.expand_dims(lse, 1))
+                p = p * K.expand_dims(dlse, 1)
+                dx = dx + K.dot(p, K.transpose(k))
+                dk = dk.write(i, K.dot(K.transpose(p), x))
+                db = db.write(i, K.sum(p, 0))
+                return i + 1, dx, dk, db
+
+            dk = tf.TensorArray(x.dtype, size=num_chunks, infer_shape=False)
+            db = tf.TensorArray(x.dtype, size=num_chunks, infer_shape=False)
+            _, dx, dk, db = tf.while_loop(lambda i, *args: i < num_chunks,
+                                          body, [0, K.zeros_like(x), dk, db])
+            return dx, K.transpose(dk.concat()), db.concat()
+
+        return lse, grad
+
+    y_true = K.cast(y_true, 'int32')
+    y_pred = K.sum(x * tf.gather(K.transpose(kernel), y_true), 1)
+    y_pred = y_pred + tf.gather(bias, y_true)
+    return logsumexp(x, kernel, bias) - y_pred
+
+
+def viterbi_decode(nodes,
+                   trans,
+                   mask=None,
+                   trans_mask=None,
+                   start_mask=None):
+    """批量的Viterbi解码（图内），返回最优路径，形状为(batch_size, seq_len)
+    nodes: (batch_size, seq_len, num_labels)的逐标签得分；
+    trans: (num_labels, num_labels)的转移得分，或者(batch_size, seq_len,
+           num_labels, num_labels)的逐步转移得分（第t步为t-1到t的转移）；
+    mask: (batch_size, seq_len)的0/1矩阵，padding部分输出0；
+    trans_mask、start_mask: 0/1矩阵，为0的转移、起始标签不会出现。
+    """
+    if trans_mask is not None:
+        trans = trans - (1 - K.cast(trans_mask, K.dtype(trans))) * 1e12
+    if start_mask is not None:
+        start_mask = K.cast(start_mask, K.dtype(nodes))
+        nodes = K.concatenate(
+            [nodes[:, :1] - (1 - start_mask) * 1e12, nodes[:, 1:]], 1)
+    if mask is None:
+        mask = K.ones_like(nodes[..., 0])
+    num_labels = K.shape(nodes)[-1]
+    labels = K.expand_dims(K.arange(0, num_labels), 0)
+    labels = K.tile(labels, [K.shape(nodes)[0], 1])
+
+    elems = [
+        tf.transpose(nodes[:, 1:], [1, 0, 2]),
+        tf.transpose(K.cast(mask[:, 1:], 'bool'), [1, 0]),
+    ]
+    if K.ndim(trans) == 4:
+        elems.append(tf.transpose(trans[:, 1:], [1, 0, 2, 3]))
+
+    def forward(states, elems):
+        """前向递归，记录每一步最优的前一个标签
+        """
+        scores = K.expand_dims(states[0], 2)
+        trans_t = elems[2] if len(elems) == 3 else trans
+        outputs = scores + trans_t + K.expand_dims(elems[0], 1)
+        m = K.tile(K.expand_dims(elems[1], 1), [1, num_labels])
+        new_scores = tf.where(m, K.max(outputs, 1), states[0])
+        idxs = K.cast(K.argmax(outputs, 1), 'int32')
+        idxs = tf.where(m, idxs, labels)
+        return new_scores, idxs
+
+    scores, idxs = tf.scan(forward, elems, initializer=(nodes[:, 0], labels))
+    scores = K.concatenate([K.expand_dims(nodes[:, 0], 0), scores], 0)[-1]
+    last = K.cast(K.argmax(scores, 1), 'int32')
+
+    def backward(labels, idxs):
+        """反向回溯
+        """
+        return batch_gather(idxs, K.expand_dims(labels, 1))[:, 0]
+
+    paths = tf.scan(backward, idxs, initializer=last, reverse=True)
+    paths = K.concatenate([tf.transpose(paths), K.expand_dims(last, 1)], 1)
+    return paths * K.cast(mask, 'int32')
+
+
+def crf_log_norm(nodes, trans, mask=None):
+    """并行计算线性链CRF的归一化因子log Z，返回形状为(batch_size, )
+    第t步记为log半环上的矩阵M_t[i, j] = trans[i, j] + nodes[:, t, j]，
+    log Z就是这些矩阵的连乘（乘法为logsumexp_k(A[i, k] + B[k, j])）。
+    矩阵乘法满足结合律，所以可以相邻两两相乘，循环深度只有O(log seq_len)，
+    代价是每层要算(batch_size, n, num_labels, num_labels, num_labels)的张量；
+    padding部分的矩阵替换为单位阵（对角为0，其余为-1e12）。
+    """
+    num_labels = K.shape(nodes)[-1]
+    eye = (tf.eye(num_labels, dtype=K.dtype(nodes)) - 1) * 1e12
+    eye = K.expand_dims(K.expand_dims(eye, 0), 0)
+    trans = K.expand_dims(K.expand_dims(trans, 0), 0)
+    # 第0步：不管从哪一行出发，到标签j的得分都是nodes[:, 0, j]
+    mats = K.concatenate([
+        K.expand_dims(nodes[:, :1], 2) + K.zeros_like(trans),
+        K.expand_dims(nodes[:, 1:], 2) + trans
+    ], 1)
+    if mask is not None:
+        mask = K.cast(mask, K.dtype(nodes))
+        mask = K.concatenate([K.ones_like(mask[:, :1]), mask[:, 1:]], 1)
+        mask = K.expand_dims(K.expand_dims(mask, 2), 3)
+        mats = mats * mask + eye * (1 - mask)
+
+    def body(i, mats):
+        """相邻两两相乘，长度为奇数时补一个单位阵
+        """
+        batch_size, n = K.shape(mats)[0], K.shape(mats)[1]
+        pad = tf.tile(eye, [batch_size, n % 2, 1, 1])
+        mats = K.concatenate([mats, pad], 1)
+        mats = K.reshape(mats, [batch_size, -1, 2, num_labels, num_labels])
+        mats = K.expand_dims(mats[:, :, 0], 4) + K.expand_dims(mats[:, :, 1], 2)
+        return i + 1, tf.reduce_logsumexp(mats, 3)
+
+    _, mats = tf.while_loop(
+        lambda i, mats: K.shape(mats)[1] > 1,
+        body, [0, mats],
+        shape_invariants=[tf.TensorShape([]), tf.TensorShape([None] * 4)])
+    return tf.reduce_logsumexp(mats[:, 0, 0], 1)
+
+
+def predict_function(model):
+    """将模型编译成直接调用的预测函数，跳过model.predict每次调用时的
+    数据适配、callbacks等开销，适合小batch、高频率的预测（如解码）。
+    用法同model.predict(inputs)，inputs为numpy数组的list；tf.keras的
+    eager模式下用固定input signature的tf.function，避免重复trace，
+    否则用K.function。eager模式下返回的函数带有
+    experimental_get_tracing_count方法，可查询实际的trace次数。
+    """
+    dtypes = [K.dtype(i) for i in model.inputs]
+
+    if is_tf_keras and tf.executing_eagerly():
+        signature = [
+            tf.TensorSpec(shape=K.int_shape(i), dtype=K.dtype(i))
+            for i in model.inputs
+        ]
+
+        @tf.function(input_signature=signature)
+        def call(*inputs):
+            return model(list(inputs), training=False)
+
+        def function(inputs):
+            outputs = call(*inputs)
+            if isinstance(outputs, (list, tuple)):
+                return [o.numpy() for o in outputs]
+            return outputs.numpy()
+    else:
+        outputs = K.function(model.inputs, model.outputs)
+
+        def function(inputs):
+            results = outputs(inputs)
+            if len(model.outputs) == 1:
+                return results[0]
+            return results
+
+    def predict(inputs):
+        if not isinstance(inputs, list):
+            inputs = [inputs]
+        inputs = [np.asarray(x, dtype=d) for x, d in zip(inputs, dtypes)]
+        return function(inputs)
+
+    if is_tf_keras and tf.executing_eagerly():
+        # 暴露tf.function实际的trace次数，供监控重复trace
+        predict.experimental_get_tracing_count = \
+            call.experimental_get_tracing_count
+
+    return predict
+
+
 # 给旧版本keras新增symbolic方法（装饰器），
 # 以便兼容optimizers.py中的代码
 K.symbolic = getattr(K, 'symbolic', None) or symbolic
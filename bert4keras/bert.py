@@ -3,6 +3,9 @@
 
 import numpy as np
 from bert4keras.layers import *
+from bert4keras.backend import batch_gather
+from bert4keras.backend import relative_ids
+from bert4keras.backend import chunked_sparse_categorical_crossentropy
 from collections import OrderedDict
 import json
 
@@ -32,6 +35,16 @@ class BertModel(object):
             block_sharing=False,  # 是否共享同一个transformer block
             att_pool_size=None,  # 进行attention之前是否先pooling
             ffn_pool_size=None,  # 输入FFN之前是否先pooling
+            fused_qkv=False,  # Attention的q、k、v是否合并为一个Dense
+            att_window_size=None,  # 是否使用稀疏的局部attention
+            att_window_mode='sliding',  # 局部attention的模式（sliding或block）
+            att_global_size=0,  # 局部attention时全局位置（如[CLS]）的个数
+            att_chunk_size=None,  # attention是否按query分块计算
+            att_linear=False,  # 是否使用线性attention
+            recompute=False,  # 是否在反向传播时重新计算（省显存）
+            unpad=False,  # 是否去掉padding后再计算（只在attention时恢复）
+            adaptive_softmax=None,  # 非None时为cutoffs，MLM部分用自适应softmax
+            token_frequencies=None,  # 各token的频数，自适应softmax按此分簇
     ):
         if keep_tokens is None:
             self.vocab_size = vocab_size
@@ -62,6 +75,31 @@ class BertModel(object):
             self.ffn_pool_size = ffn_pool_size
         else:
             self.ffn_pool_size = [ffn_pool_size] * num_hidden_layers
+        self.fused_qkv = fused_qkv
+        if isinstance(att_window_size, list):
+            self.att_window_size = att_window_size
+        else:
+            self.att_window_size = [att_window_size] * num_hidden_layers
+        self.att_window_mode = att_window_mode
+        self.att_global_size = att_global_size
+        if isinstance(att_chunk_size, list):
+            self.att_chunk_size = att_chunk_size
+        else:
+            self.att_chunk_size = [att_chunk_size] * num_hidden_layers
+        if isinstance(att_linear, list):
+            self.att_linear = att_linear
+        else:
+            self.att_linear = [att_linear] * num_hidden_layers
+        self.recompute = recompute
+        self.unpad = unpad
+        self.adaptive_softmax = adaptive_softmax
+        if token_frequencies is None:
+            self.token_order = None
+        else:
+            token_frequencies = np.asarray(token_frequencies)
+            self.token_order = np.argsort(-token_frequencies, kind='mergesort')
+        if adaptive_softmax:
+            self.with_mlm = self.with_mlm or True
         self.additional_outputs = []
 
     def build(self,
@@ -129,30 +167,86 @@ class BertModel(object):
                       kernel_initializer=self.initializer,
                       name='Embedding-Mapping')(x)
 
+        # 去掉padding，逐位置的运算只作用于真实token
+        if self.unpad:
+            if z is not None:
+                raise ValueError(
+                    'Conditional LayerNorm does not support unpadding.')
+            if any(self.att_pool_size + self.ffn_pool_size):
+                raise ValueError('Pooling does not support unpadding.')
+            x = Lambda(self.compute_unpadded,
+                       output_shape=lambda s: (None, s[0][-1]),
+                       name='Unpad')([x, x_in])
+
+        # 相对位置id，各层共用
+        if self.max_relative_position is not None:
+
+            def compute_relative_ids(x):
+                seq_len = K.shape(x)[1]
+                return relative_ids(seq_len, seq_len,
+                                    self.max_relative_position)
+
+            r_ids = Lambda(compute_relative_ids, name='Relative-Position')(x_in)
+
         # 主要Transformer部分
-        layers = None
+        layers, biases = None, []
         for i in range(self.num_hidden_layers):
             attention_name = 'Transformer-%d-MultiHeadSelfAttention' % (i + 1)
             feed_forward_name = 'Transformer-%d-FeedForward' % (i + 1)
+            attention_bias = relative_position_ids = attention_ids = None
+            if self.att_chunk_size[i] and not (
+                    self.att_pool_size[i] or self.att_window_size[i] or
+                    self.att_linear[i]):
+                # 分块计算的层按块构建mask，不构建完整的attention mask
+                attention_ids = self.compute_attention_ids(i, s_in)
+            if attention_ids is None:
+                attention_mask = self.compute_attention_mask(i, s_in)
+            else:
+                attention_mask = None
+            if not (self.att_pool_size[i] or self.att_window_size[i] or
+                    self.att_linear[i] or self.att_chunk_size[i]):
+                if self.max_relative_position is not None:
+                    relative_position_ids = r_ids
+                # 相同的attention mask只算一次bias，各层共用
+                for mask, bias in biases:
+                    if mask is attention_mask:
+                        attention_bias = bias
+                if attention_bias is None:
+                    attention_bias = self.compute_attention_bias(
+                        x_in, attention_mask, len(biases))
+                    biases.append((attention_mask, attention_bias))
             x, layers = self.transformer_block(
                 inputs=[x, z],
-                attention_mask=self.compute_attention_mask(i, s_in),
+                attention_mask=attention_mask,
+                attention_bias=attention_bias,
+                attention_ids=attention_ids,
+                relative_position_ids=relative_position_ids,
                 attention_name=attention_name,
                 feed_forward_name=feed_forward_name,
                 layer_norm_cond_hidden_size=layer_norm_cond_hidden_size,
                 layer_norm_cond_hidden_act=layer_norm_cond_hidden_act,
                 attention_pool_size=self.att_pool_size[i],
+                attention_window_size=self.att_window_size[i],
+                attention_chunk_size=self.att_chunk_size[i],
+                attention_linear=self.att_linear[i],
                 feed_forward_pool_size=self.ffn_pool_size[i],
+                token_ids=x_in if self.unpad else None,
                 layers=layers)
             if not self.block_sharing:
                 layers = None
 
+        # 恢复padding，padding部分为0
+        if self.unpad:
+            x = Lambda(self.compute_padded,
+                       output_shape=lambda s: s[1] + (s[0][-1], ),
+                       name='Pad')([x, x_in])
+
         outputs = [x]
+        self.sequence_output = x
 
         if self.with_pool or self.with_nsp:
             # Pooler部分（提取CLS向量）
-            x = outputs[0]
-            x = Lambda(lambda x: x[:, 0], name='Pooler')(x)
+            x = self.compute_pooler_input(outputs[0])
             pool_activation = 'tanh' if self.with_pool is True else self.with_pool
             x = Dense(units=self.hidden_size,
                       activation=pool_activation,
@@ -179,9 +273,18 @@ class BertModel(object):
                                    hidden_initializer=self.initializer,
                                    name='MLM-Norm')(self.filter([x, z]))
             mlm_activation = 'softmax' if self.with_mlm is True else self.with_mlm
-            x = EmbeddingDense(embedding_name='Embedding-Token',
-                               activation=mlm_activation,
-                               name='MLM-Proba')(x)
+            if self.adaptive_softmax:
+                x = AdaptiveSoftmax(vocab_size=self.vocab_size,
+                                    cutoffs=self.adaptive_softmax,
+                                    embedding_name='Embedding-Token',
+                                    token_order=self.token_order,
+                                    log_proba=(mlm_activation != 'softmax'),
+                                    kernel_initializer=self.initializer,
+                                    name='MLM-Proba')(x)
+            else:
+                x = EmbeddingDense(embedding_name='Embedding-Token',
+                                   activation=mlm_activation,
+                                   name='MLM-Proba')(x)
             outputs.append(x)
 
         outputs += self.additional_outputs
@@ -193,19 +296,32 @@ class BertModel(object):
             outputs = outputs[1:]
 
         self.model = keras.models.Model(input_layers, outputs)
+        self.input_layers = input_layers
+        self.layer_norm_cond = z
 
     def transformer_block(self,
                           inputs,
                           attention_mask=None,
+                          attention_bias=None,
+                          attention_ids=None,
+                          relative_position_ids=None,
                           attention_name='attention',
                           feed_forward_name='feed-forward',
                           layer_norm_cond_hidden_size=None,
                           layer_norm_cond_hidden_act='linear',
                           attention_pool_size=None,
+                          attention_window_size=None,
+                          attention_chunk_size=None,
+                          attention_linear=False,
                           feed_forward_pool_size=None,
+                          token_ids=None,
                           layers=None):
         """构建单个Transformer Block
         如果没传入layers则新建层；如果传入则重用旧层。
+        传入attention_bias时直接使用（见compute_attention_bias），
+        忽略attention_mask；传入attention_ids时用它代替attention_mask（见
+        compute_attention_ids）；relative_position_ids为各层共用的相对位置id。
+        传入token_ids时x为去掉padding后的(num_tokens, hidden_size)。
         """
         x, z = inputs
         layers = layers or [
@@ -214,6 +330,12 @@ class BertModel(object):
                                kernel_initializer=self.initializer,
                                max_relative_position=self.max_relative_position,
                                pool_size=attention_pool_size,
+                               fused_qkv=self.fused_qkv,
+                               window_size=attention_window_size,
+                               window_mode=self.att_window_mode,
+                               global_size=self.att_global_size,
+                               chunk_size=attention_chunk_size,
+                               linear=attention_linear,
                                name=attention_name),
             Dropout(rate=self.dropout_rate,
                     name='%s-Dropout' % attention_name),
@@ -238,16 +360,32 @@ class BertModel(object):
                                hidden_initializer=self.initializer,
                                name='%s-Norm' % feed_forward_name),
         ]
+        if self.recompute:
+            # Attention、FeedForward、LayerNorm只保存输入（见recompute_grad）
+            for i in [0, 3, 4, 7]:
+                layers[i].recompute = True
         # Self Attention
         xi, x = x, [x, x, x]
         mask = 'Sequence-Mask'
-        if attention_mask is None:
-            x = layers[0](x, q_mask=mask, v_mask=mask)
+        arguments = {'q_mask': mask, 'v_mask': mask}
+        if attention_bias is not None:
+            x.append(attention_bias)
+            arguments['a_bias'] = True
         elif attention_mask is 'history_only':
-            x = layers[0](x, q_mask=mask, v_mask=mask, a_mask=True)
-        else:
+            arguments['a_mask'] = True
+        elif attention_mask is not None:
             x.append(attention_mask)
-            x = layers[0](x, q_mask=mask, v_mask=mask, a_mask=True)
+            arguments['a_mask'] = True
+        if attention_ids is not None:
+            x.append(attention_ids)
+            arguments['a_ids'] = True
+        if relative_position_ids is not None:
+            x.append(relative_position_ids)
+            arguments['r_ids'] = True
+        if token_ids is not None:
+            x.append(token_ids)
+            arguments['unpad'] = True
+        x = layers[0](x, **arguments)
         if self.dropout_rate > 0:
             x = layers[1](x)
         x = layers[2]([xi, x])
@@ -266,6 +404,297 @@ class BertModel(object):
         """
         return None
 
+    def compute_attention_ids(self, layer_id, segment_ids):
+        """用(batch_size, seq_len)的id表示Attention Mask（见
+        MultiHeadAttention.ids_mask），供分块计算的层（att_chunk_size）
+        按块构建mask；返回None时照常使用compute_attention_mask。
+        """
+        return None
+
+    @staticmethod
+    def compute_unpadded(inputs):
+        """(batch_size, seq_len, hidden_size)的序列去掉padding，
+        得到(num_tokens, hidden_size)
+        """
+        x, token_ids = inputs
+        return tf.gather_nd(x, tf.where(K.greater(token_ids, 0)))
+
+    @staticmethod
+    def compute_padded(inputs):
+        """compute_unpadded的逆运算，padding部分补0
+        """
+        x, token_ids = inputs
+        idxs = tf.where(K.greater(token_ids, 0))
+        shape = K.cast(K.shape(token_ids), 'int64')
+        shape = K.concatenate([shape, K.cast(K.shape(x)[-1:], 'int64')])
+        return tf.scatter_nd(idxs, x, shape)
+
+    def compute_pooler_input(self, sequence_output):
+        """定义Pooler部分的输入，默认为[CLS]向量
+        """
+        return Lambda(lambda x: x[:, 0], name='Pooler')(sequence_output)
+
+    def compute_attention_bias(self, token_ids, attention_mask, index=0):
+        """将padding mask与attention mask合并为加到attention矩阵上的bias
+        形状可广播为(batch_size, heads, q_len, k_len)，每次前向只算一次，
+        供各层共用，避免每层重复构建mask。
+        """
+        def attention_bias(inputs):
+            v_mask = K.cast(K.greater(inputs[0], 0), K.floatx())
+            bias = (K.expand_dims(K.expand_dims(v_mask, 1), 1) - 1) * 1e12
+            if is_string(attention_mask):  # 即history_only
+                idxs = K.arange(0, K.shape(inputs[0])[1])
+                a_mask = K.greater_equal(K.expand_dims(idxs, 1), idxs)
+                a_mask = K.cast(a_mask, K.floatx())[None, None]
+            elif attention_mask is not None:
+                a_mask = inputs[1]
+            else:
+                return bias
+            return bias + (a_mask - 1) * 1e12
+
+        inputs = [token_ids]
+        if attention_mask is not None and not is_string(attention_mask):
+            inputs.append(attention_mask)
+        name = 'Attention-Bias' + ('-%d' % index if index else '')
+        return Lambda(attention_bias, name=name)(inputs)
+
+    def compute_lm_loss(self, target_mask=None, chunk_size=8192):
+        """语言模型的交叉熵（需要with_mlm），用于seq2seq、lm的finetune
+        只取出目标位置的编码向量再接MLM部分，交叉熵按词表分块计算（见
+        chunked_sparse_categorical_crossentropy），不构建完整的
+        (batch_size, seq_len, vocab_size)概率矩阵。
+        target_mask与token_ids对齐，为1的位置作为预测目标（由前一个位置
+        的输出来预测），默认为非padding部分，seq2seq时传入segment_ids即可。
+        返回平均loss，可直接model.add_loss。
+        """
+        if not self.with_mlm:
+            raise ValueError('LM loss requires with_mlm.')
+        get_layer = self.model.get_layer
+        if target_mask is None:
+            target_mask = get_layer('Sequence-Mask').output_mask
+        idxs = tf.where(K.greater(target_mask[:, 1:], 0))
+        x = tf.gather_nd(self.sequence_output[:, :-1], idxs)
+        y = tf.gather_nd(self.input_layers[0][:, 1:], idxs)
+        z = self.layer_norm_cond
+        if z is not None:
+            z = tf.gather(z, idxs[:, 0])
+        # 直接调用MLM部分各层的call，只作用于目标位置
+        x = get_layer('MLM-Dense').call(x)
+        x = get_layer('MLM-Norm').call(self.filter([x, z]))
+        proba = get_layer('MLM-Proba')
+        if self.adaptive_softmax:
+            loss = proba.compute_loss(x, y)
+        else:
+            loss = chunked_sparse_categorical_crossentropy(
+                y, x, proba.kernel, proba.bias, chunk_size)
+        return K.mean(loss)
+
+    def compute_step_attention_mask(self, inputs):
+        """定义step模型的Attention Mask，形状为(batch_size, 1, q_len, k_len)
+        inputs为[新增部分的token_ids, 完整的token_ids, 完整的segment_ids]，
+        其中“完整”指缓存前缀与新增部分拼接后的序列。
+        默认的双向Attention下，前缀的计算依赖后续token，无法缓存。
+        """
+        raise ValueError('Bidirectional attention does not support caching.')
+
+    def build_step_model(self, cached_condition=False, generation_head=None):
+        """构建增量预测用的step模型（仅用于推断，与self.model共享权重）
+        输入：新增部分的token_ids、segment_ids，已缓存前缀的token_ids、
+             segment_ids，前缀在每一层Transformer的输入（缓存状态），
+             以及self.model的其余输入（条件输入等）；
+        输出：新增部分的主输出（with_mlm时为MLM-Proba，否则为编码向量），
+             以及新增部分在每一层Transformer的输入（用于扩充缓存）。
+        cached_condition=True时，条件输入换成build_condition_model输出的
+        各层beta、gamma增量（不含条件向量本身），条件只需每个请求算一次。
+        generation_head非None时（需with_mlm），主输出换成新增部分最后一个
+        位置的生成结果，含义同build_bert_model的generation_head。
+        """
+        if self.max_relative_position is not None:
+            raise ValueError('Relative position does not support caching.')
+        if any(self.att_pool_size + self.ffn_pool_size):
+            raise ValueError('Pooling does not support caching.')
+        if any(self.att_window_size):
+            raise ValueError('Window attention does not support caching.')
+        if any(self.att_linear):
+            raise ValueError('Linear attention does not support caching.')
+        if self.unpad:
+            raise ValueError('Unpadding does not support caching.')
+
+        get_layer = self.model.get_layer
+        x_in = Input(shape=(None, ), name='Step-Input-Token')
+        s_in = Input(shape=(None, ), name='Step-Input-Segment')
+        cx_in = Input(shape=(None, ), name='Cache-Token')
+        cs_in = Input(shape=(None, ), name='Cache-Segment')
+        caches = [
+            Input(shape=(None, self.hidden_size), name='Cache-%d' % (i + 1))
+            for i in range(self.num_hidden_layers)
+        ]
+        z = self.layer_norm_cond
+
+        conditions = OrderedDict()
+        if cached_condition:
+            for layer in self.condition_layers:
+                conditions[layer.name] = [
+                    Input(shape=(layer.beta_dense.units, ),
+                          name='Condition-%s-%s' % (layer.name, n))
+                    for n in ['Beta', 'Gamma']
+                ]
+
+        def norm(name, x):
+            if name in conditions:
+                return get_layer(name)([x] + conditions[name])
+            else:
+                return get_layer(name)(self.filter([x, z]))
+
+        # 拼接得到完整序列，并计算Attention Mask
+        cx = Concatenate(axis=1, name='Step-Token')([cx_in, x_in])
+        cs = Concatenate(axis=1, name='Step-Segment')([cs_in, s_in])
+        a_mask = self.compute_step_attention_mask([x_in, cx, cs])
+
+        # Embedding部分
+        x = get_layer('Embedding-Token')(x_in)
+        s = get_layer('Embedding-Segment')(s_in)
+        x = get_layer('Embedding-Token-Segment')([x, s])
+
+        def position_ids(inputs):
+            x, c = inputs
+            ids = K.arange(0, K.shape(x)[1]) + K.shape(c)[1]
+            return K.tile(K.expand_dims(ids, 0), [K.shape(x)[0], 1])
+
+        p = Lambda(position_ids, name='Step-Position')([x_in, cx_in])
+        x = get_layer('Embedding-Position')([x, p])
+        x = norm('Embedding-Norm', x)
+        if self.embedding_size != self.hidden_size:
+            x = get_layer('Embedding-Mapping')(x)
+
+        # 主要Transformer部分
+        states = []
+        for i in range(self.num_hidden_layers):
+            j = 1 if self.block_sharing else i + 1
+            attention_name = 'Transformer-%d-MultiHeadSelfAttention' % j
+            feed_forward_name = 'Transformer-%d-FeedForward' % j
+            states.append(x)
+            xi = x
+            kv = Concatenate(axis=1)([caches[i], x])
+            x = get_layer(attention_name)([x, kv, kv, a_mask], a_mask=True)
+            x = get_layer('%s-Add' % attention_name)([xi, x])
+            x = norm('%s-Norm' % attention_name, x)
+            xi = x
+            x = get_layer(feed_forward_name)(x)
+            x = get_layer('%s-Add' % feed_forward_name)([xi, x])
+            x = norm('%s-Norm' % feed_forward_name, x)
+
+        if generation_head is not None:
+            if not self.with_mlm:
+                raise ValueError('Generation head requires with_mlm.')
+            x = Lambda(lambda x: x[:, -1], name='Generation-Gather')(x)
+            topk = None if generation_head is True else generation_head
+            x = self.compute_generation_head(x, norm, topk)
+        elif self.with_mlm:
+            x = get_layer('MLM-Dense')(x)
+            x = norm('MLM-Norm', x)
+            x = get_layer('MLM-Proba')(x)
+
+        inputs = [x_in, s_in, cx_in, cs_in] + caches
+        if cached_condition:
+            inputs += [i for c in conditions.values() for i in c]
+        else:
+            inputs += self.input_layers[2:]
+        outputs = x if isinstance(x, list) else [x]
+        self.step_model = keras.models.Model(inputs, outputs + states)
+        return self.step_model
+
+    @property
+    def condition_layers(self):
+        """所有的条件Layer Normalization层（共享的层只算一次）
+        """
+        return [
+            layer for layer in self.model.layers
+            if isinstance(layer, LayerNormalization) and layer.conditional
+        ]
+
+    def build_condition_model(self):
+        """构建条件部分的模型（仅用于推断，与self.model共享权重）
+        输入为self.model的条件输入（即除token_ids、segment_ids外的输入），
+        输出为每个条件Layer Normalization层的[beta增量, gamma增量]，
+        顺序与build_step_model(cached_condition=True)的条件输入一致。
+        解码时每个请求只需调用一次。
+        """
+        z = self.layer_norm_cond
+        if z is None:
+            raise ValueError('Model has no condition.')
+
+        outputs = []
+        for layer in self.condition_layers:
+            outputs.extend(layer.compute_condition(z))
+
+        self.condition_model = keras.models.Model(self.input_layers[2:],
+                                                  outputs)
+        return self.condition_model
+
+    def build_generation_model(self, topk=None, position=-1):
+        """构建生成用的模型（仅用于推断，与self.model共享权重）
+        先取出单个位置的编码向量，再接MLM部分，避免对所有位置算softmax。
+        position为int时取该位置（默认最后一个），为None时则新增输入
+        Generation-Position（形状为(batch_size, 1)），逐行指定位置；
+        topk为None时输出该位置的概率对数，否则在图内取topk，输出
+        [topk个概率对数, topk个token id]，可以直接返回给beam search。
+        """
+        if not self.with_mlm:
+            raise ValueError('Generation model requires with_mlm.')
+
+        get_layer = self.model.get_layer
+        inputs = self.input_layers[:]
+        x, z = self.sequence_output, self.layer_norm_cond
+
+        if position is None:
+            p_in = Input(shape=(1, ), dtype='int32', name='Generation-Position')
+            inputs.append(p_in)
+
+            def gather(inputs):
+                x, p = inputs
+                idxs = K.arange(0, K.shape(p)[0])
+                idxs = K.stack([idxs, K.cast(p[:, 0], 'int32')], 1)
+                return tf.gather_nd(x, idxs)
+
+            x = Lambda(gather, name='Generation-Gather')([x, p_in])
+        else:
+            x = Lambda(lambda x: x[:, position], name='Generation-Gather')(x)
+
+        norm = lambda name, x: get_layer(name)(self.filter([x, z]))
+        x = self.compute_generation_head(x, norm, topk)
+        self.generation_model = keras.models.Model(inputs, x)
+        return self.generation_model
+
+    def compute_generation_head(self, x, norm, topk=None):
+        """在单个位置的编码向量上接MLM部分，输出概率对数或图内的topk
+        norm(name, x)负责调用（条件）Layer Normalization层。
+        """
+        get_layer = self.model.get_layer
+        x = get_layer('MLM-Dense')(x)
+        x = norm('MLM-Norm', x)
+        mlm = get_layer('MLM-Proba')
+
+        if self.adaptive_softmax:
+            # 自适应softmax直接在图内取topk，跳过不需要的尾部簇
+            if topk is not None:
+                x = Lambda(lambda x: mlm.compute_topk(x, topk),
+                           name='Generation-TopK')(x)
+            else:
+                x = Lambda(mlm.compute_log_proba,
+                           name='Generation-LogProba')(x)
+        else:
+
+            def log_proba(x):
+                x = K.bias_add(K.dot(x, mlm.kernel), mlm.bias)
+                return tf.nn.log_softmax(x)
+
+            x = Lambda(log_proba, name='Generation-LogProba')(x)
+            if topk is not None:
+                x = Lambda(lambda x: list(tf.nn.top_k(x, topk)),
+                           name='Generation-TopK')(x)
+        return x
+
     @property
     def initializer(self):
         """默认使用截断正态分布初始化
@@ -366,11 +795,31 @@ class BertModel(object):
                 'cls/predictions/transform/dense/bias',
                 'cls/predictions/transform/LayerNorm/gamma',
                 'cls/predictions/transform/LayerNorm/beta',
-                'cls/predictions/output_bias',
             ])
+            if not self.adaptive_softmax:
+                # 自适应softmax的权重在原checkpoint中没有对应
+                mapping.append('cls/predictions/output_bias')
+
+        if self.fused_qkv:
+            mapping = self.fuse_qkv_mapping(mapping)
 
         return mapping
 
+    def fuse_qkv_mapping(self, mapping):
+        """fused_qkv时，将q、k、v各自的kernel、bias合并为变量名的list，
+        加载时沿最后一维拼接，保存时再等分，跟原checkpoint保持一致
+        """
+        fused, i = [], 0
+        while i < len(mapping):
+            if mapping[i].endswith('/self/query/kernel'):
+                fused.append(mapping[i:i + 6:2])
+                fused.append(mapping[i + 1:i + 6:2])
+                i += 6
+            else:
+                fused.append(mapping[i])
+                i += 1
+        return fused
+
     def load_weights_from_checkpoint(self,
                                      checkpoint_file,
                                      reference='bert',
@@ -382,6 +831,8 @@ class BertModel(object):
 
         def load_variable(name):
             # 加载单个变量的函数
+            if isinstance(name, list):
+                return np.concatenate([load_variable(n) for n in name], -1)
             variable = tf.train.load_variable(checkpoint_file, name)
             if name in [
                     'bert/embeddings/word_embeddings',
@@ -419,8 +870,9 @@ class BertModel(object):
             'NSP-Proba',
             'MLM-Dense',
             'MLM-Norm',
-            'MLM-Proba',
         ])
+        if not self.adaptive_softmax:
+            bert_layer_names.append('MLM-Proba')
 
         weights = []
         for layer_name in bert_layer_names:
@@ -453,6 +905,9 @@ class BertModel(object):
             mapping = self.variable_mapping(reference)
 
         def create_variable(name, value):
+            if isinstance(name, list):
+                values = np.split(value, len(name), -1)
+                return [create_variable(n, v) for n, v in zip(name, values)]
             if name == 'cls/seq_relationship/output_weights':
                 value = value.T
             return tf.Variable(value, name=name)
@@ -473,6 +928,7 @@ class Bert4Seq2seq(BertModel):
         super(Bert4Seq2seq, self).__init__(*args, **kwargs)
         self.with_mlm = self.with_mlm or True
         self.attention_mask = None
+        self.attention_ids = None
 
     def compute_attention_mask(self, layer_id, segment_ids):
         """为seq2seq采用特定的attention mask
@@ -496,6 +952,34 @@ class Bert4Seq2seq(BertModel):
 
         return self.attention_mask
 
+    def compute_attention_ids(self, layer_id, segment_ids):
+        """seq2seq的Attention Mask id：segment_ids的累加
+        """
+        if self.attention_ids is None:
+            self.attention_ids = Lambda(
+                lambda s: K.cumsum(s, 1),
+                name='Attention-Ids')(segment_ids)
+
+        return self.attention_ids
+
+    def compute_step_attention_mask(self, inputs):
+        """step模型的seq2seq Attention Mask
+        """
+        def seq2seq_step_attention_mask(inputs):
+            x, c, s = inputs
+            q_len, k_len = K.shape(x)[1], K.shape(c)[1]
+            q_idxs = K.expand_dims(K.arange(k_len - q_len, k_len), 1)
+            k_idxs = K.expand_dims(K.arange(0, k_len), 0)
+            a_mask = K.cast(K.greater_equal(q_idxs, k_idxs), K.floatx())
+            s_q = K.expand_dims(K.expand_dims(s[:, -q_len:], 1), 3)
+            s_k = K.expand_dims(K.expand_dims(s, 1), 2)
+            a_mask = (1 - s_q) * (1 - s_k) + s_q * a_mask
+            v_mask = K.cast(K.greater(c, 0), K.floatx())
+            return a_mask * K.expand_dims(K.expand_dims(v_mask, 1), 2)
+
+        return Lambda(seq2seq_step_attention_mask,
+                      name='Step-Attention-Mask')(inputs)
+
 
 class Bert4LM(BertModel):
     """用来做语言模型任务的Bert
@@ -508,6 +992,105 @@ class Bert4LM(BertModel):
     def compute_attention_mask(self, layer_id, segment_ids):
         return self.attention_mask
 
+    def compute_step_attention_mask(self, inputs):
+        """step模型的单向语言模型Attention Mask
+        """
+        def lm_step_attention_mask(inputs):
+            x, c = inputs[:2]
+            q_len, k_len = K.shape(x)[1], K.shape(c)[1]
+            q_idxs = K.expand_dims(K.arange(k_len - q_len, k_len), 1)
+            k_idxs = K.expand_dims(K.arange(0, k_len), 0)
+            a_mask = K.cast(K.greater_equal(q_idxs, k_idxs), K.floatx())
+            v_mask = K.cast(K.greater(c, 0), K.floatx())
+            return a_mask * K.expand_dims(K.expand_dims(v_mask, 1), 2)
+
+        return Lambda(lm_step_attention_mask,
+                      name='Step-Attention-Mask')(inputs)
+
+
+class Bert4Packing(BertModel):
+    """把多个样本拼接成一条序列来finetune的Bert（配合SequencePacker）
+    额外的输入Input-Example标记每个token所属的样本（从1开始，0为
+    padding），attention只在同一样本内进行，位置编码按样本重新开始，
+    Pooler输出每个样本的[CLS]向量，形状为(batch_size, 样本数, hidden_size)，
+    并带有标记样本是否存在的mask（计算loss时自动忽略不存在的样本）。
+    """
+    def __init__(self, *args, **kwargs):
+        super(Bert4Packing, self).__init__(*args, **kwargs)
+        self.attention_mask = None
+
+    def build(self,
+              position_ids=None,
+              additional_input_layers=None,
+              **kwargs):
+        self.example_ids = Input(shape=(None, ), name='Input-Example')
+        if position_ids is None:
+
+            def packing_position_ids(e):
+                starts = self.compute_example_starts(e)
+                e = K.cast(e, 'int32')
+                idxs = K.expand_dims(K.arange(0, K.shape(e)[1]), 0)
+                return idxs - batch_gather(starts, e)
+
+            position_ids = Lambda(packing_position_ids,
+                                  name='Packing-Position')(self.example_ids)
+
+        if additional_input_layers is None:
+            additional_input_layers = []
+        elif not isinstance(additional_input_layers, list):
+            additional_input_layers = [additional_input_layers]
+        additional_input_layers = [self.example_ids] + additional_input_layers
+        super(Bert4Packing, self).build(
+            position_ids=position_ids,
+            additional_input_layers=additional_input_layers,
+            **kwargs)
+
+    @staticmethod
+    def compute_example_starts(example_ids):
+        """每个样本第一个token的位置，形状为(batch_size, 样本数 + 1)，
+        第0列对应padding（没有的样本位置为0）
+        """
+        e = K.cast(example_ids, 'int32')
+        ids = K.arange(0, K.max(e) + 1)
+        is_example = K.equal(K.expand_dims(e, 1), ids[None, :, None])
+        return K.cast(K.argmax(K.cast(is_example, 'int32'), 2), 'int32')
+
+    def compute_attention_mask(self, layer_id, segment_ids):
+        """block-diagonal的attention mask：只看同一样本内的token
+        """
+        if self.attention_mask is None:
+
+            def packing_attention_mask(e):
+                e_q = K.expand_dims(K.expand_dims(e, 1), 3)
+                e_k = K.expand_dims(K.expand_dims(e, 1), 2)
+                return K.cast(K.equal(e_q, e_k), K.floatx())
+
+            self.attention_mask = Lambda(
+                packing_attention_mask,
+                name='Attention-Mask')(self.example_ids)
+
+        return self.attention_mask
+
+    def compute_pooler_input(self, sequence_output):
+        """取出每个样本的[CLS]向量
+        """
+        def packing_pooler(inputs):
+            x, e = inputs
+            starts = self.compute_example_starts(e)[:, 1:]
+            return tf.gather(x, starts, batch_dims=1)
+
+        def packing_pooler_mask(inputs, mask=None):
+            e = K.cast(inputs[1], 'int32')
+            ids = K.arange(1, K.max(e) + 1)
+            return K.any(K.equal(K.expand_dims(e, 1), ids[None, :, None]), 2)
+
+        return Lambda(packing_pooler,
+                      mask=packing_pooler_mask,
+                      name='Pooler')([sequence_output, self.example_ids])
+
+    def compute_step_attention_mask(self, inputs):
+        raise ValueError('Packing does not support caching.')
+
 
 def build_bert_model(config_path,
                      checkpoint_path=None,
@@ -526,16 +1109,64 @@ def build_bert_model(config_path,
                      additional_input_layers=None,
                      att_pool_size=None,
                      ffn_pool_size=None,
-                     return_keras_model=True):
+                     return_keras_model=True,
+                     generation_head=None,
+                     fused_qkv=False,
+                     att_window_size=None,
+                     att_window_mode='sliding',
+                     att_global_size=0,
+                     att_chunk_size=None,
+                     att_linear=False,
+                     recompute=False,
+                     unpad=False,
+                     adaptive_softmax=None,
+                     token_frequencies=None,
+                     config_overrides=None):
     """根据配置文件构建bert模型，可选加载checkpoint权重
+    config_overrides为dict，用于覆盖配置文件中的同名配置，比如传入
+    {'num_hidden_layers': 3}即可得到只保留前3层的模型（常用作投机采样的
+    draft模型）；只接受配置文件中已有的项及可选项，拼写错误会直接报错。
+    generation_head非None时返回生成用的模型（见build_generation_model），
+    为True时输出最后一个位置的概率对数，为整数k时输出图内的topk结果。
+    fused_qkv=True时Attention的q、k、v合并为一次矩阵乘法，加载及保存
+    checkpoint时仍然对应原来的q、k、v变量。
+    att_window_size跟att_pool_size一样可以逐层指定（int或list），非None
+    的层使用稀疏的局部attention，att_window_mode与att_global_size的含义
+    见MultiHeadAttention。att_chunk_size同样逐层指定，非None的层按query
+    分块计算attention，结果不变，只降低峰值显存（长文本时可加大batch）；
+    lm、seq2seq的mask也按块构建，不需要完整的(seq_len, seq_len)矩阵。
+    att_linear同样逐层指定（bool或list），为True的层使用线性attention，
+    参数与原来相同，可直接加载checkpoint后finetune。
+    recompute=True时各Transformer层的Attention、FeedForward、LayerNorm
+    在反向传播时重新计算，只保存各自的输入，以额外的训练时间换取显存。
+    unpad=True时Embedding之后去掉padding，FeedForward、LayerNorm及
+    Attention的线性变换只作用于真实token，只在计算attention矩阵时恢复
+    padding，padding比例越高加速越明显。
+    adaptive_softmax非None时（cutoffs列表，如[2000, 10000]），MLM部分换成
+    自适应softmax（见AdaptiveSoftmax），token按token_frequencies从高到低
+    排序后分簇，适合大词表的lm、seq2seq；训练时用compute_lm_loss，生成时
+    用generation_head=k。其权重不在原checkpoint中，需另用save_weights保存。
+    application='packing'时多个样本拼接成一条序列，见Bert4Packing与
+    snippets.SequencePacker。
     """
     config = json.load(open(config_path))
+    if config_overrides:
+        optional = [
+            'max_position_embeddings', 'initializer_range', 'embedding_size',
+            'num_feed_forward_groups'
+        ]
+        unknown = set(config_overrides) - set(config) - set(optional)
+        if unknown:
+            raise ValueError('Unknown config overrides: %s' %
+                             ', '.join(sorted(unknown)))
+        config.update(config_overrides)
     model, application = model.lower(), application.lower()
 
     applications = {
         'encoder': BertModel,
         'seq2seq': Bert4Seq2seq,
         'lm': Bert4LM,
+        'packing': Bert4Packing,
     }
     if application not in applications:
         raise ValueError('application must be one of ' +
@@ -548,6 +1179,9 @@ def build_bert_model(config_path,
             def compute_attention_mask(self, layer_id, segment_ids):
                 return attention_mask
 
+            def compute_step_attention_mask(self, inputs):
+                raise ValueError('Custom attention_mask does not support caching.')
+
     bert = Bert(vocab_size=config['vocab_size'],
                 max_position_embeddings=config.get('max_position_embeddings'),
                 hidden_size=config['hidden_size'],
@@ -566,7 +1200,17 @@ def build_bert_model(config_path,
                 keep_tokens=keep_tokens,
                 block_sharing=(model == 'albert'),
                 att_pool_size=att_pool_size,
-                ffn_pool_size=ffn_pool_size)
+                ffn_pool_size=ffn_pool_size,
+                fused_qkv=fused_qkv,
+                att_window_size=att_window_size,
+                att_window_mode=att_window_mode,
+                att_global_size=att_global_size,
+                att_chunk_size=att_chunk_size,
+                att_linear=att_linear,
+                recompute=recompute,
+                unpad=unpad,
+                adaptive_softmax=adaptive_softmax,
+                token_frequencies=token_frequencies)
 
     bert.build(position_ids=position_ids,
                layer_norm_cond=layer_norm_cond,
@@ -582,6 +1226,12 @@ def build_bert_model(config_path,
             reference = 'bert'
         bert.load_weights_from_checkpoint(checkpoint_path, reference)
 
+    if generation_head is not None:
+        topk = None if generation_head is True else generation_head
+        bert.build_generation_model(topk)
+        if return_keras_model:
+            return bert.generation_model
+
     if return_keras_model:
         return bert.model
     else:
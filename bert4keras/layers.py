@@ -8,6 +8,11 @@ from bert4keras.backend import search_layer
 from bert4keras.backend import sequence_masking
 from bert4keras.backend import pool1d
 from bert4keras.backend import divisible_temporal_padding
+from bert4keras.backend import recompute_grad, do_recompute
+from bert4keras.backend import batch_gather
+from bert4keras.backend import relative_ids
+from bert4keras.backend import viterbi_decode
+from bert4keras.backend import crf_log_norm
 from bert4keras.snippets import is_string
 from keras import initializers, activations
 from keras.layers import *
@@ -64,6 +69,18 @@ class ZeroMasking(Layer):
 
 class MultiHeadAttention(Layer):
     """多头注意力机制
+    fused_qkv=True时q、k、v共用一个Dense（kernel按q、k、v的顺序拼接），
+    self attention时只需一次矩阵乘法；收益不大，且只在batch_size *
+    seq_len较大（上千个token）时才可能出现，单条短序列（如CPU上逐步
+    解码）反而略慢（见examples/basic_fused_qkv_benchmark.py）。
+    window_size非None时使用稀疏的局部attention（见window_attention），
+    window_mode为sliding（只看距离不超过window_size的位置）或block
+    （分块后只看相邻的三个块），前global_size个位置（如[CLS]）为全局
+    位置，既看所有位置，也被所有位置看到。
+    chunk_size非None时query按chunk_size分块计算（见chunked_attention），
+    峰值显存从O(L^2)降到O(chunk_size * L)，结果不变。
+    linear=True时使用线性attention（见linear_attention），计算量与序列
+    长度成线性关系，但只是标准attention的近似。
     """
     def __init__(self,
                  heads,
@@ -72,6 +89,12 @@ class MultiHeadAttention(Layer):
                  pool_size=None,
                  kernel_initializer='glorot_uniform',
                  max_relative_position=None,
+                 fused_qkv=False,
+                 window_size=None,
+                 window_mode='sliding',
+                 global_size=0,
+                 chunk_size=None,
+                 linear=False,
                  **kwargs):
         super(MultiHeadAttention, self).__init__(**kwargs)
         self.heads = heads
@@ -81,15 +104,34 @@ class MultiHeadAttention(Layer):
         self.pool_size = pool_size or 1
         self.kernel_initializer = initializers.get(kernel_initializer)
         self.max_relative_position = max_relative_position
+        self.fused_qkv = fused_qkv
+        self.window_size = window_size
+        self.window_mode = window_mode
+        self.global_size = global_size or 0
+        self.chunk_size = chunk_size
+        self.linear = linear
+        if window_size is not None:
+            if self.pool_size > 1 or max_relative_position is not None:
+                raise ValueError('Window attention does not support pooling ' +
+                                 'or relative position.')
+        if linear and max_relative_position is not None:
+            raise ValueError('Linear attention does not support ' +
+                             'relative position.')
 
     def build(self, input_shape):
         super(MultiHeadAttention, self).build(input_shape)
-        self.q_dense = Dense(units=self.key_size * self.heads,
-                             kernel_initializer=self.kernel_initializer)
-        self.k_dense = Dense(units=self.key_size * self.heads,
-                             kernel_initializer=self.kernel_initializer)
-        self.v_dense = Dense(units=self.out_dim,
-                             kernel_initializer=self.kernel_initializer)
+        if self.fused_qkv:
+            self.qkv_dense = Dense(units=self.key_size * self.heads * 2 +
+                                   self.out_dim,
+                                   kernel_initializer=self.kernel_initializer)
+            self.qkv_dense.build(input_shape[0])
+        else:
+            self.q_dense = Dense(units=self.key_size * self.heads,
+                                 kernel_initializer=self.kernel_initializer)
+            self.k_dense = Dense(units=self.key_size * self.heads,
+                                 kernel_initializer=self.kernel_initializer)
+            self.v_dense = Dense(units=self.out_dim,
+                                 kernel_initializer=self.kernel_initializer)
         self.o_dense = Dense(units=self.out_dim,
                              kernel_initializer=self.kernel_initializer)
 
@@ -101,11 +143,11 @@ class MultiHeadAttention(Layer):
             def initializer(shape, dtype=None):
                 vocab_size, depth = shape
                 embeddings = np.zeros(shape)
-                for pos in range(vocab_size):
-                    for i in range(depth // 2):
-                        theta = pos / np.power(10000, 2. * i / depth)
-                        embeddings[pos, 2 * i] = np.sin(theta)
-                        embeddings[pos, 2 * i + 1] = np.cos(theta)
+                pos = np.arange(vocab_size)[:, None]
+                i = np.arange(depth // 2)[None]
+                theta = pos / np.power(10000, 2. * i / depth)
+                embeddings[:, 0:2 * (depth // 2):2] = np.sin(theta)
+                embeddings[:, 1:2 * (depth // 2):2] = np.cos(theta)
                 return embeddings
 
             shape = (2 * self.max_relative_position + 1, self.head_size)
@@ -114,7 +156,16 @@ class MultiHeadAttention(Layer):
                                                        initializer=initializer,
                                                        trainable=False)
 
-    def call(self, inputs, q_mask=None, v_mask=None, a_mask=None):
+    @recompute_grad
+    def call(self,
+             inputs,
+             q_mask=None,
+             v_mask=None,
+             a_mask=None,
+             a_bias=None,
+             r_ids=None,
+             a_ids=None,
+             unpad=None):
         """实现多头注意力
         q_mask: 对输入的query序列的mask。
                 主要是将输出结果的padding部分置0。
@@ -122,13 +173,48 @@ class MultiHeadAttention(Layer):
                 主要是防止attention读取到padding信息。
         a_mask: 对attention矩阵的mask。
                 不同的attention mask对应不同的应用。
+        a_bias: 为True时inputs[3]是直接加到attention矩阵上的bias，
+                已包含v_mask与a_mask的信息（多层共用，只需算一次）。
+        r_ids: 为True时inputs的最后一个是相对位置id（见relative_ids），
+               多层共用，只需算一次。
+        a_ids: 为True时inputs的最后一个（r_ids之前）是(batch_size, seq_len)
+               的attention mask id，位置j能看到位置k当且仅当
+               a_ids[k] <= a_ids[j]（见ids_mask）；分块计算时按块构建
+               mask，不需要完整的(q_len, k_len)矩阵。
+        unpad: 为True时inputs的最后一个是(batch_size, seq_len)的token_ids，
+               q、k、v是去掉padding后的(num_tokens, hidden_size)，只在
+               计算attention矩阵时恢复成带padding的形状，输出同样去掉padding。
         """
+        if unpad:
+            if self.pool_size > 1:
+                raise ValueError('Pooling does not support unpadding.')
+            inputs, token_ids = inputs[:-1], inputs[-1]
+            idxs = K.cast(tf.where(K.greater(token_ids, 0)), 'int32')
+            shape = K.shape(token_ids)
+        if r_ids:
+            inputs, r_ids = inputs[:-1], inputs[-1]
+        else:
+            r_ids = None
+        if a_ids:
+            inputs, a_ids = inputs[:-1], inputs[-1]
+        else:
+            a_ids = None
         q, k, v = inputs[:3]
+        if a_bias:
+            if self.pool_size > 1:
+                raise ValueError('Attention bias does not support pooling.')
+            a_bias, v_mask, a_mask = inputs[3], None, None
+        else:
+            a_bias = None
         if a_mask:
             if len(inputs) == 3:
                 a_mask = 'history_only'
             else:
                 a_mask = inputs[3]
+        if a_ids is not None:
+            if (self.chunk_size is None or self.window_size is not None or
+                    self.linear or self.pool_size > 1):
+                a_mask, a_ids = self.ids_mask(a_ids, a_ids), None
         if q_mask is not None:
             if not hasattr(self, 'q_mask_layer'):
                 self.q_mask_layer = search_layer(q, q_mask)
@@ -158,29 +244,65 @@ class MultiHeadAttention(Layer):
             if a_mask is not None and not is_string(a_mask):
                 a_mask = a_mask[..., ::self.pool_size, ::self.pool_size]
         # 线性变换
-        qw = self.q_dense(q)
-        kw = self.k_dense(k)
-        vw = self.v_dense(v)
+        if self.fused_qkv:
+            qw, kw, vw = self.fused_dense(q, k, v)
+        else:
+            qw = self.q_dense(q)
+            kw = self.k_dense(k)
+            vw = self.v_dense(v)
+        if unpad:
+            qw, kw, vw = [
+                tf.scatter_nd(idxs, x, [shape[0], shape[1], K.int_shape(x)[-1]])
+                for x in [qw, kw, vw]
+            ]
         # 形状变换
-        qw = K.reshape(qw, (-1, K.shape(q)[1], self.heads, self.key_size))
-        kw = K.reshape(kw, (-1, K.shape(k)[1], self.heads, self.key_size))
-        vw = K.reshape(vw, (-1, K.shape(v)[1], self.heads, self.head_size))
-        # Attention
+        qw = K.reshape(qw, (-1, K.shape(qw)[1], self.heads, self.key_size))
+        kw = K.reshape(kw, (-1, K.shape(kw)[1], self.heads, self.key_size))
+        vw = K.reshape(vw, (-1, K.shape(vw)[1], self.heads, self.head_size))
+        if self.window_size is not None:
+            o = self.window_attention(qw, kw, vw, v_mask, a_mask)
+        elif self.linear:
+            if a_bias is not None:
+                raise ValueError('Linear attention does not support bias.')
+            o = self.linear_attention(qw, kw, vw, v_mask, a_mask)
+        elif self.chunk_size is not None:
+            o = self.chunked_attention(qw, kw, vw, v_mask, a_mask, a_bias,
+                                       r_ids, a_ids)
+        else:
+            o = self.attention(qw, kw, vw, v_mask, a_mask, a_bias, r_ids)
+        o = K.reshape(o, (-1, K.shape(o)[1], self.out_dim))
+        if unpad:
+            o = tf.gather_nd(o, idxs)
+        o = self.o_dense(o)
+        # 恢复长度
+        if self.pool_size > 1:
+            o = K.repeat_elements(o, self.pool_size, 1)[:, :q_in_len]
+        # 返回结果
+        if not unpad:
+            o = sequence_masking(o, q_mask, 0)
+        return o
+
+    def attention(self,
+                  qw,
+                  kw,
+                  vw,
+                  v_mask=None,
+                  a_mask=None,
+                  a_bias=None,
+                  r_ids=None):
+        """标准的attention计算（q、k、v均已做完线性变换与形状变换）
+        """
         a = tf.einsum('bjhd,bkhd->bhjk', qw, kw)
         # 相对位置编码
         if self.max_relative_position is not None:
-            q_idxs = K.arange(0, K.shape(q)[1], dtype='int32')
-            q_idxs = K.expand_dims(q_idxs, 1)
-            v_idxs = K.arange(0, K.shape(v)[1], dtype='int32')
-            v_idxs = K.expand_dims(v_idxs, 0)
-            pos_ids = v_idxs - q_idxs
-            pos_ids = K.clip(pos_ids, -self.max_relative_position,
-                             self.max_relative_position)
-            pos_ids = pos_ids + self.max_relative_position
-            pos_embeddings = K.gather(self.relative_embeddings, pos_ids)
-            a = a + tf.einsum('bjhd,jkd->bhjk', qw, pos_embeddings)
+            if r_ids is None:
+                r_ids = relative_ids(K.shape(qw)[1], K.shape(kw)[1],
+                                     self.max_relative_position)
+            a = a + self.relative_scores(qw, r_ids)
         # Attention（续）
         a = a / self.key_size**0.5
+        if a_bias is not None:
+            a = a + a_bias
         a = sequence_masking(a, v_mask, 1, -1)
         if a_mask is not None:
             if is_string(a_mask):
@@ -193,18 +315,328 @@ class MultiHeadAttention(Layer):
         # 完成输出
         o = tf.einsum('bhjk,bkhd->bjhd', a, vw)
         if self.max_relative_position is not None:
-            o = o + tf.einsum('bhjk,jkd->bjhd', a, pos_embeddings)
-        o = K.reshape(o, (-1, K.shape(o)[1], self.out_dim))
-        o = self.o_dense(o)
-        # 恢复长度
-        if self.pool_size > 1:
-            o = K.repeat_elements(o, self.pool_size, 1)[:, :q_in_len]
-        # 返回结果
-        o = sequence_masking(o, q_mask, 0)
+            o = o + self.relative_outputs(a, r_ids)
         return o
 
+    def chunked_attention(self,
+                          qw,
+                          kw,
+                          vw,
+                          v_mask=None,
+                          a_mask=None,
+                          a_bias=None,
+                          r_ids=None,
+                          a_ids=None):
+        """query分块的attention，结果与attention完全相同
+        每次只算chunk_size个query，得分矩阵为(batch_size, heads,
+        chunk_size, k_len)；history_only、a_ids对应的mask以及相对位置id
+        都按块构建，反向传播时每块重新计算，训练时也不保存
+        完整的attention矩阵（原生keras + TF1下反向传播不重计算，
+        见backend.do_recompute）。
+        """
+        c = self.chunk_size
+        q_len, k_len = K.shape(qw)[1], K.shape(kw)[1]
+        num_chunks = (q_len + c - 1) // c
+        history_only = is_string(a_mask)
+        if history_only:
+            a_mask = None  # 每块根据位置单独构建
+        inputs = {
+            'qw': qw,
+            'kw': kw,
+            'vw': vw,
+            'v_mask': v_mask,
+            'a_mask': a_mask,
+            'a_bias': a_bias,
+            'r_ids': r_ids,
+            'q_ids': a_ids,
+            'k_ids': a_ids,
+        }
+        # query所在维度（k_ids不分块）
+        axes = {'qw': 1, 'a_mask': 2, 'a_bias': 2, 'r_ids': 0, 'q_ids': 1}
+        names = [n for n in sorted(inputs) if inputs[n] is not None]
+        chunk_names = [
+            n for n in names
+            if n in axes and K.int_shape(inputs[n])[axes[n]] != 1
+        ]
+        full_names = [n for n in names if n not in chunk_names]
+
+        def to_chunks(x, axis):
+            # padding到chunk_size的整数倍，分块后块的维度放到最前
+            paddings = [[0, 0] for _ in range(K.ndim(x))]
+            paddings[axis] = [0, num_chunks * c - q_len]
+            x = tf.pad(x, paddings)
+            shape = K.shape(x)
+            shape = tf.concat([shape[:axis], [num_chunks, c], shape[axis + 1:]],
+                              0)
+            x = tf.reshape(x, shape)
+            perm = list(range(K.ndim(x)))
+            perm = [axis] + perm[:axis] + perm[axis + 1:]
+            return K.permute_dimensions(x, perm)
+
+        chunks = [to_chunks(inputs[n], axes[n]) for n in chunk_names]
+        full = [inputs[n] for n in full_names]
+        num_args = len(chunk_names)
+
+        def attention(i, args):
+            # 第i块的attention，args依次为分块输入（的第i块）与完整输入
+            kwargs = dict(zip(chunk_names + full_names, args))
+            if history_only:
+                q_idxs = K.expand_dims(i * c + K.arange(0, c), 1)
+                k_idxs = K.expand_dims(K.arange(0, k_len), 0)
+                a_mask = K.cast(q_idxs >= k_idxs, K.floatx())
+                kwargs['a_mask'] = a_mask[None, None]
+            if 'q_ids' in kwargs:
+                q_ids, k_ids = kwargs.pop('q_ids'), kwargs.pop('k_ids')
+                kwargs['a_mask'] = self.ids_mask(q_ids, k_ids)
+            if self.max_relative_position is not None and r_ids is None:
+                kwargs['r_ids'] = relative_ids(c, k_len,
+                                               self.max_relative_position,
+                                               i * c)
+            return self.attention(**kwargs)
+
+        def forward(*args):
+            chunks, full = list(args[:num_args]), list(args[num_args:])
+            return tf.map_fn(lambda x: attention(x[0], list(x[1:]) + full),
+                             tuple([K.arange(0, num_chunks)] + chunks),
+                             dtype=K.floatx())
+
+        @tf.custom_gradient
+        def chunked(*args):
+            chunks, full = list(args[:num_args]), list(args[num_args:])
+            o = forward(*args)
+
+            def grad(do, variables=None):
+                # 反向传播时逐块重新计算attention再求梯度
+                floats = [i for i, x in enumerate(args) if x.dtype.is_floating]
+                c_floats = [i for i in floats if i < num_args]
+                f_floats = [i for i in floats if i >= num_args]
+
+                def body(i, d_chunks, d_full):
+                    xs = [x[i] for x in chunks] + [tf.identity(x) for x in full]
+                    ys = attention(i, xs)
+                    gs = tf.gradients(ys, [xs[j] for j in floats], do[i])
+                    gs = dict(zip(floats, gs))
+                    for j in floats:
+                        if gs[j] is None:
+                            gs[j] = K.zeros_like(xs[j])
+                        gs[j] = tf.convert_to_tensor(gs[j])
+                    d_chunks = [
+                        d.write(i, gs[j]) for d, j in zip(d_chunks, c_floats)
+                    ]
+                    d_full = [d + gs[j] for d, j in zip(d_full, f_floats)]
+                    return i + 1, d_chunks, d_full
+
+                d_chunks = [
+                    tf.TensorArray(args[j].dtype, size=num_chunks)
+                    for j in c_floats
+                ]
+                d_full = [K.zeros_like(args[j]) for j in f_floats]
+                _, d_chunks, d_full = tf.while_loop(
+                    lambda i, *_: i < num_chunks, body,
+                    [K.constant(0, dtype='int32'), d_chunks, d_full])
+                grads = [None] * len(args)
+                for d, j in zip(d_chunks, c_floats):
+                    grads[j] = d.stack()
+                for d, j in zip(d_full, f_floats):
+                    grads[j] = d
+                if variables:
+                    return grads, [K.zeros_like(v) for v in variables]
+                return grads
+
+            return o, grad
+
+        if do_recompute:
+            o = chunked(*(chunks + full))
+        else:
+            o = forward(*(chunks + full))
+        o = K.permute_dimensions(o, (1, 0, 2, 3, 4))
+        o = K.reshape(o, (-1, num_chunks * c, self.heads, self.head_size))
+        return o[:, :q_len]
+
+    def linear_attention(self, qw, kw, vw, v_mask=None, a_mask=None):
+        """线性attention：用正的特征映射elu(x)+1代替exp，按结合律先算
+        k与v的乘积，计算量与序列长度成线性关系。
+        a_mask只支持history_only（仅限self attention），此时序列分块计算：
+        块内直接算（下三角的）attention，块间用前面各块k与v乘积的前缀和，
+        显存为O(L * chunk_size + L / chunk_size * d^2)而不是O(L * d^2)；
+        块大小为chunk_size，未指定时为64。
+        """
+        if a_mask is not None and not is_string(a_mask):
+            raise ValueError('Linear attention only supports history_only.')
+        qw, kw = K.elu(qw) + 1, K.elu(kw) + 1
+        if v_mask is not None:
+            kw = kw * v_mask[:, :, None, None]
+        if a_mask is None:
+            kv = tf.einsum('bkhd,bkhe->bhde', kw, vw)
+            o = tf.einsum('bjhd,bhde->bjhe', qw, kv)
+            z = tf.einsum('bjhd,bhd->bjh', qw, K.sum(kw, 1))
+        else:
+            return self.causal_linear_attention(qw, kw, vw)
+        return o / (K.expand_dims(z, 3) + K.epsilon())
+
+    def causal_linear_attention(self, qw, kw, vw):
+        """分块计算的单向线性attention，qw、kw已经过特征映射
+        """
+        c = self.chunk_size or 64
+        seq_len = K.shape(qw)[1]
+        num_chunks = (seq_len + c - 1) // c
+
+        def to_chunks(x):
+            x = tf.pad(x, [[0, 0], [0, num_chunks * c - seq_len], [0, 0],
+                           [0, 0]])
+            return K.reshape(x, [-1, num_chunks, c] + list(K.int_shape(x)[2:]))
+
+        qw, kw, vw = to_chunks(qw), to_chunks(kw), to_chunks(vw)
+        # 块内：下三角的attention
+        a = tf.einsum('bnihd,bnjhd->bnhij', qw, kw)
+        a = a * tf.linalg.band_part(tf.ones((c, c)), -1, 0)
+        o = tf.einsum('bnhij,bnjhe->bnihe', a, vw)
+        z = tf.transpose(K.sum(a, 4), [0, 1, 3, 2])
+        # 块间：前面各块的k、v乘积之和（不含当前块）
+        kv = tf.einsum('bnjhd,bnjhe->bnhde', kw, vw)
+        kv = tf.cumsum(kv, 1, exclusive=True)
+        ks = tf.cumsum(K.sum(kw, 2), 1, exclusive=True)
+        o = o + tf.einsum('bnihd,bnhde->bnihe', qw, kv)
+        z = z + tf.einsum('bnihd,bnhd->bnih', qw, ks)
+        o = o / (K.expand_dims(z, 4) + K.epsilon())
+        o = K.reshape(o, [-1, num_chunks * c] + list(K.int_shape(o)[3:]))
+        return o[:, :seq_len]
+
+    def window_attention(self, qw, kw, vw, v_mask=None, a_mask=None):
+        """稀疏的局部attention（仅限self attention）
+        序列按window_size分块，每个块的query只跟前一块、当前块、后一块
+        的key计算（sliding模式下再限制距离不超过window_size），另外加上
+        全局位置，计算量与序列长度成线性关系。a_mask只支持history_only。
+        """
+        if a_mask is not None and not is_string(a_mask):
+            raise ValueError('Window attention only supports history_only.')
+        w, g = self.window_size, self.global_size
+        seq_len = K.shape(qw)[1]
+        if v_mask is None:
+            v_mask = K.ones_like(qw[:, :, 0, 0])
+        # padding到window_size的整数倍并分块
+        num_blocks = (seq_len + w - 1) // w
+
+        def padding(x):
+            paddings = [[0, 0], [0, num_blocks * w - seq_len]]
+            return tf.pad(x, paddings + [[0, 0]] * (K.ndim(x) - 2))
+
+        qw, kw, vw, v_mask = [padding(x) for x in [qw, kw, vw, v_mask]]
+
+        def to_blocks(x):
+            shape = [-1, num_blocks, w] + list(K.int_shape(x)[2:])
+            return K.reshape(x, shape)
+
+        def to_windows(x):
+            # 每个块拼上前后各一块，形状(batch_size, num_blocks, 3w, ...)
+            x = to_blocks(x)
+            paddings = [[0, 0], [1, 1]] + [[0, 0]] * (K.ndim(x) - 2)
+            x = tf.pad(x, paddings)
+            return K.concatenate([x[:, :-2], x[:, 1:-1], x[:, 2:]], 2)
+
+        qb, kb, vb = to_blocks(qw), to_windows(kw), to_windows(vw)
+        # 局部部分，q位置为n*w+i，k位置为(n-1)*w+j
+        a = tf.einsum('bnihd,bnjhd->bhnij', qb, kb) / self.key_size**0.5
+        mask = K.expand_dims(to_windows(v_mask), 2)  # (b, n, 1, 3w)
+        i_idxs = K.arange(0, w)[:, None]
+        j_idxs = K.arange(0, 3 * w)[None]
+        distance = j_idxs - w - i_idxs  # k位置 - q位置
+        if self.window_mode == 'sliding':
+            mask = mask * K.cast(K.abs(distance) <= w, K.floatx())
+        if a_mask is not None:
+            mask = mask * K.cast(distance <= 0, K.floatx())
+        if g > 0:  # 全局位置另外计算，这里去掉
+            k_idxs = (K.arange(0, num_blocks)[:, None] - 1) * w + j_idxs
+            mask = mask * K.cast(k_idxs >= g, K.floatx())[:, None]
+        a = a - (1 - K.expand_dims(mask, 1)) * 1e12
+        if g > 0:
+            # 每个位置看全局位置
+            a_g = tf.einsum('bnihd,bjhd->bhnij', qb, kw[:, :g])
+            a_g = a_g / self.key_size**0.5
+            mask = v_mask[:, None, None, None, :g]
+            if a_mask is not None:
+                q_idxs = K.arange(0, num_blocks)[:, None] * w + i_idxs[:, 0]
+                g_idxs = K.arange(0, g)
+                causal = K.cast(q_idxs[..., None] >= g_idxs, K.floatx())
+                mask = mask * causal[None, None]
+            a_g = a_g - (1 - mask) * 1e12
+            a = K.concatenate([a, a_g], 4)
+        a = K.softmax(a)
+        o = tf.einsum('bhnij,bnjhd->bnihd', a[..., :3 * w], vb)
+        if g > 0:
+            o = o + tf.einsum('bhnij,bjhd->bnihd', a[..., 3 * w:], vw[:, :g])
+        o = K.reshape(o, (-1, num_blocks * w, self.heads, self.head_size))
+        if g > 0:
+            # 全局位置看所有位置
+            a = tf.einsum('bihd,bjhd->bhij', qw[:, :g], kw)
+            a = a / self.key_size**0.5
+            a = sequence_masking(a, v_mask, 1, -1)
+            if a_mask is not None:
+                ones = K.ones_like(a[:1, :1])
+                a = a - (ones - tf.linalg.band_part(ones, -1, 0)) * 1e12
+            a = K.softmax(a)
+            o_g = tf.einsum('bhij,bjhd->bihd', a, vw)
+            o = K.concatenate([o_g, o[:, g:]], 1)
+        return o[:, :seq_len]
+
+    @staticmethod
+    def ids_mask(q_ids, k_ids):
+        """由attention mask id构建attention mask，形状为(batch_size, 1,
+        q_len, k_len)：位置j能看到位置k当且仅当k_ids[k] <= q_ids[j]。
+        如单向语言模型的id为位置id，seq2seq的id为segment_ids的累加
+        （source部分全为0，互相可见；target部分递增，只看之前的位置）。
+        """
+        q_ids = K.expand_dims(K.expand_dims(q_ids, 1), 3)
+        k_ids = K.expand_dims(K.expand_dims(k_ids, 1), 2)
+        return K.cast(K.less_equal(k_ids, q_ids), K.floatx())
+
+    def relative_scores(self, qw, r_ids):
+        """相对位置部分的attention得分
+        先跟所有(2 * max_relative_position + 1)个相对位置向量算内积，
+        再按r_ids取出，避免构建(q_len, k_len, head_size)的张量。
+        """
+        s = tf.einsum('bjhd,nd->jnbh', qw, self.relative_embeddings)
+        s = tf.gather(s, r_ids, axis=1, batch_dims=1)  # (j, k, b, h)
+        return K.permute_dimensions(s, (2, 3, 0, 1))
+
+    def relative_outputs(self, a, r_ids):
+        """相对位置部分的输出
+        先把attention权重按相对位置id累加，再乘以相对位置向量。
+        """
+        q_len, n = K.shape(r_ids)[0], 2 * self.max_relative_position + 1
+        a = K.permute_dimensions(a, (2, 3, 0, 1))  # (j, k, b, h)
+        segment_ids = r_ids + K.expand_dims(K.arange(0, q_len) * n, 1)
+        a = tf.math.unsorted_segment_sum(a, segment_ids, q_len * n)
+        a = K.reshape(a, (q_len, n, -1, self.heads))
+        return tf.einsum('jnbh,nd->bjhd', a, self.relative_embeddings)
+
+    def fused_dense(self, q, k, v):
+        """fused_qkv时的线性变换，输入相同的部分合并成一次矩阵乘法
+        """
+        kernel, bias = self.qkv_dense.kernel, self.qkv_dense.bias
+        splits = [0, self.key_size * self.heads, self.key_size * self.heads * 2]
+        splits.append(splits[2] + self.out_dim)
+
+        def dense(x, i, j):
+            # 只用kernel中第i到第j部分（对应q、k、v）
+            start, end = splits[i], splits[j]
+            if j - i == 3:
+                x = K.bias_add(K.dot(x, kernel), bias)
+            else:
+                w, b = kernel[:, start:end], bias[start:end]
+                x = K.bias_add(K.dot(x, w), b)
+            return [x[..., splits[n] - start:splits[n + 1] - start]
+                    for n in range(i, j)]
+
+        if q is k is v:
+            return dense(q, 0, 3)
+        elif k is v:
+            return dense(q, 0, 1) + dense(k, 1, 3)
+        else:
+            return dense(q, 0, 1) + dense(k, 1, 2) + dense(v, 2, 3)
+
     def compute_output_shape(self, input_shape):
-        return (input_shape[0][0], input_shape[0][1], self.out_dim)
+        return input_shape[0][:-1] + (self.out_dim, )
 
     def get_config(self):
         config = {
@@ -214,6 +646,12 @@ class MultiHeadAttention(Layer):
             'pool_size': self.pool_size,
             'kernel_initializer': initializers.serialize(self.kernel_initializer),
             'max_relative_position': self.max_relative_position,
+            'fused_qkv': self.fused_qkv,
+            'window_size': self.window_size,
+            'window_mode': self.window_mode,
+            'global_size': self.global_size,
+            'chunk_size': self.chunk_size,
+            'linear': self.linear,
         }
         base_config = super(MultiHeadAttention, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
@@ -267,17 +705,28 @@ class LayerNormalization(Layer):
                                      use_bias=False,
                                      kernel_initializer='zeros')
 
+    def compute_condition(self, cond):
+        """计算condition对beta、gamma的增量
+        condition在解码过程中不变时，可以预先算好，然后以
+        [inputs, beta增量, gamma增量]的形式输入，避免重复计算。
+        """
+        if self.hidden_units is not None:
+            cond = self.hidden_dense(cond)
+        return [self.beta_dense(cond), self.gamma_dense(cond)]
+
+    @recompute_grad
     def call(self, inputs):
         """如果是条件Layer Norm，则默认以list为输入，第二个是condition
         """
         if self.conditional:
-            inputs, cond = inputs
-            if self.hidden_units is not None:
-                cond = self.hidden_dense(cond)
-            for _ in range(K.ndim(inputs) - K.ndim(cond)):
-                cond = K.expand_dims(cond, 1)
-            beta = self.beta_dense(cond)
-            gamma = self.gamma_dense(cond)
+            if len(inputs) == 2:
+                inputs, cond = inputs
+                beta, gamma = self.compute_condition(cond)
+            else:
+                inputs, beta, gamma = inputs
+            for _ in range(K.ndim(inputs) - K.ndim(beta)):
+                beta = K.expand_dims(beta, 1)
+                gamma = K.expand_dims(gamma, 1)
             beta, gamma = self.beta + beta, self.gamma + gamma
         else:
             beta, gamma = self.beta, self.gamma
@@ -289,6 +738,12 @@ class LayerNormalization(Layer):
         outputs = outputs * gamma + beta
         return outputs
 
+    def compute_output_shape(self, input_shape):
+        if self.conditional:
+            return input_shape[0]
+        else:
+            return input_shape
+
     def get_config(self):
         config = {
             'conditional': self.conditional,
@@ -324,18 +779,28 @@ class PositionEmbedding(Layer):
         )
 
     def call(self, inputs):
-        input_shape = K.shape(inputs)
-        batch_size, seq_len = input_shape[0], input_shape[1]
-        pos_embeddings = self.embeddings[:seq_len]
-        pos_embeddings = K.expand_dims(pos_embeddings, 0)
+        """如果输入是list，则第二个是自定义的position_ids
+        """
+        if isinstance(inputs, list):
+            inputs, position_ids = inputs
+            position_ids = K.cast(position_ids, 'int32')
+            pos_embeddings = K.gather(self.embeddings, position_ids)
+        else:
+            input_shape = K.shape(inputs)
+            batch_size, seq_len = input_shape[0], input_shape[1]
+            pos_embeddings = self.embeddings[:seq_len]
+            pos_embeddings = K.expand_dims(pos_embeddings, 0)
+            if self.merge_mode != 'add':
+                pos_embeddings = K.tile(pos_embeddings, [batch_size, 1, 1])
 
         if self.merge_mode == 'add':
             return inputs + pos_embeddings
         else:
-            pos_embeddings = K.tile(pos_embeddings, [batch_size, 1, 1])
             return K.concatenate([inputs, pos_embeddings])
 
     def compute_output_shape(self, input_shape):
+        if isinstance(input_shape, list):
+            input_shape = input_shape[0]
         if self.merge_mode == 'add':
             return input_shape
         else:
@@ -446,6 +911,7 @@ class FeedForward(Layer):
                                       groups=self.groups,
                                       kernel_initializer=self.kernel_initializer)
 
+    @recompute_grad
     def call(self, inputs, mask=None):
         x = inputs
         # Pooling
@@ -516,13 +982,183 @@ class EmbeddingDense(Layer):
         return dict(list(base_config.items()) + list(config.items()))
 
 
+class AdaptiveSoftmax(Layer):
+    """自适应softmax（Adaptive Softmax），用于大词表时代替EmbeddingDense
+    token按token_order（一般按频数从高到低）排序后，按cutoffs分成头部
+    及若干尾部簇：头部预测高频token以及“属于哪个尾部簇”，尾部簇先降维
+    （第i个尾部簇的维度为输入维度除以div_value的i次方）再预测簇内token，
+    低频token的计算量大幅减少。头部token复用Embedding层的矩阵。
+    输出跟EmbeddingDense一致，为原token顺序下的概率（log_proba=True时为
+    概率对数）；训练时用compute_loss只算目标token所在的簇，生成时用
+    compute_topk跳过不可能进入topk的簇。
+    """
+    def __init__(self,
+                 vocab_size,
+                 cutoffs,
+                 embedding_name='Embedding-Token',
+                 token_order=None,
+                 div_value=4.,
+                 log_proba=False,
+                 kernel_initializer='glorot_uniform',
+                 **kwargs):
+        super(AdaptiveSoftmax, self).__init__(**kwargs)
+        self.vocab_size = vocab_size
+        self.cutoffs = list(cutoffs)
+        self.embedding_name = embedding_name
+        if token_order is None:
+            token_order = range(vocab_size)
+        self.token_order = [int(i) for i in token_order]
+        self.div_value = div_value
+        self.log_proba = log_proba
+        self.kernel_initializer = initializers.get(kernel_initializer)
+        self.boundaries = [0] + self.cutoffs + [vocab_size]
+        self.token_ranks = np.argsort(self.token_order).tolist()
+
+    def build(self, input_shape):
+        super(AdaptiveSoftmax, self).build(input_shape)
+        input_dim = input_shape[-1]
+        self.head_bias = self.add_weight(name='head_bias',
+                                         shape=(self.cutoffs[0], ),
+                                         initializer='zeros')
+        self.cluster_kernel = self.add_weight(
+            name='cluster_kernel',
+            shape=(input_dim, len(self.cutoffs)),
+            initializer=self.kernel_initializer)
+        self.cluster_bias = self.add_weight(name='cluster_bias',
+                                            shape=(len(self.cutoffs), ),
+                                            initializer='zeros')
+        self.tails = []
+        for i in range(len(self.cutoffs)):
+            size = self.boundaries[i + 2] - self.boundaries[i + 1]
+            tail_dim = max(1, int(input_dim // self.div_value**(i + 1)))
+            self.tails.append([
+                self.add_weight(name='tail_%d_projection' % i,
+                                shape=(input_dim, tail_dim),
+                                initializer=self.kernel_initializer),
+                self.add_weight(name='tail_%d_kernel' % i,
+                                shape=(tail_dim, size),
+                                initializer=self.kernel_initializer),
+                self.add_weight(name='tail_%d_bias' % i,
+                                shape=(size, ),
+                                initializer='zeros'),
+            ])
+
+    def head_log_proba(self, inputs):
+        """头部的概率对数，前cutoffs[0]个为高频token，其余为各尾部簇
+        """
+        if not hasattr(self, 'embeddings'):
+            embedding_layer = search_layer(inputs, self.embedding_name)
+            if embedding_layer is None:
+                raise Exception('Embedding layer not found')
+            self.embeddings = embedding_layer.embeddings
+        kernel = K.gather(self.embeddings, self.token_order[:self.cutoffs[0]])
+        token_logits = K.dot(inputs, K.transpose(kernel)) + self.head_bias
+        cluster_logits = K.dot(inputs, self.cluster_kernel) + self.cluster_bias
+        logits = K.concatenate([token_logits, cluster_logits])
+        return tf.nn.log_softmax(logits)
+
+    def tail_log_proba(self, inputs, i):
+        """第i个尾部簇内的条件概率对数
+        """
+        projection, kernel, bias = self.tails[i]
+        logits = K.dot(K.dot(inputs, projection), kernel) + bias
+        return tf.nn.log_softmax(logits)
+
+    def compute_log_proba(self, inputs):
+        """原token顺序下全部token的概率对数
+        """
+        head = self.head_log_proba(inputs)
+        c = self.cutoffs[0]
+        outputs = [head[..., :c]]
+        for i in range(len(self.cutoffs)):
+            tail = self.tail_log_proba(inputs, i)
+            outputs.append(tail + head[..., c + i:c + i + 1])
+        outputs = K.concatenate(outputs)  # 按token_order排列
+        return tf.gather(outputs, self.token_ranks, axis=-1)
+
+    def call(self, inputs):
+        outputs = self.compute_log_proba(inputs)
+        if self.log_proba:
+            return outputs
+        else:
+            return K.exp(outputs)
+
+    def compute_loss(self, inputs, y_true):
+        """交叉熵，inputs形状为(num_tokens, input_dim)，y_true为目标id
+        每个尾部簇只对属于它的token计算，返回形状为(num_tokens, )。
+        """
+        ranks = K.gather(self.token_ranks, K.cast(y_true, 'int32'))
+        clusters = tf.add_n(
+            [K.cast(K.greater_equal(ranks, c), 'int32') for c in self.cutoffs])
+        c = self.cutoffs[0]
+        head_ids = tf.where(K.greater(clusters, 0), c + clusters - 1, ranks)
+        head = self.head_log_proba(inputs)
+        loss = -batch_gather(head, K.expand_dims(head_ids, 1))[:, 0]
+        for i in range(len(self.cutoffs)):
+            idxs = tf.where(K.equal(clusters, i + 1))
+            tail_ids = tf.gather_nd(ranks, idxs) - self.boundaries[i + 1]
+            tail = self.tail_log_proba(tf.gather_nd(inputs, idxs), i)
+            tail_loss = -batch_gather(tail, K.expand_dims(tail_ids, 1))[:, 0]
+            shape = tf.shape(loss, out_type='int64')
+            loss = loss + tf.scatter_nd(idxs, tail_loss, shape)
+        return loss
+
+    def compute_topk(self, inputs, topk):
+        """概率对数最大的topk个token，返回[概率对数, token id]
+        inputs形状为(batch_size, input_dim)，topk不超过cutoffs[0]。
+        簇内token的概率不超过簇的概率，所以簇的概率不超过当前第topk
+        大的概率时，可以跳过该簇。
+        """
+        head = self.head_log_proba(inputs)
+        c = self.cutoffs[0]
+        scores, ids = tf.nn.top_k(head[:, :c], topk)
+        for i in range(len(self.cutoffs)):
+            cluster = head[:, c + i]
+
+            def update(scores=scores, ids=ids, i=i, cluster=cluster):
+                tail = self.tail_log_proba(inputs, i)
+                tail = tail + K.expand_dims(cluster, 1)
+                tail_ids = K.arange(self.boundaries[i + 1],
+                                    self.boundaries[i + 2])
+                tail_ids = K.tile(tail_ids[None], [K.shape(ids)[0], 1])
+                scores, idxs = tf.nn.top_k(K.concatenate([scores, tail]),
+                                           topk)
+                ids = batch_gather(K.concatenate([ids, tail_ids]), idxs)
+                return scores, ids
+
+            skip = lambda scores=scores, ids=ids: (scores, ids)
+            needed = K.any(K.greater(cluster, scores[:, -1]))
+            scores, ids = tf.cond(needed, update, skip)
+        return [scores, K.gather(self.token_order, ids)]
+
+    def compute_output_shape(self, input_shape):
+        return input_shape[:-1] + (self.vocab_size, )
+
+    def get_config(self):
+        config = {
+            'vocab_size': self.vocab_size,
+            'cutoffs': self.cutoffs,
+            'embedding_name': self.embedding_name,
+            'token_order': self.token_order,
+            'div_value': self.div_value,
+            'log_proba': self.log_proba,
+            'kernel_initializer': initializers.serialize(self.kernel_initializer),
+        }
+        base_config = super(AdaptiveSoftmax, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+
 class ConditionalRandomField(Layer):
     """纯Keras实现CRF层
     CRF层本质上是一个带训练参数的loss计算层。
+    推断时可以用Lambda(CRF.viterbi_decode)接在CRF层之后，图内批量解码。
+    parallel_scan=True时用矩阵两两连乘并行计算log Z（见crf_log_norm），
+    循环深度从O(seq_len)降为O(log seq_len)，适合长序列、标签数不多的情形。
     """
-    def __init__(self, lr_multiplier=1, **kwargs):
+    def __init__(self, lr_multiplier=1, parallel_scan=False, **kwargs):
         super(ConditionalRandomField, self).__init__(**kwargs)
         self.lr_multiplier = lr_multiplier  # 当前层学习率的放大倍数
+        self.parallel_scan = parallel_scan  # 是否并行计算log Z
 
     def build(self, input_shape):
         output_dim = input_shape[-1]
@@ -546,6 +1182,18 @@ class ConditionalRandomField(Layer):
                                 y_true[:, 1:])  # 标签转移得分
         return point_score + trans_score
 
+    def sparse_target_score(self, y_true, y_pred, mask=None):
+        """同target_score，但y_true是整数形式，直接gather得分，免去one hot
+        """
+        point_score = batch_gather(y_pred, K.expand_dims(y_true, 2))[:, :, 0]
+        labels = K.stack([y_true[:, :-1], y_true[:, 1:]], 2)
+        trans_score = tf.gather_nd(self.trans, labels)
+        if mask is not None:
+            mask = K.cast(mask, K.floatx())
+            point_score = point_score * mask
+            trans_score = trans_score * mask[:, :-1] * mask[:, 1:]
+        return K.sum(point_score, 1) + K.sum(trans_score, 1)
+
     def log_norm_step(self, inputs, states):
         """递归计算归一化因子
         要点：1、递归计算；2、用logsumexp避免溢出。
@@ -578,6 +1226,14 @@ class ConditionalRandomField(Layer):
         mask = self.output_mask
         # 计算目标分数
         target_score = self.target_score(y_true, y_pred, mask)
+        # 计算损失 -log p
+        return self.log_norm(y_pred, mask) - target_score
+
+    def log_norm(self, y_pred, mask=None):
+        """计算归一化因子log Z
+        """
+        if self.parallel_scan:
+            return crf_log_norm(y_pred, self.trans, mask)
         # 递归计算log Z
         init_states = [y_pred[:, 0]]
         if mask is None:
@@ -588,9 +1244,7 @@ class ConditionalRandomField(Layer):
         log_norm, _, _ = K.rnn(self.log_norm_step,
                                y_pred[:, 1:],
                                init_states)  # 最后一步的log Z向量
-        log_norm = tf.reduce_logsumexp(log_norm, 1)  # logsumexp得标量
-        # 计算损失 -log p
-        return log_norm - target_score
+        return tf.reduce_logsumexp(log_norm, 1)  # logsumexp得标量
 
     def sparse_loss(self, y_true, y_pred):
         """y_true需要是整数形式（非one hot）
@@ -598,9 +1252,11 @@ class ConditionalRandomField(Layer):
         # y_true需要重新明确一下dtype和shape
         y_true = K.cast(y_true, 'int32')
         y_true = K.reshape(y_true, [K.shape(y_true)[0], -1])
-        # 转为one hot
-        y_true = K.one_hot(y_true, K.shape(self.trans)[0])
-        return self.dense_loss(y_true, y_pred)
+        mask = self.output_mask
+        # 计算目标分数（直接gather，无需转为one hot）
+        target_score = self.sparse_target_score(y_true, y_pred, mask)
+        # 计算损失 -log p
+        return self.log_norm(y_pred, mask) - target_score
 
     def dense_accuracy(self, y_true, y_pred):
         """训练过程中显示逐帧准确率的函数，排除了mask的影响
@@ -625,9 +1281,18 @@ class ConditionalRandomField(Layer):
         else:
             return K.sum(isequal * mask) / K.sum(mask)
 
+    def viterbi_decode(self, y_pred, trans_mask=None, start_mask=None):
+        """图内批量Viterbi解码，返回最优标签序列（padding部分为0）
+        trans_mask、start_mask为可选的0/1约束（如禁止O到I的转移），
+        见backend.viterbi_decode。
+        """
+        return viterbi_decode(y_pred, self.trans, self.output_mask,
+                              trans_mask, start_mask)
+
     def get_config(self):
         config = {
             'lr_multiplier': self.lr_multiplier,
+            'parallel_scan': self.parallel_scan,
         }
         base_config = super(ConditionalRandomField, self).get_config()
         return dict(list(base_config.items()) + list(config.items()))
@@ -636,6 +1301,7 @@ class ConditionalRandomField(Layer):
 class MaximumEntropyMarkovModel(Layer):
     """（双向）最大熵隐马尔可夫模型
     作用和用法都类似CRF，但是比CRF更快更简单。
+    推断时同样可以用Lambda(MEMM.viterbi_decode)图内批量解码。
     """
     def __init__(self, lr_multiplier=1, hidden_dim=None, **kwargs):
         super(MaximumEntropyMarkovModel, self).__init__(**kwargs)
@@ -789,6 +1455,23 @@ class MaximumEntropyMarkovModel(Layer):
         y_true = K.argmax(y_true, 2)
         return self.sparse_accuracy(y_true, y_pred)
 
+    def viterbi_decode(self, y_pred, trans_mask=None, start_mask=None):
+        """图内批量Viterbi解码，返回最优标签序列（padding部分为0）
+        按（前向）MEMM的概率求最优路径：第t步的转移得分为
+        log_softmax((y_pred[t] + trans[y_{t-1}]) / 2)，跟basic_loss一致。
+        """
+        if self.hidden_dim is None:
+            trans = self.trans
+        else:
+            trans = K.dot(self.l_trans, K.transpose(self.r_trans))
+        trans = K.expand_dims(K.expand_dims(trans, 0), 0)
+        trans = tf.nn.log_softmax((trans + K.expand_dims(y_pred, 2)) / 2)
+        nodes = K.concatenate(
+            [tf.nn.log_softmax(y_pred[:, :1]),
+             K.zeros_like(y_pred[:, 1:])], 1)
+        return viterbi_decode(nodes, trans, self.output_mask, trans_mask,
+                              start_mask)
+
     def get_config(self):
         config = {
             'lr_multiplier': self.lr_multiplier,
@@ -806,6 +1489,7 @@ custom_objects = {
     'GroupDense': GroupDense,
     'FeedForward': FeedForward,
     'EmbeddingDense': EmbeddingDense,
+    'AdaptiveSoftmax': AdaptiveSoftmax,
     'ConditionalRandomField': ConditionalRandomField,
     'MaximumEntropyMarkovModel': MaximumEntropyMarkovModel,
 }
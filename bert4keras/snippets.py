@@ -2,10 +2,13 @@
 # 代码合集
 
 import six
+import os
 import logging
 import numpy as np
 import re
 import sys
+import time
+from collections import OrderedDict
 
 
 _open_ = open
@@ -219,6 +222,69 @@ def sequence_padding(inputs, length=None, padding=0):
     return outputs
 
 
+def viterbi_decode(nodes, trans, mask=None, trans_mask=None, start_mask=None):
+    """Numpy函数，批量的Viterbi解码，返回最优路径，形状为(batch_size, seq_len)
+    参数同backend.viterbi_decode（图内版本）：nodes为逐标签得分，形状为
+    (batch_size, seq_len, num_labels)；trans为(num_labels, num_labels)的
+    转移得分（或逐步的(batch_size, seq_len, num_labels, num_labels)）；
+    mask为0/1矩阵，padding部分输出0；trans_mask、start_mask为0/1约束。
+    只在时间方向循环，batch与标签方向都是向量化的。
+    """
+    nodes = np.array(nodes, dtype='float64')
+    trans = np.asarray(trans, dtype='float64')
+    batch_size, seq_len, num_labels = nodes.shape
+    if mask is None:
+        mask = np.ones((batch_size, seq_len))
+    mask = np.asarray(mask) > 0
+    if trans_mask is not None:
+        trans = np.where(np.asarray(trans_mask) > 0, trans, -np.inf)
+    if start_mask is not None:
+        nodes[:, 0] = np.where(np.asarray(start_mask) > 0, nodes[:, 0], -np.inf)
+
+    labels = np.arange(num_labels)
+    scores = nodes[:, 0]
+    paths = np.empty((batch_size, seq_len, num_labels), dtype='int32')
+    paths[:, 0] = labels
+    for t in range(1, seq_len):
+        trans_t = trans if trans.ndim == 2 else trans[:, t]
+        outputs = scores[:, :, None] + trans_t + nodes[:, t, None]
+        idxs = outputs.argmax(1)
+        m = mask[:, t, None]
+        scores = np.where(m, outputs.max(1), scores)
+        paths[:, t] = np.where(m, idxs, labels)
+
+    outputs = np.empty((batch_size, seq_len), dtype='int32')
+    outputs[:, -1] = scores.argmax(1)
+    batch_idxs = np.arange(batch_size)
+    for t in range(seq_len - 1, 0, -1):
+        outputs[:, t - 1] = paths[batch_idxs, t, outputs[:, t]]
+    return outputs * mask
+
+
+def extract_spans(start_probs, end_probs, start_threshold=0.5,
+                  end_threshold=0.5):
+    """Numpy函数，批量的指针网络（start/end）解码，返回所有片段
+    start_probs、end_probs形状为(batch_size, seq_len, num_classes)，
+    或者(batch_size, seq_len)（视为只有一个类）；概率大于阈值即为候选。
+    每个start与其后（含自身）最近的、同batch同类的end配对（就近原则）。
+    返回形状为(num_spans, 4)的整数矩阵，每行为(batch, start, end, class)。
+    先用反向累积最小值求出每个位置之后最近的end，全程没有Python循环。
+    """
+    start_probs, end_probs = np.asarray(start_probs), np.asarray(end_probs)
+    if start_probs.ndim == 2:
+        start_probs = start_probs[:, :, None]
+        end_probs = end_probs[:, :, None]
+    seq_len = start_probs.shape[1]
+    # next_end[b, i, c]为i及之后第一个end的位置，不存在则为seq_len
+    positions = np.arange(seq_len)[None, :, None]
+    next_end = np.where(end_probs > end_threshold, positions, seq_len)
+    next_end = np.minimum.accumulate(next_end[:, ::-1], axis=1)[:, ::-1]
+    batch_idxs, starts, classes = np.where(start_probs > start_threshold)
+    ends = next_end[batch_idxs, starts, classes]
+    spans = np.stack([batch_idxs, starts, ends, classes], 1)
+    return spans[ends < seq_len]
+
+
 def is_one_of(x, ys):
     """判断x是否在ys之中
     等价于x in ys，但有些情况下x in ys会报错
@@ -251,6 +317,157 @@ class DataGenerator(object):
                 yield d
 
 
+class SequencePacker(object):
+    """把多个短样本首尾相接拼成一条序列（sequence packing）
+    配合application='packing'的模型使用，减少短文本任务中padding的浪费。
+    用法：packs = packer.pack(lengths)得到每条序列包含哪些样本，然后
+    packer.concatenate(packs, batch_token_ids, batch_segment_ids)得到
+    拼接并padding后的token_ids、segment_ids以及example_ids，样本级的
+    标签用packer.gather(packs, batch_labels)按同样的顺序排好。
+    """
+    def __init__(self, maxlen, max_examples=None):
+        self.maxlen = maxlen
+        self.max_examples = max_examples
+
+    def pack(self, lengths):
+        """First Fit Decreasing装箱：从长到短依次放进第一个放得下的序列
+        返回每条序列包含的样本下标（list的list）
+        """
+        packs, totals = [], []
+        for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+            for j, total in enumerate(totals):
+                if total + lengths[i] <= self.maxlen and (
+                        self.max_examples is None or
+                        len(packs[j]) < self.max_examples):
+                    packs[j].append(i)
+                    totals[j] += lengths[i]
+                    break
+            else:
+                packs.append([i])
+                totals.append(lengths[i])
+        return packs
+
+    def concatenate(self, packs, *sequences):
+        """按packs拼接各个序列（如token_ids、segment_ids）并padding，
+        最后附加上example_ids（从1开始，0为padding）
+        """
+        outputs = [[] for _ in range(len(sequences) + 1)]
+        for p in packs:
+            for k, seqs in enumerate(sequences):
+                outputs[k].append(np.concatenate([seqs[i] for i in p]))
+            example_ids = [[n + 1] * len(sequences[0][i])
+                           for n, i in enumerate(p)]
+            outputs[-1].append(np.concatenate(example_ids))
+        return [sequence_padding(x) for x in outputs]
+
+    def gather(self, packs, values, padding=0):
+        """把样本级的值（如标签）按packs排好，形状为(序列数, 样本数, ...)
+        """
+        max_examples = max([len(p) for p in packs])
+        outputs = []
+        for p in packs:
+            x = [values[i] for i in p]
+            x += [np.full_like(values[0], padding)] * (max_examples - len(p))
+            outputs.append(x)
+        return np.array(outputs)
+
+
+class SubstringConstraint(object):
+    """子串约束：解码结果必须是给定序列（如篇章）之一的连续片段
+    预先把所有长度不超过maxlen的子串建成trie，每个解码假设对应trie
+    的一个节点（状态，-1表示已不可能再延续）；对一个batch的状态，
+    advance与mask都是向量化完成的，不需要逐个候选循环。
+    参数：
+        sequences: token id序列组成的list；
+        vocab_size: 词表大小；
+        maxlen: 子串最大长度，None表示不限制；
+        extra_ids: 任何时候都允许的token（如结束标记）；
+        separate: 为True时每个序列单独一棵trie（根节点见self.roots），
+                  否则所有序列共用一个根节点（即子串的并集）。
+    说明：sequences为空时只有一个没有子节点的根节点，即除extra_ids外
+         没有可选的token。
+    """
+    def __init__(self,
+                 sequences,
+                 vocab_size,
+                 maxlen=None,
+                 extra_ids=None,
+                 separate=False):
+        self.vocab_size = vocab_size
+        self.extra_ids = list(extra_ids or [])
+        self.separate = separate
+        children, roots = [], []
+        for i, seq in enumerate(sequences):
+            if separate or i == 0:
+                roots.append(len(children))
+                children.append({})
+            for j in range(len(seq)):
+                node = roots[-1]
+                for t in seq[j:j + maxlen if maxlen else None]:
+                    if t not in children[node]:
+                        children[node][t] = len(children)
+                        children.append({})
+                    node = children[node][t]
+        if not children:  # 空trie也保留一个根节点
+            roots.append(0)
+            children.append({})
+        parents = [i for i, c in enumerate(children) for _ in c]
+        tokens = [t for c in children for t in c]
+        nexts = [n for c in children for n in c.values()]
+        keys = np.array(parents, dtype='int64') * vocab_size
+        keys += np.array(tokens, dtype='int64')
+        order = keys.argsort()
+        self.keys = keys[order]
+        self.tokens = np.array(tokens, dtype='int64')[order]
+        self.nexts = np.array(nexts, dtype='int64')[order]
+        self.indptr = np.searchsorted(
+            self.keys,
+            np.arange(len(children) + 1, dtype='int64') * vocab_size)
+        self.roots = np.array(roots)
+
+    def initial_states(self, n, roots=None):
+        """n个新假设的初始状态
+        roots为每个假设所用的trie（即self.roots的下标，整数或长度为n
+        的数组）；separate=False时只有一个根节点，可以省略，separate=True
+        时必须指定。
+        """
+        if roots is None:
+            if self.separate and len(self.roots) > 1:
+                raise ValueError(
+                    'roots must be given when separate=True, '
+                    'since each sequence has its own root.'
+                )
+            roots = 0
+        return self.roots[np.broadcast_to(roots, (n,))]
+
+    def advance(self, states, token_ids):
+        """所有假设各自接上一个token后的新状态
+        """
+        states, token_ids = np.asarray(states), np.asarray(token_ids)
+        if len(self.keys) == 0:
+            return -np.ones_like(states)
+        keys = states * self.vocab_size + token_ids
+        idxs = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = (self.keys[idxs] == keys) & (states >= 0)
+        return np.where(found, self.nexts[idxs], -1)
+
+    def mask(self, states):
+        """返回形如(batch_size, vocab_size)的bool矩阵，表示下一个可选token
+        """
+        states = np.asarray(states)
+        starts = np.where(states >= 0, self.indptr[states], 0)
+        ends = np.where(states >= 0, self.indptr[states + 1], 0)
+        counts = ends - starts
+        rows = np.repeat(np.arange(len(states)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(counts.cumsum() - counts,
+                                                      counts)
+        cols = self.tokens[np.repeat(starts, counts) + offsets]
+        mask = np.zeros((len(states), self.vocab_size), dtype=bool)
+        mask[rows, cols] = True
+        mask[:, self.extra_ids] = True
+        return mask
+
+
 class AutoRegressiveDecoder(object):
     """通用自回归生成模型解码基类
     包含beam search和random sample两种策略
@@ -269,33 +486,196 @@ class AutoRegressiveDecoder(object):
         rtype为字符串logits或probas，用户定义的时候，应当根据rtype来
         返回不同的结果，rtype=probas时返回归一化的概率，rtype=logits时
         则返回softmax前的结果或者概率对数。
+        也可以只返回每一行得分最高的若干个token，即返回tuple
+        (得分, token_ids)，两者形状均为(batch_size, k)，k不小于topk
+        （如BertModel.build_generation_model的topk输出）。
         """
         raise NotImplementedError
 
-    def beam_search(self, inputs, topk):
+    def padded_predict(self,
+                       inputs,
+                       output_ids,
+                       lengths,
+                       steps,
+                       rtype='logits'):
+        """batch_predict合并多个请求后调用的预测函数
+        inputs中的序列（二维输入）以及output_ids都已逐行右padding（补0）
+        到相同长度，lengths为对应的真实长度（顺序同inputs + [output_ids]，
+        形状为(batch_size,)；非序列的输入没有padding，对应None），steps
+        为各行所属请求的step；返回各行在自身最后一个真实位置的结果，
+        形式同predict。
+        模型能处理padding时（如bert的Sequence-Mask），应重写该函数，
+        借助concatenate_padded、gather_last用一次预测算完；默认实现只是
+        按真实长度及step分组，去掉padding后分别调用predict。
+        """
+        padded = [i for i, l in enumerate(lengths) if l is not None]
+        groups = {}
+        for i, key in enumerate(zip(steps, *[lengths[j] for j in padded])):
+            groups.setdefault(key, []).append(i)
+        results = [None] * len(output_ids)
+        for key, idxs in groups.items():
+            step, key = key[0], dict(zip(padded, key[1:]))
+            x = [
+                x[idxs, :key[j]] if j in key else x[idxs]
+                for j, x in enumerate(inputs)
+            ]
+            o_len = key[len(inputs)]
+            scores = self.predict(x, output_ids[idxs, :o_len], step, rtype)
+            for j, i in enumerate(idxs):
+                if isinstance(scores, tuple):
+                    results[i] = [x[j] for x in scores]
+                else:
+                    results[i] = [scores[j]]
+        results = tuple([np.array(r) for r in zip(*results)])
+        if len(results) == 1:
+            return results[0]
+        return results
+
+    @staticmethod
+    def concatenate_padded(inputs, lengths, padding=0):
+        """将逐行右padding的若干序列按行拼接，每行只拼接真实部分，
+        然后再右padding（补padding）到相同长度；返回拼接结果及各行的
+        真实长度。用于padded_predict中拼接source与output_ids。
+        """
+        total = np.sum(lengths, 0)
+        outputs = np.full((len(total), max(total.max(), 1)), padding,
+                          dtype=np.result_type(*inputs))
+        offsets = np.zeros_like(total)
+        for x, l in zip(inputs, lengths):
+            cols = np.arange(x.shape[1])
+            rows, cols = np.nonzero(cols[None] < l[:, None])
+            outputs[rows, offsets[rows] + cols] = x[rows, cols]
+            offsets = offsets + l
+        return outputs, total
+
+    @staticmethod
+    def gather_last(outputs, lengths):
+        """取出每一行最后一个真实位置（lengths - 1）的结果
+        """
+        return outputs[np.arange(len(lengths)), np.asarray(lengths) - 1]
+
+    def batch_predict(self, requests):
+        """批量执行多个解码请求的预测
+        requests为(inputs, output_ids, step, rtype)组成的list，rtype相同
+        的请求（不管step以及序列长度是否相同）合并成一个batch：inputs的
+        各个序列以及output_ids逐行右padding到相同长度后，只调用一次
+        padded_predict；返回与requests对应的结果。
+        """
+        groups = {}
+        for i, (inputs, output_ids, step, rtype) in enumerate(requests):
+            if any([len(x) != len(output_ids) for x in inputs]):
+                key = i  # 输入与输出行数不对齐的，无法合并
+            else:
+                # 二维的输入视为序列，可以padding，其余的需要形状相同
+                key = (rtype, len(inputs))
+                key += tuple([
+                    np.shape(x)[1:] if np.ndim(x) > 2 else np.ndim(x)
+                    for x in inputs
+                ])
+            groups.setdefault(key, []).append(i)
+        results = [None] * len(requests)
+        for idxs in groups.values():
+            rtype = requests[idxs[0]][3]
+            if len(idxs) == 1:
+                inputs, output_ids, step = requests[idxs[0]][:3]
+                results[idxs[0]] = self.predict(inputs, output_ids, step, rtype)
+                continue
+            arrays = [list(requests[i][0]) + [requests[i][1]] for i in idxs]
+            inputs, lengths = [], []
+            for x in zip(*arrays):
+                x = [np.asarray(i) for i in x]
+                if x[0].ndim == 2:
+                    l = np.concatenate([[i.shape[1]] * len(i) for i in x])
+                    x = [
+                        np.pad(i, [(0, 0), (0, max(l) - i.shape[1])],
+                               'constant') for i in x
+                    ]
+                else:
+                    l = None  # 非序列输入不需要padding
+                inputs.append(np.concatenate(x))
+                lengths.append(l)
+            output_ids = inputs.pop()
+            steps = np.concatenate(
+                [[requests[i][2]] * len(requests[i][1]) for i in idxs])
+            scores = self.padded_predict(inputs, output_ids, lengths, steps,
+                                         rtype)
+            sizes = np.cumsum([len(requests[i][1]) for i in idxs])[:-1]
+            if isinstance(scores, tuple):
+                splits = zip(*[np.split(x, sizes) for x in scores])
+            else:
+                splits = np.split(scores, sizes)
+            for i, s in zip(idxs, splits):
+                results[i] = s
+        return results
+
+    def decode(self, decoding):
+        """用predict驱动解码生成器直至结束，返回解码结果
+        """
+        done, value = next(decoding)
+        while not done:
+            done, value = decoding.send(self.predict(*value))
+        return value
+
+    def split_scores(self, scores):
+        """将predict的返回值统一为(得分, token_ids)，
+        返回完整词表的得分时token_ids为None
+        """
+        if isinstance(scores, tuple):
+            return scores
+        return scores, None
+
+    def gather_ids(self, scores, token_ids):
+        """从完整词表的得分中取出token_ids对应的部分
+        """
+        if token_ids is None:
+            return scores
+        return np.take_along_axis(scores, token_ids, axis=1)
+
+    def beam_search(self, inputs, topk, constraint=None):
         """beam search解码
-        说明：这里的topk即beam size；
+        说明：这里的topk即beam size；constraint为可选的解码约束
+             （如SubstringConstraint），不满足约束的token得分置为-inf；
         返回：最优解码序列。
         """
+        return self.decode(self.beam_search_steps(inputs, topk, constraint))
+
+    def beam_search_steps(self, inputs, topk, constraint=None, candidates=None):
+        """beam search的逐步版本（生成器）
+        每一步yield出(False, (inputs, output_ids, step, 'logits'))，
+        并通过send接收对应的得分；结束时yield出(True, 最优解码序列)。
+        candidates非None时（应为list），每一步后会被更新为当前所有
+        可能成为最终结果的序列（未完成的beam以及缓存的准输出）。
+        """
         inputs = [np.array([i]) for i in inputs]
         output_ids, output_scores = self.first_output_ids, np.zeros(1)
         quasi_output, quasi_score = [], -np.inf
+        if constraint is not None:
+            states = constraint.initial_states(1)
         for step in range(self.maxlen):
-            scores = self.predict(inputs, output_ids, step, 'logits')  # 计算当前得分
+            scores = yield False, (inputs, output_ids, step, 'logits')  # 计算当前得分
+            scores, token_ids = self.split_scores(scores)
             if step == 0:  # 第1步预测后将输入重复topk次
                 inputs = [np.repeat(i, topk, axis=0) for i in inputs]
+            if constraint is not None:  # 去掉不满足约束的token
+                mask = self.gather_ids(constraint.mask(states), token_ids)
+                scores = np.where(mask, scores, -np.inf)
             scores = output_scores.reshape((-1, 1)) + scores  # 综合累积得分
             indices = scores.argpartition(-topk, axis=None)[-topk:]  # 仅保留topk
             indices_1 = indices // scores.shape[1]  # 行索引
             indices_2 = (indices % scores.shape[1]).reshape((-1, 1))  # 列索引
+            if token_ids is not None:  # 列索引转为token id
+                indices_2 = token_ids[indices_1, indices_2[:, 0]].reshape((-1, 1))
             output_ids = np.concatenate([output_ids[indices_1], indices_2], 1)  # 更新输出
+            if constraint is not None:  # 更新约束状态
+                states = constraint.advance(states[indices_1], indices_2[:, 0])
             output_scores = np.take_along_axis(scores, indices, axis=None)  # 更新得分
             best_one = output_scores.argmax()  # 取最优
             if indices_2[best_one, 0] == self.end_id:  # 判断是否可以输出
                 if output_scores[best_one] >= quasi_score:  # 跟缓存比较
-                    return output_ids[best_one]  # 返回当前最优
+                    yield True, output_ids[best_one]  # 返回当前最优
                 else:
-                    return quasi_output  # 返回缓存的准输出
+                    yield True, quasi_output  # 返回缓存的准输出
+                return
             else:
                 flag = (indices_2[:, 0] == self.end_id)  # 标记已完成序列
                 if flag.any():
@@ -306,24 +686,53 @@ class AutoRegressiveDecoder(object):
                     inputs = [i[flag] for i in inputs]  # 只保留未完成部分输入
                     output_ids = output_ids[flag]  # 只保留未完成部分候选集
                     output_scores = output_scores[flag]  # 只保留未完成部分候选得分
+                    if constraint is not None:
+                        states = states[flag]  # 只保留未完成部分约束状态
                     topk = flag.sum()  # 更新topk的值
+            if candidates is not None:
+                candidates[:] = list(output_ids)
+                if len(quasi_output) > 0:
+                    candidates.append(quasi_output)
         # 达到长度直接输出
-        return output_ids[output_scores.argmax()]
+        yield True, output_ids[output_scores.argmax()]
 
-    def random_sample(self, inputs, n, topk=None):
+    def random_sample(self, inputs, n, topk=None, constraint=None):
         """随机采样n个结果
         说明：非None的topk表示每一步只从概率最高的topk个中采样；
+             constraint为可选的解码约束，不满足约束的token概率置零；
         返回：n个解码序列组成的list。
         """
+        return self.decode(self.random_sample_steps(inputs, n, topk, constraint))
+
+    def random_sample_steps(self,
+                            inputs,
+                            n,
+                            topk=None,
+                            constraint=None,
+                            candidates=None):
+        """随机采样的逐步版本（生成器）
+        每一步yield出(False, (inputs, output_ids, step, 'probas'))，
+        并通过send接收对应的概率；结束时yield出(True, 解码序列list)。
+        candidates非None时（应为list），每一步后会被更新为当前所有
+        已完成与未完成的序列。
+        """
         inputs = [np.array([i]) for i in inputs]
         output_ids = self.first_output_ids
         results = []
+        if constraint is not None:
+            states = constraint.initial_states(n)
         for step in range(self.maxlen):
-            probas = self.predict(inputs, output_ids, step, 'probas')  # 计算当前概率
+            probas = yield False, (inputs, output_ids, step, 'probas')  # 计算当前概率
+            probas, token_ids = self.split_scores(probas)
             if step == 0:  # 第1步预测后将结果重复n次
                 probas = np.repeat(probas, n, axis=0)
                 inputs = [np.repeat(i, n, axis=0) for i in inputs]
                 output_ids = np.repeat(output_ids, n, axis=0)
+                if token_ids is not None:
+                    token_ids = np.repeat(token_ids, n, axis=0)
+            if constraint is not None:  # 去掉不满足约束的token
+                probas = probas * self.gather_ids(constraint.mask(states),
+                                                  token_ids)
             if topk is not None:
                 indices = probas.argpartition(-topk, axis=1)[:, -topk:]  # 仅保留topk
                 probas = np.take_along_axis(probas, indices, axis=1)  # topk概率
@@ -333,20 +742,611 @@ class AutoRegressiveDecoder(object):
             sample_ids = sample_ids.reshape((-1, 1))  # 对齐形状
             if topk is not None:
                 sample_ids = np.take_along_axis(indices, sample_ids, axis=1)  # 对齐原id
+            if token_ids is not None:
+                sample_ids = np.take_along_axis(token_ids, sample_ids, axis=1)
             output_ids = np.concatenate([output_ids, sample_ids], 1)  # 更新输出
+            if constraint is not None:  # 更新约束状态
+                states = constraint.advance(states, sample_ids[:, 0])
             flag = (sample_ids[:, 0] == self.end_id)  # 标记已完成序列
             for ids in output_ids[flag]:  # 存好已完成序列
                 results.append(ids)
             flag = (flag == False)  # 标记未完成序列
             inputs = [i[flag] for i in inputs]  # 只保留未完成部分输入
             output_ids = output_ids[flag]  # 只保留未完成部分候选集
+            if constraint is not None:
+                states = states[flag]  # 只保留未完成部分约束状态
+            if candidates is not None:
+                candidates[:] = results + list(output_ids)
             if len(output_ids) == 0:
                 break
         # 如果还有未完成序列，直接放入结果
         for ids in output_ids:
             results.append(ids)
         # 返回结果
-        return results
+        yield True, results
+
+    def stable_text(self, detokenize, ids, final=False):
+        """ids对应的文本中已经稳定（之后的token不会再改变）的部分
+        去掉最后一个token改动过的部分（如wordpiece的##合并、词间空格）
+        以及末尾不完整的字符（多个token拼成一个字时会先解码成\ufffd）；
+        final=True时返回完整文本。
+        """
+        text = detokenize(ids)
+        if not final:
+            if len(ids) > 0:
+                text = os.path.commonprefix([text, detokenize(ids[:-1])])
+            text = text.rstrip(u'\ufffd')
+        return text
+
+    def stream(self, decoding, candidates, detokenize=None):
+        """流式地驱动解码生成器（生成器）
+        每当candidates的公共前缀变长时（即这部分已不会再改变），马上
+        yield出(step, 新确定的token ids, offset, 新增的文本)，最后yield出
+        最终结果的剩余部分。detokenize为ids转文本的函数（如
+        tokenizer.decode），为None时offset与文本部分均为None。
+        文本只输出已经稳定的部分（见stable_text），所以一般offset就是
+        已输出文本的长度；万一已输出的文本被改写，offset会指出改写的
+        起点，使用方按text = text[:offset] + new_text更新即可。
+        停止迭代或调用close即取消解码，之后不会再调用predict。
+        """
+        step, fixed_ids, text = 0, [], u''
+        try:
+            done, value = next(decoding)
+            while True:
+                if done:
+                    ids = value
+                elif candidates:
+                    length = min([len(c) for c in candidates])
+                    c = np.array([c[:length] for c in candidates])
+                    same = (c == c[:1]).all(0)
+                    ids = c[0, :length if same.all() else same.argmin()]
+                else:
+                    ids = fixed_ids
+                if len(ids) > len(fixed_ids) or done:
+                    new_ids, fixed_ids = ids[len(fixed_ids):], ids
+                    if detokenize is None:
+                        if len(new_ids) > 0:
+                            yield step, new_ids, None, None
+                    else:
+                        new_text = self.stable_text(detokenize, fixed_ids,
+                                                    done)
+                        offset = len(os.path.commonprefix([text, new_text]))
+                        if len(new_ids) > 0 or new_text != text:
+                            yield step, new_ids, offset, new_text[offset:]
+                        text = new_text
+                if done:
+                    break
+                done, value = decoding.send(self.predict(*value))
+                step += 1
+        finally:
+            decoding.close()
+
+    def beam_search_stream(self,
+                           inputs,
+                           topk,
+                           constraint=None,
+                           detokenize=None):
+        """beam search的流式版本（生成器）
+        所有可能的结果的公共前缀一旦变长就输出，参数及输出格式见stream。
+        """
+        candidates = []
+        decoding = self.beam_search_steps(inputs, topk, constraint, candidates)
+        return self.stream(decoding, candidates, detokenize)
+
+    def random_sample_stream(self,
+                             inputs,
+                             topk=None,
+                             constraint=None,
+                             detokenize=None):
+        """随机采样一个结果的流式版本（生成器）
+        每采样一个token就输出，参数及输出格式见stream。
+        """
+        candidates = []
+
+        def decoding():
+            steps = self.random_sample_steps(inputs, 1, topk, constraint,
+                                             candidates)
+            try:
+                done, value = next(steps)
+                while not done:
+                    done, value = steps.send((yield done, value))
+                yield True, value[0]
+            finally:
+                steps.close()
+
+        return self.stream(decoding(), candidates, detokenize)
+
+    def predict_window(self, inputs, output_ids, window):
+        """计算output_ids最后window个位置各自的下一个token的概率
+        返回形状为(batch_size, window, vocab_size)，其中第j个结果是
+        以output_ids[:, :len - window + 1 + j]为已生成部分的预测。
+        默认逐个调用predict来实现，一般应重写为一次前向计算，比如
+        model.predict([token_ids, segment_ids])[:, -window:]。
+        """
+        length = output_ids.shape[1]
+        start = self.first_output_ids.shape[1]
+        probas = [
+            self.predict(inputs, output_ids[:, :l], l - start, 'probas')
+            for l in range(length - window + 1, length + 1)
+        ]
+        return np.stack(probas, 1)
+
+    def speculative_sample(self, inputs, draft, k=4, topk=None):
+        """投机采样（speculative sampling）
+        由廉价的draft（另一个AutoRegressiveDecoder，如层数更少的同类
+        模型）逐个提出k个token，当前模型通过predict_window一次前向
+        验证全部k个token，再经接受/拒绝采样，保证结果严格服从当前模型
+        （含topk截断后）的分布，跟random_sample(inputs, 1, topk)等价。
+        返回：一个解码序列；统计信息记录在self.speculative_stats中。
+        """
+        def truncate(probas):
+            if topk is not None:
+                probas = probas.copy()
+                probas[probas.argsort()[:-topk]] = 0  # 仅保留topk
+            return probas / probas.sum()  # 重新归一化
+
+        inputs = [np.array([i]) for i in inputs]
+        output_ids = self.first_output_ids
+        start = output_ids.shape[1]
+        stats = {'target_calls': 0, 'draft_tokens': 0, 'accepted_tokens': 0}
+        while output_ids.shape[1] - start < self.maxlen:
+            # draft逐个提出若干个token，遇到end_id停止
+            draft_ids, draft_probas = output_ids, []
+            for i in range(min(k, self.maxlen - draft_ids.shape[1] + start - 1)):
+                step = draft_ids.shape[1] - start
+                q = truncate(draft.predict(inputs, draft_ids, step, 'probas')[0])
+                sample_id = np.random.choice(len(q), p=q)
+                draft_ids = np.concatenate([draft_ids, [[sample_id]]], 1)
+                draft_probas.append(q)
+                if sample_id == self.end_id:
+                    break
+            proposal = draft_ids[0, output_ids.shape[1]:]
+            # 当前模型一次性验证
+            probas = self.predict_window(inputs, draft_ids, len(proposal) + 1)
+            probas = [truncate(p) for p in probas[0]]
+            new_ids = []
+            for p, q, sample_id in zip(probas, draft_probas, proposal):
+                if np.random.rand() < p[sample_id] / q[sample_id]:  # 接受
+                    new_ids.append(sample_id)
+                else:  # 拒绝，从残差分布中重新采样
+                    p = np.maximum(p - q, 0)
+                    new_ids.append(np.random.choice(len(p), p=p / p.sum()))
+                    break
+            else:  # 全部接受，额外从最后一个位置采样
+                new_ids.append(np.random.choice(len(probas[-1]), p=probas[-1]))
+            stats['target_calls'] += 1
+            stats['draft_tokens'] += len(proposal)
+            stats['accepted_tokens'] += len(new_ids) - 1
+            if self.end_id in new_ids:  # 截断到end_id为止
+                new_ids = new_ids[:new_ids.index(self.end_id) + 1]
+            output_ids = np.concatenate([output_ids, [new_ids]], 1)
+            if new_ids[-1] == self.end_id:
+                break
+        self.speculative_stats = stats
+        return output_ids[0]
+
+
+class PrefixCache(object):
+    """共享前缀的增量预测
+    对同一batch中前缀相同的行（如各beam共有的source以及已生成的
+    公共部分），前缀只用batch_size=1计算一次，然后通过step模型的
+    缓存接口广播给各行，各行只需计算剩余部分；完全相同的行只计算
+    一次。已算好的前缀保留到下一次调用，供更长的前缀继续复用。
+    参数：
+        step_model: 由BertModel.build_step_model构建的模型；
+        application: lm或seq2seq，seq2seq时前缀需包含全部source，
+                     因为source部分是双向Attention；
+        max_memory: 缓存状态占用的字节数上限。为None时只保留本次
+                    调用用到的前缀；否则跨请求保留（如重复的模板、
+                    固定的指令），超出上限时按LRU淘汰。
+    step模型带generation_head时，返回的是其生成结果（topk时为tuple
+    (得分, token_ids)），可以直接返回给beam search。
+    """
+    def __init__(self, step_model, application='seq2seq', max_memory=None):
+        self.step_model = step_model
+        self.application = application
+        self.max_memory = max_memory
+        self.num_layers = len([
+            n for n in step_model.input_names if re.match(r'Cache-\d+$', n)
+        ])
+        self.num_outputs = len(step_model.outputs) - self.num_layers
+        self.hidden_size = step_model.output_shape[-1][-1]
+        # 主输出是否是序列（否则为generation_head的最后位置结果）
+        self.sequence_output = len(step_model.output_shape[0]) == 3
+        self.cache = OrderedDict()  # key -> (token_ids, segment_ids, states)
+        self.memory = 0
+        self.lookups, self.hits = 0, 0
+        self.reused_tokens, self.computed_tokens = 0, 0
+
+    def is_closed(self, segment_ids, length):
+        """判断前length个token的计算结果是否不受之后token的影响
+        """
+        if self.application == 'seq2seq' and length > 0:
+            return not (segment_ids[length:] == 0).any()
+        return True
+
+    def match(self, token_ids, segment_ids, cached):
+        """求与某个缓存的可复用的公共前缀长度
+        缓存的状态对其任意前缀都有效（只要两边都满足is_closed）。
+        """
+        c_token_ids, c_segment_ids = cached[:2]
+        length = min(len(token_ids), len(c_token_ids))
+        same = ((token_ids[:length] == c_token_ids[:length]) &
+                (segment_ids[:length] == c_segment_ids[:length]))
+        if not same.all():
+            length = same.argmin()
+        if (self.is_closed(segment_ids, length) and
+                self.is_closed(c_segment_ids, length)):
+            return length
+        return 0
+
+    def fetch(self, token_ids, segment_ids, others):
+        """获取单行前缀在每一层的缓存状态，复用最长的已缓存前缀
+        """
+        length, others_key = len(token_ids), self.to_key(others)
+        cached_key, cached_length, states = None, 0, [
+            np.zeros((1, 0, self.hidden_size)) for _ in range(self.num_layers)
+        ]
+        for key, value in self.cache.items():
+            if key[2] == others_key and len(key[0]) > cached_length:
+                l = self.match(token_ids, segment_ids, value)
+                if l > cached_length:
+                    cached_key, cached_length = key, l
+        self.lookups += 1
+        if cached_key is not None:
+            self.hits += 1
+            states = [h[:, :cached_length] for h in self.cache[cached_key][2]]
+        self.reused_tokens += cached_length
+        self.computed_tokens += length - cached_length
+        if cached_key is not None and cached_length == length:
+            return cached_key, states  # 已被某个缓存完全覆盖
+        if cached_length < length:
+            outputs = self.step_model.predict([
+                token_ids[None, cached_length:],
+                segment_ids[None, cached_length:],
+                token_ids[None, :cached_length],
+                segment_ids[None, :cached_length],
+            ] + states + [x[None] for x in others])
+            states = [
+                np.concatenate([s, o], 1)
+                for s, o in zip(states, outputs[self.num_outputs:])
+            ]
+        key = (tuple(token_ids), tuple(segment_ids), others_key)
+        # 被完整延长的旧前缀可以由新前缀代替
+        if cached_key is not None and cached_length == len(cached_key[0]):
+            self.remove(cached_key)
+        self.remove(key)
+        self.cache[key] = (token_ids, segment_ids, states)
+        self.memory += sum([h.nbytes for h in states])
+        return key, states
+
+    def remove(self, key):
+        if key in self.cache:
+            self.memory -= sum([h.nbytes for h in self.cache.pop(key)[2]])
+
+    def evict(self, used_keys):
+        """清理缓存：max_memory为None时只保留本次用到的前缀，
+        否则把本次用到的前缀标记为最近使用，并按LRU淘汰到上限以内
+        """
+        if self.max_memory is None:
+            for key in list(self.cache.keys()):
+                if key not in used_keys:
+                    self.remove(key)
+        else:
+            for key in used_keys:
+                if key in self.cache:
+                    self.cache[key] = self.cache.pop(key)
+            while self.cache and self.memory > self.max_memory:
+                self.remove(next(iter(self.cache)))
+
+    @property
+    def stats(self):
+        """命中率及内存占用
+        hit_rate为能复用缓存的查询比例，token_hit_rate为前缀中直接
+        复用的token比例，memory为缓存状态占用的字节数。
+        """
+        tokens = self.reused_tokens + self.computed_tokens
+        return {
+            'entries': len(self.cache),
+            'memory': self.memory,
+            'hit_rate': 1. * self.hits / max(self.lookups, 1),
+            'token_hit_rate': 1. * self.reused_tokens / max(tokens, 1),
+        }
+
+    def to_key(self, inputs):
+        return tuple([np.asarray(x).tobytes() for x in inputs])
+
+    def predict(self, inputs, lengths=None):
+        """inputs为[token_ids, segment_ids, 其余输入]，均为逐行对齐的
+        batch；返回每一行最后一个位置的输出。lengths非None时各行为
+        右padding的序列，返回各行最后一个真实位置（lengths - 1）的输出，
+        此时padding部分的segment_ids应与最后一个真实token相同（如seq2seq
+        的目标部分为1），保证它不会被前面的token看到。
+        """
+        if lengths is not None and not self.sequence_output:
+            raise ValueError('Generation head does not support padded rows.')
+        elif lengths is not None:
+            lengths = np.asarray(lengths)
+        inputs = [np.asarray(x) for x in inputs]
+        token_ids, segment_ids = inputs[:2]
+        # 完全相同的行只计算一次，再按其余输入（以及source）分组
+        uniques, inverse, groups = {}, [], {}
+        for i in range(len(token_ids)):
+            key = self.to_key([x[i] for x in inputs])
+            if key not in uniques:
+                uniques[key] = i
+                group_key = [x[i] for x in inputs[2:]]
+                if self.application == 'seq2seq':
+                    group_key.append(token_ids[i][segment_ids[i] == 0])
+                group_key = self.to_key(group_key)
+                groups.setdefault(group_key, []).append(i)
+            inverse.append(uniques[key])
+        # 每组取公共前缀，前缀之外的部分逐行计算
+        results, used_keys = {}, set()
+        for idxs in groups.values():
+            x, s = token_ids[idxs], segment_ids[idxs]
+            others = [o[idxs] for o in inputs[2:]]
+            same = (x == x[:1]).all(0) & (s == s[:1]).all(0)
+            length = x.shape[1] - 1
+            if not same[:length].all():
+                length = same.argmin()
+            if lengths is not None:  # 每行至少留下最后一个真实token
+                length = min(length, lengths[idxs].min() - 1)
+            if not all([self.is_closed(r, length) for r in s]):
+                length = 0
+            key, states = self.fetch(x[0, :length], s[0, :length],
+                                     [o[0] for o in others])
+            used_keys.add(key)
+            outputs = self.step_model.predict([
+                x[:, length:],
+                s[:, length:],
+                np.repeat(x[:1, :length], len(idxs), 0),
+                np.repeat(s[:1, :length], len(idxs), 0),
+            ] + [np.repeat(h, len(idxs), 0) for h in states] + others)
+            outputs = outputs[:self.num_outputs]
+            if lengths is not None:
+                positions = lengths[idxs] - 1 - length
+                outputs = [o[np.arange(len(idxs)), positions] for o in outputs]
+            elif self.sequence_output:
+                outputs = [o[:, -1] for o in outputs]
+            for j, i in enumerate(idxs):
+                results[i] = [o[j] for o in outputs]
+        # 清理缓存，保留本次用到的前缀供下一步继续扩充
+        self.evict(used_keys)
+        outputs = tuple([
+            np.array([results[i][j] for i in inverse])
+            for j in range(self.num_outputs)
+        ])
+        if self.num_outputs == 1:
+            return outputs[0]
+        return outputs
+
+
+class DecodingScheduler(object):
+    """连续批处理（continuous batching）的解码调度器
+    同时持有多个解码请求，每一步把所有在途请求的待预测部分合并
+    成batch（见AutoRegressiveDecoder.batch_predict）；每一步之间
+    接纳新请求、移除已完成请求，每个请求通过Future获取结果。
+    参数：
+        decoder: AutoRegressiveDecoder实例；
+        max_batch_size: 在途请求的总行数（如beam size之和）上限，
+                        超过之后新请求需排队等待。
+    说明：beam search、随机采样的请求在第1步只有1行，之后才扩充为
+         topk、n行，所以接纳请求时按其最多行数（beam_search为topk，
+         random_sample为n）预留，保证每一步的总行数不超过上限（单个
+         请求本身超过上限时，仍在没有其他在途请求时单独执行）。
+    """
+    def __init__(self, decoder, max_batch_size=64):
+        self.decoder = decoder
+        self.max_batch_size = max_batch_size
+        self.queue = six.moves.queue.Queue()
+        self.pending = None  # 已取出但暂时放不下的请求
+        self.actives = []  # 元素为[future, decoding, request, rows]
+        self.thread = None
+        self.running = False
+
+    def submit(self, inputs, method='beam_search', **kwargs):
+        """提交一个解码请求，返回Future
+        method为beam_search或random_sample，kwargs为对应的参数。
+        """
+        from concurrent.futures import Future
+        decoding = getattr(self.decoder, method + '_steps')(inputs, **kwargs)
+        rows = kwargs.get('topk' if method == 'beam_search' else 'n', 1)
+        future = Future()
+        self.queue.put((future, decoding, rows))
+        return future
+
+    @property
+    def batch_size(self):
+        """在途请求预留的总行数
+        """
+        return sum([r[3] for r in self.actives])
+
+    def admit(self, block=False):
+        """从等待队列中接纳新请求，直到预留的总行数达到上限
+        """
+        while True:
+            if self.pending is None:
+                try:
+                    self.pending = self.queue.get(block=block, timeout=0.1)
+                except six.moves.queue.Empty:
+                    break
+                block = False
+            future, decoding, rows = self.pending
+            if self.actives and self.batch_size + rows > self.max_batch_size:
+                break
+            self.pending = None
+            if not future.set_running_or_notify_cancel():
+                continue  # 已被取消的请求
+            self.advance([future, decoding, None, rows], None)
+
+    def advance(self, item, scores):
+        """将得分送入单个请求的解码生成器，完成则移除并返回结果
+        """
+        future, decoding = item[:2]
+        try:
+            if scores is None:
+                done, value = next(decoding)
+            else:
+                done, value = decoding.send(scores)
+        except Exception as e:
+            done, value = None, e
+        if item in self.actives:
+            self.actives.remove(item)
+        if done is None:
+            future.set_exception(value)
+        elif done:
+            future.set_result(value)
+        else:
+            item[2] = value
+            self.actives.append(item)
+
+    def step(self):
+        """执行一步：接纳新请求，合并预测，推进各个请求
+        """
+        self.admit(block=not self.actives)
+        if not self.actives:
+            return
+        actives = self.actives[:]
+        try:
+            results = self.decoder.batch_predict([r[2] for r in actives])
+        except Exception as e:
+            for item in actives:
+                self.actives.remove(item)
+                item[0].set_exception(e)
+            return
+        for item, scores in zip(actives, results):
+            self.advance(item, scores)
+
+    def run(self):
+        """循环执行解码步，直到调用stop
+        """
+        while self.running:
+            self.step()
+
+    def start(self):
+        """在后台线程中启动调度循环
+        """
+        import threading
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """停止调度循环（在途请求保留，可再次start）
+        """
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+class Predictor(object):
+    """按形状分桶的预测器
+    输入按长度排序后，padding到少数几个固定的(batch_size, length)桶
+    再预测，输出恢复原顺序，这样模型只会见到这几种形状，避免
+    tf.function反复重新trace；启动时可预先把每个桶都跑一遍。
+    参数：
+        model: keras模型或BertModel实例；
+        buckets: (batch_size, length)组成的list；
+        predict: 实际执行预测的函数，默认为model.predict，
+                 也可以传入backend.predict_function(model)；
+        warmup: 是否在初始化时预热所有桶。
+    说明：模型的每个输入都应是token_ids、segment_ids这样的变长序列；
+         输出的第2维若是序列维度，则按原长度截断后逐样本返回。
+    """
+    def __init__(self, model, buckets, predict=None, warmup=True):
+        self.model = getattr(model, 'model', model)
+        self.predict_func = predict or self.model.predict
+        self.buckets = sorted(buckets, key=lambda b: (b[1], b[0]))
+        self.lengths = sorted(set([l for _, l in self.buckets]))
+        self.stats = {b: {'calls': 0, 'time': 0.} for b in self.buckets}
+        if warmup:
+            self.warmup()
+
+    def warmup(self):
+        """每个桶都用全零输入预测一次（trace及首次调用的耗时不计入统计）
+        """
+        num_inputs = len(self.model.inputs)
+        for batch_size, length in self.buckets:
+            inputs = [np.zeros((batch_size, length)) for _ in range(num_inputs)]
+            self.predict_func(inputs)
+
+    def run(self, inputs, bucket):
+        """预测一个已padding好的桶，并记录统计信息
+        """
+        start = time.time()
+        outputs = self.predict_func(inputs)
+        self.stats[bucket]['calls'] += 1
+        self.stats[bucket]['time'] += time.time() - start
+        return outputs
+
+    def bucket_length(self, length):
+        for l in self.lengths:
+            if l >= length:
+                return l
+        raise ValueError('Sequence length %d exceeds the largest bucket.' %
+                         length)
+
+    def predict(self, inputs):
+        """inputs为[token_ids列表, segment_ids列表, ...]，每个列表里
+        是各样本的变长序列；返回与输入顺序一致的结果。
+        """
+        lengths = np.array([len(x) for x in inputs[0]])
+        idxs = lengths.argsort()
+        results = [None] * len(lengths)
+        while len(idxs) > 0:
+            # 以当前最短样本所在的长度桶为准，尽量多地装入样本
+            length = self.bucket_length(lengths[idxs[0]])
+            sizes = [b for b, l in self.buckets if l == length]
+            chunk = idxs[:max(sizes)]
+            chunk = chunk[lengths[chunk] <= length]
+            idxs = idxs[len(chunk):]
+            batch_size = min([b for b in sizes if b >= len(chunk)])
+            batch = []
+            for x in inputs:
+                x = sequence_padding([x[i] for i in chunk], length)
+                padding = np.zeros((batch_size - len(chunk), length))
+                batch.append(np.concatenate([x, padding]))
+            outputs = self.run(batch, (batch_size, length))
+            if not isinstance(outputs, list):
+                outputs = [outputs]
+            for j, i in enumerate(chunk):
+                results[i] = [
+                    o[j, :lengths[i]] if len(s) > 2 and s[1] is None else o[j]
+                    for o, s in zip(outputs, self.output_shapes)
+                ]
+        if len(self.output_shapes) == 1:
+            return [r[0] for r in results]
+        return [list(r) for r in zip(*results)]
+
+    @property
+    def output_shapes(self):
+        shapes = self.model.output_shape
+        if not isinstance(shapes, list):
+            shapes = [shapes]
+        return shapes
+
+    def report(self):
+        """返回每个桶的调用次数与平均耗时（毫秒），以及trace次数
+        traces取自实际编译的tf.function（predict_function或model.predict
+        的predict_function）的experimental_get_tracing_count()；
+        取不到时（如静态图模式，本来就不会重复trace）不给出该项。
+        """
+        latencies = {}
+        for bucket, stat in self.stats.items():
+            latency = stat['time'] * 1000 / max(stat['calls'], 1)
+            latencies[bucket] = {'calls': stat['calls'], 'latency': latency}
+        report = {'buckets': latencies}
+        for function in [
+            self.predict_func,
+            getattr(self.model, 'predict_function', None)
+        ]:
+            if hasattr(function, 'experimental_get_tracing_count'):
+                report['traces'] = function.experimental_get_tracing_count()
+                break
+        return report
 
 
 class Hook:
@@ -0,0 +1,54 @@
+#! -*- coding: utf-8 -*-
+# 测试fused_qkv（q、k、v合并为一个Dense）在不同batch_size * seq_len下
+# 的前向耗时（CPU）：收益不大，batch_size * seq_len上千时才可能更快，
+# 单条短序列（如逐步解码）时略慢；CPU上的耗时波动较大，建议多跑几次
+# 模型为随机初始化的Bert，只比较前向耗时，不需要加载权重
+# 用法：python basic_fused_qkv_benchmark.py [层数] [hidden_size]
+# 默认为4层、hidden_size=768（head_size固定为64，intermediate为4倍）
+
+from __future__ import print_function
+import sys, time
+from bert4keras.backend import predict_function
+from bert4keras.bert import BertModel
+import numpy as np
+
+args = [int(i) for i in sys.argv[1:]]
+num_layers, hidden_size = (args + [4, 768][len(args):])[:2]
+
+
+def build_model(fused_qkv=False):
+    bert = BertModel(vocab_size=21128,
+                     max_position_embeddings=512,
+                     hidden_size=hidden_size,
+                     num_hidden_layers=num_layers,
+                     num_attention_heads=hidden_size // 64,
+                     intermediate_size=hidden_size * 4,
+                     hidden_act='gelu',
+                     dropout_rate=0.1,
+                     fused_qkv=fused_qkv)
+    bert.build()
+    return predict_function(bert.model)
+
+
+def benchmark(predict, batch_size, seq_len, n=10):
+    """返回平均每次前向的耗时（毫秒）
+    """
+    token_ids = np.random.randint(1, 21128, (batch_size, seq_len))
+    segment_ids = np.zeros_like(token_ids)
+    predict([token_ids, segment_ids]) # 预热
+    start = time.time()
+    for _ in range(n):
+        predict([token_ids, segment_ids])
+    return (time.time() - start) * 1000 / n
+
+
+models = [
+    ('split', build_model()),
+    ('fused', build_model(fused_qkv=True)),
+]
+
+print('layers=%s, hidden_size=%s' % (num_layers, hidden_size))
+for batch_size, seq_len in [(1, 64), (1, 512), (8, 128), (32, 128)]:
+    for name, predict in models:
+        print('%s, %sx%s: %.1f ms' %
+              (name, batch_size, seq_len, benchmark(predict, batch_size, seq_len)))
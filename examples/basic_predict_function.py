@@ -0,0 +1,37 @@
+#! -*- coding: utf-8 -*-
+# 测试predict_function的加速效果：小batch高频率预测时的单次耗时
+# 解码等场景每次只预测很少的样本，model.predict本身的开销占了大头
+
+from __future__ import print_function
+import time
+from bert4keras.backend import keras, predict_function
+from bert4keras.bert import build_bert_model
+from bert4keras.tokenizer import Tokenizer
+import numpy as np
+
+
+config_path = '/root/kg/bert/chinese_L-12_H-768_A-12/bert_config.json'
+checkpoint_path = '/root/kg/bert/chinese_L-12_H-768_A-12/bert_model.ckpt'
+dict_path = '/root/kg/bert/chinese_L-12_H-768_A-12/vocab.txt'
+
+tokenizer = Tokenizer(dict_path, do_lower_case=True) # 建立分词器
+model = build_bert_model(config_path, checkpoint_path) # 建立模型，加载权重
+predict = predict_function(model) # 编译成直接调用的函数
+
+token_ids, segment_ids = tokenizer.encode(u'语言模型')
+inputs = [np.array([token_ids]), np.array([segment_ids])]
+print('max diff: %s' % np.abs(model.predict(inputs) - predict(inputs)).max())
+
+
+def benchmark(func, n=100):
+    """返回平均每次调用的耗时（毫秒）
+    """
+    func(inputs) # 预热
+    start = time.time()
+    for _ in range(n):
+        func(inputs)
+    return (time.time() - start) * 1000 / n
+
+
+print('model.predict: %.2f ms/call' % benchmark(model.predict))
+print('predict_function: %.2f ms/call' % benchmark(predict))
@@ -0,0 +1,46 @@
+#! -*- coding: utf-8 -*-
+# 测试recompute=True的效果：训练时的峰值内存与每步耗时（CPU）
+# 用法：python basic_recompute_benchmark.py [层数] [recompute]
+# 默认为4层，base宽度，seq_len=512，batch_size=4
+# 峰值内存按进程统计，所以每种设置要分别用一个进程来跑
+
+from __future__ import print_function
+import sys, time, resource
+from bert4keras.backend import keras, K
+from bert4keras.bert import BertModel
+import numpy as np
+
+recompute = 'recompute' in sys.argv[1:]
+layers = [int(i) for i in sys.argv[1:] if i.isdigit()]
+num_layers = layers[0] if layers else 4
+seq_len, batch_size = 512, 4
+
+bert = BertModel(vocab_size=21128,
+                 max_position_embeddings=512,
+                 hidden_size=768,
+                 num_hidden_layers=num_layers,
+                 num_attention_heads=12,
+                 intermediate_size=3072,
+                 hidden_act='gelu',
+                 dropout_rate=0.1,
+                 recompute=recompute)
+bert.build()
+model = bert.model
+model.compile(loss=lambda y_true, y_pred: K.mean(y_pred**2), optimizer='adam')
+
+token_ids = np.random.randint(1, 21128, (batch_size, seq_len))
+segment_ids = np.zeros_like(token_ids)
+labels = np.zeros((batch_size, seq_len, 768))
+model.train_on_batch([token_ids, segment_ids], labels) # 预热
+
+n = 5
+start = time.time()
+for _ in range(n):
+    model.train_on_batch([token_ids, segment_ids], labels)
+step_time = (time.time() - start) / n
+
+# ru_maxrss在linux下单位为KB
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+print('recompute=%s, layers=%s, seq_len=%s, batch_size=%s' %
+      (recompute, num_layers, seq_len, batch_size))
+print('step time: %.2f s, peak memory: %.0f MB' % (step_time, peak))
@@ -0,0 +1,55 @@
+#! -*- coding: utf-8 -*-
+# 测试unpad=True的效果：不同padding比例下的前向耗时（CPU）
+# 序列长度固定为seq_len，每个样本的真实长度为seq_len * (1 - padding比例)
+
+from __future__ import print_function
+import time
+from bert4keras.backend import keras, K
+from bert4keras.bert import BertModel
+import numpy as np
+
+num_layers, seq_len, batch_size = 4, 256, 16
+
+
+def build(unpad):
+    bert = BertModel(vocab_size=21128,
+                     max_position_embeddings=512,
+                     hidden_size=768,
+                     num_hidden_layers=num_layers,
+                     num_attention_heads=12,
+                     intermediate_size=3072,
+                     hidden_act='gelu',
+                     dropout_rate=0.1,
+                     unpad=unpad)
+    bert.build()
+    return bert.model
+
+
+def benchmark(model, inputs, n=5):
+    model.predict(inputs)  # 预热
+    start = time.time()
+    for _ in range(n):
+        model.predict(inputs)
+    return (time.time() - start) / n
+
+
+model = build(False)
+unpad_model = build(True)
+unpad_model.set_weights(model.get_weights())
+
+print('padding ratio | padded (ms) | unpadded (ms) | speedup')
+for ratio in [0, 0.25, 0.5, 0.75, 0.9]:
+    token_ids = np.random.randint(1, 21128, (batch_size, seq_len))
+    # 真实长度在均值附近随机浮动，保证整体的padding比例约为ratio
+    mean_len = seq_len * (1 - ratio)
+    lengths = np.random.randint(mean_len * 0.5, mean_len * 1.5 + 1, batch_size)
+    lengths = np.clip(lengths, 1, seq_len)
+    lengths[0] = seq_len  # 保证batch的长度为seq_len
+    for i, l in enumerate(lengths):
+        token_ids[i, l:] = 0
+    segment_ids = np.zeros_like(token_ids)
+    real_ratio = 1 - (token_ids > 0).mean()
+    t1 = benchmark(model, [token_ids, segment_ids])
+    t2 = benchmark(unpad_model, [token_ids, segment_ids])
+    print('%13.2f | %11.1f | %13.1f | %.2fx' %
+          (real_ratio, t1 * 1000, t2 * 1000, t1 / t2))
@@ -0,0 +1,60 @@
+#! -*- coding: utf-8 -*-
+# 测试稀疏局部attention及线性attention在长序列上的速度：128到4096个
+# token（CPU），较短的序列上两者都未必比普通attention快
+# 模型为随机初始化的Bert，只比较前向耗时，不需要加载权重
+# 用法：python basic_window_attention_benchmark.py [层数] [hidden_size]
+# 默认为2层、hidden_size=256（head_size固定为64，intermediate为4倍）
+
+from __future__ import print_function
+import sys, time
+from bert4keras.backend import predict_function
+from bert4keras.bert import BertModel
+import numpy as np
+
+args = [int(i) for i in sys.argv[1:]]
+num_layers, hidden_size = (args + [2, 256][len(args):])[:2]
+
+
+def build_model(att_window_size=None, att_window_mode='sliding',
+                att_linear=False):
+    """att_window_size为None且att_linear=False时即普通attention
+    """
+    bert = BertModel(vocab_size=21128,
+                     max_position_embeddings=4096,
+                     hidden_size=hidden_size,
+                     num_hidden_layers=num_layers,
+                     num_attention_heads=hidden_size // 64,
+                     intermediate_size=hidden_size * 4,
+                     hidden_act='gelu',
+                     dropout_rate=0.1,
+                     att_window_size=att_window_size,
+                     att_window_mode=att_window_mode,
+                     att_linear=att_linear,
+                     att_global_size=1) # [CLS]作为全局位置
+    bert.build()
+    return predict_function(bert.model)
+
+
+def benchmark(predict, seq_len, batch_size=1, n=3):
+    """返回平均每次前向的耗时（毫秒）
+    """
+    token_ids = np.random.randint(1, 21128, (batch_size, seq_len))
+    segment_ids = np.zeros_like(token_ids)
+    predict([token_ids, segment_ids]) # 预热
+    start = time.time()
+    for _ in range(n):
+        predict([token_ids, segment_ids])
+    return (time.time() - start) * 1000 / n
+
+
+models = [
+    ('dense', build_model()),
+    ('sliding-128', build_model(128, 'sliding')),
+    ('block-128', build_model(128, 'block')),
+    ('linear', build_model(att_linear=True)),
+]
+
+print('layers=%s, hidden_size=%s' % (num_layers, hidden_size))
+for seq_len in [128, 256, 512, 1024, 2048, 4096]:
+    for name, predict in models:
+        print('%s, seq_len=%s: %.1f ms' % (name, seq_len, benchmark(predict, seq_len)))
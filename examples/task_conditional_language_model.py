@@ -13,6 +13,7 @@ from bert4keras.tokenizer import Tokenizer, load_vocab
 from bert4keras.optimizers import Adam
 from bert4keras.snippets import sequence_padding, open
 from bert4keras.snippets import DataGenerator, AutoRegressiveDecoder
+from bert4keras.snippets import PrefixCache
 from bert4keras.snippets import uniout  # 打印中文
 from keras.layers import *
 
@@ -92,14 +93,20 @@ c = Embedding(2, 128)(c_in)
 c = Reshape((128, ))(c)
 
 # Bert模型
-model = build_bert_model(
+bert = build_bert_model(
     config_path,
     checkpoint_path,
     application='lm',
     keep_tokens=keep_tokens,  # 只保留keep_tokens中的字，精简原字表
     layer_norm_cond=c,
     additional_input_layers=c_in,
+    return_keras_model=False,
 )
+model = bert.model
+# 解码时各层Conditional LayerNorm的条件部分每个标签只算一次
+condition_model = bert.build_condition_model()
+step_model = bert.build_step_model(cached_condition=True)
+prefix_cache = PrefixCache(step_model, 'lm')  # 公共前缀只算一次
 
 model.summary()
 
@@ -120,14 +127,16 @@ class RandomSentiment(AutoRegressiveDecoder):
     def predict(self, inputs, output_ids, step, rtype='logits'):
         token_ids = output_ids
         segment_ids = np.zeros_like(token_ids)
-        probas = model.predict([token_ids, segment_ids, inputs[0]])[:, -1]
+        probas = prefix_cache.predict([token_ids, segment_ids] + inputs)
         if rtype == 'probas':
             return probas
         else:
             return np.log(probas)
 
     def generate(self, label, n=1, topk=5):
-        results = self.random_sample([[label]], n, topk)  # 基于随机采样
+        conditions = condition_model.predict(np.array([[label]]))  # 条件部分
+        conditions = [c[0] for c in conditions]
+        results = self.random_sample(conditions, n, topk)  # 基于随机采样
         return [tokenizer.decode(ids) for ids in results]
 
 
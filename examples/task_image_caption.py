@@ -14,6 +14,7 @@ from bert4keras.tokenizer import Tokenizer, load_vocab
 from bert4keras.optimizers import Adam
 from bert4keras.snippets import sequence_padding, is_string
 from bert4keras.snippets import DataGenerator, AutoRegressiveDecoder
+from bert4keras.snippets import PrefixCache
 import cv2
 
 
@@ -122,7 +123,7 @@ image_model = MobileNetV2(include_top=False, pooling='avg')
 img_size = 299
 
 # Bert模型
-model = build_bert_model(
+bert = build_bert_model(
     config_path,
     checkpoint_path,
     application='lm',
@@ -131,8 +132,16 @@ model = build_bert_model(
     layer_norm_cond_hidden_size=128,
     layer_norm_cond_hidden_act='swish',
     additional_input_layers=image_model.input,
+    return_keras_model=False,
 )
 
+model = bert.model
+# 解码时图像特征及各层Conditional LayerNorm的条件部分每张图只算一次
+condition_model = bert.build_condition_model()
+# 只输出最后位置的top10
+step_model = bert.build_step_model(cached_condition=True, generation_head=10)
+prefix_cache = PrefixCache(step_model, 'lm')  # 公共前缀只算一次
+
 model.summary()
 
 # 交叉熵作为loss，并mask掉输入部分的预测
@@ -150,20 +159,21 @@ class AutoCaption(AutoRegressiveDecoder):
     """img2seq解码器
     """
     def predict(self, inputs, output_ids, step, rtype='logits'):
-        image = inputs[0]
         token_ids = output_ids
         segment_ids = np.zeros_like(token_ids)
-        probas = model.predict([token_ids, segment_ids, image])[:, -1]
+        scores, ids = prefix_cache.predict([token_ids, segment_ids] + inputs)
         if rtype == 'probas':
-            return probas
+            return np.exp(scores), ids
         else:
-            return np.log(probas)
+            return scores, ids
 
     def generate(self, image, topk=1):
         if is_string(image):
             image = read_image(image)
         image = preprocess_input(image)
-        output_ids = self.beam_search([image], topk)  # 基于beam search
+        conditions = condition_model.predict(image[None])  # 条件部分
+        conditions = [c[0] for c in conditions]
+        output_ids = self.beam_search(conditions, topk)  # 基于beam search
         return tokenizer.decode(output_ids)
 
 
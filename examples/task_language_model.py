@@ -11,6 +11,7 @@ from bert4keras.tokenizer import Tokenizer, load_vocab
 from bert4keras.optimizers import Adam
 from bert4keras.snippets import sequence_padding, open
 from bert4keras.snippets import DataGenerator, AutoRegressiveDecoder
+from bert4keras.snippets import PrefixCache
 
 
 maxlen = 256
@@ -92,21 +93,21 @@ class data_generator(DataGenerator):
                 batch_token_ids, batch_segment_ids = [], []
 
 
-model = build_bert_model(
+bert = build_bert_model(
     config_path,
     checkpoint_path,
     application='lm',
     keep_tokens=keep_tokens,  # 只保留keep_tokens中的字，精简原字表
+    return_keras_model=False,
 )
+model = bert.model
+prefix_cache = PrefixCache(bert.build_step_model(), 'lm')  # 公共前缀只算一次
 
 model.summary()
 
-# 交叉熵作为loss，并mask掉输入部分的预测
-y_in = model.input[0][:, 1:]  # 目标tokens
-y_mask = model.get_layer('Sequence-Mask').output_mask[:, 1:]  # 目标mask
-y = model.output[:, :-1]  # 预测tokens，预测与目标错开一位
-cross_entropy = K.sparse_categorical_crossentropy(y_in, y)
-cross_entropy = K.sum(cross_entropy * y_mask) / K.sum(y_mask)
+# 交叉熵作为loss，只在非padding部分计算
+# 只取出目标位置再按词表分块计算，不构建完整的概率矩阵
+cross_entropy = bert.compute_lm_loss()
 
 model.add_loss(cross_entropy)
 model.compile(optimizer=Adam(1e-5))
@@ -119,7 +120,7 @@ class StoryCompletion(AutoRegressiveDecoder):
         token_ids = inputs[0]
         token_ids = np.concatenate([token_ids, output_ids], 1)
         segment_ids = np.zeros_like(token_ids)
-        probas = model.predict([token_ids, segment_ids])[:, -1]
+        probas = prefix_cache.predict([token_ids, segment_ids])
         if rtype == 'probas':
             return probas
         else:
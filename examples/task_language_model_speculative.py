@@ -0,0 +1,90 @@
+#! -*- coding: utf-8 -*-
+# 投机采样：给task_language_model.py训练好的模型加速续写
+# draft模型直接截取原模型的前3层，验证由完整模型一次前向完成，
+# 输出的分布跟直接random_sample完全一致。
+# 这里统计每次完整模型前向平均能确定多少个token，以及实际耗时。
+
+from __future__ import print_function
+import time
+import numpy as np
+from bert4keras.backend import predict_function
+from bert4keras.bert import build_bert_model
+from bert4keras.snippets import AutoRegressiveDecoder
+from task_language_model import config_path, keep_tokens, tokenizer, maxlen
+from task_language_model import model, StoryCompletion
+
+draft_layers = 3
+draft_k = 4
+topk = 5
+
+# 截取前draft_layers层作为draft模型，权重直接从完整模型复制
+draft_model = build_bert_model(
+    config_path,
+    application='lm',
+    keep_tokens=keep_tokens,
+    config_overrides={'num_hidden_layers': draft_layers},
+)
+for layer in draft_model.layers:
+    if layer.weights:
+        layer.set_weights(model.get_layer(layer.name).get_weights())
+
+# 每次只预测一两条样本，直接调用比model.predict快得多
+model_predict = predict_function(model)
+draft_predict = predict_function(draft_model)
+
+
+class Target(StoryCompletion):
+    """完整模型，一次前向同时给出最后若干个位置的预测
+    """
+    def predict_window(self, inputs, output_ids, window):
+        token_ids = np.concatenate([inputs[0], output_ids], 1)
+        segment_ids = np.zeros_like(token_ids)
+        return model_predict([token_ids, segment_ids])[:, -window:]
+
+
+class Draft(AutoRegressiveDecoder):
+    """draft模型
+    """
+    def predict(self, inputs, output_ids, step, rtype='logits'):
+        token_ids = np.concatenate([inputs[0], output_ids], 1)
+        segment_ids = np.zeros_like(token_ids)
+        probas = draft_predict([token_ids, segment_ids])[:, -1]
+        if rtype == 'probas':
+            return probas
+        else:
+            return np.log(probas)
+
+
+target = Target(start_id=None, end_id=tokenizer._token_sep_id, maxlen=maxlen)
+draft = Draft(start_id=None, end_id=tokenizer._token_sep_id, maxlen=maxlen)
+
+
+if __name__ == '__main__':
+
+    texts = [
+        u'当晚两人在一家小客店中宿歇。张无忌躺在炕上，越想越是担心，走到赵敏窗外，但听她呼吸调匀，正自香梦沉酣。',
+        u'虚竹飞身跃上松树的枝干，只见段延庆的钢杖深深嵌在树枝之中，全凭一股内力粘劲，挂住了下面四人，内力之深厚，实是非同小可。虚竹伸左手抓住钢杖，提将上来。',
+        u'杨过居住在侠客岛，是令狐冲的弟子，武器是金蛇剑。',
+    ]
+    total_time, total_tokens = 0., 0
+    for text in texts:
+        token_ids = tokenizer.encode(text)[0][:-1]
+        start = time.time()
+        output_ids = target.random_sample([token_ids], 1, topk)[0]
+        total_time += time.time() - start
+        total_tokens += len(output_ids)
+    print(u'random_sample: %.2f ms/token' % (total_time * 1000 / total_tokens))
+
+    total_time, total_tokens, total_calls, total_accepted = 0., 0, 0, 0
+    for text in texts:
+        token_ids = tokenizer.encode(text)[0][:-1]
+        start = time.time()
+        output_ids = target.speculative_sample([token_ids], draft, draft_k, topk)
+        total_time += time.time() - start
+        total_tokens += len(output_ids)
+        total_calls += target.speculative_stats['target_calls']
+        total_accepted += target.speculative_stats['accepted_tokens']
+        print(u'结果: %s' % (text + tokenizer.decode(output_ids)))
+    print(u'speculative_sample: %.2f ms/token' % (total_time * 1000 / total_tokens))
+    print(u'每次完整模型前向确定的token数: %.2f' % (1. * total_tokens / total_calls))
+    print(u'每次完整模型前向接受的draft token数: %.2f' % (1. * total_accepted / total_calls))
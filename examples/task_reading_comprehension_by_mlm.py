@@ -11,7 +11,7 @@ from bert4keras.bert import build_bert_model
 from bert4keras.tokenizer import Tokenizer, load_vocab
 from bert4keras.optimizers import Adam
 from bert4keras.snippets import sequence_padding, DataGenerator
-from bert4keras.snippets import open
+from bert4keras.snippets import open, SubstringConstraint
 from keras.layers import Lambda
 from keras.models import Model
 from tqdm import tqdm
@@ -121,19 +121,6 @@ def masked_cross_entropy(y_true, y_pred):
 model.compile(loss=masked_cross_entropy, optimizer=Adam(1e-5))
 
 
-def get_ngram_set(x, n):
-    """生成ngram合集，返回结果格式是:
-    {(n-1)-gram: set([n-gram的第n个字集合])}
-    """
-    result = {}
-    for i in range(len(x) - n + 1):
-        k = tuple(x[i:i + n])
-        if k[:-1] not in result:
-            result[k[:-1]] = set()
-        result[k[:-1]].add(k[-1])
-    return result
-
-
 def gen_answer(question, passages):
     """由于是MLM模型，所以可以直接argmax解码。
     """
@@ -151,24 +138,31 @@ def gen_answer(question, passages):
     token_ids = sequence_padding(token_ids)
     segment_ids = sequence_padding(segment_ids)
     probas = model.predict([token_ids, segment_ids])
+    # 每个篇章单独一棵trie，所有篇章一起逐位解码
+    constraint = SubstringConstraint(all_p_token_ids,
+                                     probas.shape[-1],
+                                     maxlen=max_a_len,
+                                     extra_ids=[tokenizer._token_sep_id],
+                                     separate=True)
+    states = constraint.initial_states(len(passages), np.arange(len(passages)))
+    answers = np.zeros((len(passages), max_a_len), dtype='int32')
+    scores, lengths = np.zeros(len(passages)), np.zeros(len(passages))
+    finished = np.zeros(len(passages), dtype=bool)
+    for i in range(max_a_len):
+        # pi是将passage以外的token的概率置零
+        pi = np.where(constraint.mask(states), probas[:, i], 0)
+        answers[:, i] = pi.argmax(1)
+        scores += np.where(finished, 0, pi.max(1))
+        lengths += (finished == False)
+        finished |= (answers[:, i] == tokenizer._token_sep_id)
+        if finished.all():
+            break
+        states = constraint.advance(states, answers[:, i])
     results = {}
-    for t, p in zip(all_p_token_ids, probas):
-        a, score = tuple(), 0.
-        for i in range(max_a_len):
-            idxs = list(get_ngram_set(t, i + 1)[a])
-            if tokenizer._token_sep_id not in idxs:
-                idxs.append(tokenizer._token_sep_id)
-            # pi是将passage以外的token的概率置零
-            pi = np.zeros_like(p[i])
-            pi[idxs] = p[i, idxs]
-            a = a + (pi.argmax(), )
-            score += pi.max()
-            if a[-1] == tokenizer._token_sep_id:
-                break
-        score = score / (i + 1)
-        a = tokenizer.decode(a)
+    for a, score, length in zip(answers, scores, lengths):
+        a = tokenizer.decode(a[:int(length)])
         if a:
-            results[a] = results.get(a, []) + [score]
+            results[a] = results.get(a, []) + [score / length]
     results = {
         k: (np.array(v)**2).sum() / (sum(v) + 1)
         for k, v in results.items()
@@ -12,6 +12,7 @@ from bert4keras.tokenizer import Tokenizer, load_vocab
 from bert4keras.optimizers import Adam
 from bert4keras.snippets import sequence_padding, open
 from bert4keras.snippets import DataGenerator, AutoRegressiveDecoder
+from bert4keras.snippets import SubstringConstraint
 from tqdm import tqdm
 
 
@@ -119,18 +120,6 @@ class ReadingComprehension(AutoRegressiveDecoder):
         super(ReadingComprehension, self).__init__(start_id, end_id, maxlen)
         self.mode = mode
 
-    def get_ngram_set(self, x, n):
-        """生成ngram合集，返回结果格式是:
-        {(n-1)-gram: set([n-gram的第n个字集合])}
-        """
-        result = {}
-        for i in range(len(x) - n + 1):
-            k = tuple(x[i:i + n])
-            if k[:-1] not in result:
-                result[k[:-1]] = set()
-            result[k[:-1]].add(k[-1])
-        return result
-
     def predict(self, inputs, output_ids, step, rtype='logits'):
         inputs = [i for i in inputs if i[0, 0] > -1]  # 过滤掉无答案篇章
         topk = len(inputs[0])
@@ -163,23 +152,6 @@ class ReadingComprehension(AutoRegressiveDecoder):
                     inputs[i][:, 0] = -1  # 无答案篇章首位标记为-1
                 probas = probas[available_idxs]
                 inputs = [i for i in inputs if i[0, 0] > -1]  # 过滤掉无答案篇章
-        if self.mode == 'extractive':
-            # 如果是抽取式，那么答案必须是篇章的一个片段
-            # 那么将非篇章片段的概率值全部置0
-            new_probas = np.zeros_like(probas)
-            ngrams = {}
-            for token_ids in inputs:
-                token_ids = token_ids[0]
-                sep_idx = np.where(token_ids == tokenizer._token_sep_id)[0][0]
-                p_token_ids = token_ids[1:sep_idx]
-                for k, v in self.get_ngram_set(p_token_ids, step + 1).items():
-                    ngrams[k] = ngrams.get(k, set()) | v
-            for i, ids in enumerate(output_ids):
-                available_idxs = ngrams.get(tuple(ids), set())
-                available_idxs.add(tokenizer._token_sep_id)
-                available_idxs = list(available_idxs)
-                new_probas[:, i, available_idxs] = probas[:, i, available_idxs]
-            probas = new_probas
         probas = (probas**2).sum(0) / (probas.sum(0) + 1)  # 某种平均投票方式
         if rtype == 'probas':
             return probas
@@ -187,13 +159,23 @@ class ReadingComprehension(AutoRegressiveDecoder):
             return np.log(probas + 1e-6)
 
     def answer(self, question, passages, topk=1):
-        token_ids = []
+        token_ids, all_p_token_ids = [], []
         for passage in passages:
             passage = re.sub(u' |、|；|，', ',', passage)
             p_token_ids = tokenizer.encode(passage, max_length=max_p_len)[0]
             q_token_ids = tokenizer.encode(question, max_length=max_q_len + 1)[0]
             token_ids.append(p_token_ids + q_token_ids[1:])
-        output_ids = self.beam_search(token_ids, topk)  # 基于beam search
+            all_p_token_ids.append(p_token_ids[1:-1])
+        if self.mode == 'extractive':
+            # 如果是抽取式，那么答案必须是篇章的一个片段
+            # 那么将非篇章片段的概率值全部置0
+            constraint = SubstringConstraint(all_p_token_ids,
+                                             len(token_dict),
+                                             maxlen=self.maxlen,
+                                             extra_ids=[self.end_id])
+        else:
+            constraint = None
+        output_ids = self.beam_search(token_ids, topk, constraint)  # 基于beam search
         return tokenizer.decode(output_ids)
 
 
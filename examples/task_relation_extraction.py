@@ -8,12 +8,13 @@
 import json
 import numpy as np
 import tensorflow as tf
-from bert4keras.backend import keras, K, batch_gather
+from bert4keras.backend import keras, K, batch_gather, predict_function
 from bert4keras.layers import LayerNormalization
 from bert4keras.tokenizer import Tokenizer
 from bert4keras.bert import build_bert_model
 from bert4keras.optimizers import Adam, ExponentialMovingAverage
 from bert4keras.snippets import sequence_padding, DataGenerator
+from bert4keras.snippets import extract_spans
 from bert4keras.snippets import open
 from keras.layers import *
 from keras.models import Model
@@ -175,6 +176,10 @@ object_preds = Lambda(lambda x: x**4)(output)
 
 object_model = Model(bert.model.inputs + [subject_ids], object_preds)
 
+# 抽取时每次只预测一个样本，直接调用比model.predict快
+subject_predict = predict_function(subject_model)
+object_predict = predict_function(object_model)
+
 # 训练模型
 train_model = Model(bert.model.inputs + [subject_labels, subject_ids, object_labels],
                     [subject_preds, object_preds])
@@ -199,30 +204,17 @@ def extract_spoes(text):
     tokens = tokenizer.tokenize(text, max_length=maxlen)
     token_ids, segment_ids = tokenizer.encode(text, max_length=maxlen)
     # 抽取subject
-    subject_preds = subject_model.predict([[token_ids], [segment_ids]])
-    start = np.where(subject_preds[0, :, 0] > 0.6)[0]
-    end = np.where(subject_preds[0, :, 1] > 0.5)[0]
-    subjects = []
-    for i in start:
-        j = end[end >= i]
-        if len(j) > 0:
-            j = j[0]
-            subjects.append((i, j))
-    if subjects:
-        spoes = []
+    subject_preds = subject_predict([[token_ids], [segment_ids]])
+    subjects = extract_spans(subject_preds[:, :, 0], subject_preds[:, :, 1],
+                             0.6, 0.5)[:, 1:3]
+    if len(subjects) > 0:
         token_ids = np.repeat([token_ids], len(subjects), 0)
         segment_ids = np.repeat([segment_ids], len(subjects), 0)
-        subjects = np.array(subjects)
         # 传入subject，抽取object和predicate
-        object_preds = object_model.predict([token_ids, segment_ids, subjects])
-        for subject, object_pred in zip(subjects, object_preds):
-            start = np.where(object_pred[:, :, 0] > 0.6)
-            end = np.where(object_pred[:, :, 1] > 0.5)
-            for _start, predicate1 in zip(*start):
-                for _end, predicate2 in zip(*end):
-                    if _start <= _end and predicate1 == predicate2:
-                        spoes.append((subject, predicate1, (_start, _end)))
-                        break
+        object_preds = object_predict([token_ids, segment_ids, subjects])
+        spans = extract_spans(object_preds[..., 0], object_preds[..., 1],
+                              0.6, 0.5)
+        spoes = [(subjects[i], p, (s, e)) for i, s, e, p in spans]
         return [
             (
                 tokenizer.decode(token_ids[0, s[0]:s[1] + 1], tokens[s[0]:s[1] + 1]),
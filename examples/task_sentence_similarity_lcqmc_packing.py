@@ -0,0 +1,130 @@
+#! -*- coding:utf-8 -*-
+# 句子对分类任务，LCQMC数据集，sequence packing版
+# 样本平均长度远小于maxlen，把多个样本拼成一条序列，减少padding的计算
+# 模型部分见Bert4Packing：attention只在样本内部进行，位置编码按样本重新开始
+
+import json
+import numpy as np
+from bert4keras.backend import keras, set_gelu, K
+from bert4keras.tokenizer import Tokenizer
+from bert4keras.bert import build_bert_model
+from bert4keras.optimizers import Adam
+from bert4keras.snippets import DataGenerator, SequencePacker
+from bert4keras.snippets import open
+from keras.layers import *
+
+set_gelu('tanh') # 切换gelu版本
+
+
+maxlen = 128
+packed_maxlen = 512 # 拼接后序列的最大长度
+batch_size = 64 # 每个batch的样本数（拼接前）
+config_path = '/root/kg/bert/chinese_wwm_L-12_H-768_A-12/bert_config.json'
+checkpoint_path = '/root/kg/bert/chinese_wwm_L-12_H-768_A-12/bert_model.ckpt'
+dict_path = '/root/kg/bert/chinese_wwm_L-12_H-768_A-12/vocab.txt'
+
+
+def load_data(filename):
+    D = []
+    with open(filename, encoding='utf-8') as f:
+        for l in f:
+            text1, text2, label = l.strip().split('\t')
+            D.append((text1, text2, int(label)))
+    return D
+
+
+# 加载数据集
+train_data = load_data('datasets/lcqmc/lcqmc.train.data')
+valid_data = load_data('datasets/lcqmc/lcqmc.valid.data')
+test_data = load_data('datasets/lcqmc/lcqmc.test.data')
+
+# 建立分词器
+tokenizer = Tokenizer(dict_path, do_lower_case=True)
+packer = SequencePacker(packed_maxlen)
+
+
+class data_generator(DataGenerator):
+    """数据生成器
+    每batch_size个样本拼接成若干条序列，标签形状为(序列数, 样本数)
+    """
+    def __iter__(self, random=False):
+        idxs = list(range(len(self.data)))
+        if random:
+            np.random.shuffle(idxs)
+        batch_token_ids, batch_segment_ids, batch_labels = [], [], []
+        for i in idxs:
+            text1, text2, label = self.data[i]
+            token_ids, segment_ids = tokenizer.encode(text1, text2, max_length=maxlen)
+            batch_token_ids.append(token_ids)
+            batch_segment_ids.append(segment_ids)
+            batch_labels.append(label)
+            if len(batch_token_ids) == self.batch_size or i == idxs[-1]:
+                packs = packer.pack([len(t) for t in batch_token_ids])
+                inputs = packer.concatenate(packs, batch_token_ids,
+                                            batch_segment_ids)
+                yield inputs, packer.gather(packs, batch_labels)
+                batch_token_ids, batch_segment_ids, batch_labels = [], [], []
+
+
+# 加载预训练模型
+bert = build_bert_model(
+    config_path=config_path,
+    checkpoint_path=checkpoint_path,
+    with_pool=True,
+    application='packing',
+    return_keras_model=False,
+)
+
+output = Dropout(rate=0.1)(bert.model.output)
+output = Dense(units=2,
+               activation='softmax',
+               kernel_initializer=bert.initializer)(output)
+
+model = keras.models.Model(bert.model.input, output)
+model.summary()
+
+model.compile(
+    loss='sparse_categorical_crossentropy', # 不存在的样本由mask自动忽略
+    optimizer=Adam(2e-5),  # 用足够小的学习率
+)
+
+
+# 转换数据集
+train_generator = data_generator(train_data, batch_size)
+valid_generator = data_generator(valid_data, batch_size)
+test_generator = data_generator(test_data, batch_size)
+
+
+def evaluate(data):
+    total, right = 0., 0.
+    for x_true, y_true in data:
+        y_pred = model.predict(x_true).argmax(axis=2)
+        example_ids = x_true[2]
+        mask = np.arange(1, y_true.shape[1] + 1) <= example_ids.max(1)[:, None]
+        total += mask.sum()
+        right += ((y_true == y_pred) * mask).sum()
+    return right / total
+
+
+class Evaluator(keras.callbacks.Callback):
+    def __init__(self):
+        self.best_val_acc = 0.
+
+    def on_epoch_end(self, epoch, logs=None):
+        val_acc = evaluate(valid_generator)
+        if val_acc > self.best_val_acc:
+            self.best_val_acc = val_acc
+            model.save_weights('best_model.weights')
+        test_acc = evaluate(test_generator)
+        print(u'val_acc: %.5f, best_val_acc: %.5f, test_acc: %.5f\n'
+              % (val_acc, self.best_val_acc, test_acc))
+
+
+evaluator = Evaluator()
+model.fit_generator(train_generator.forfit(),
+                    steps_per_epoch=len(train_generator),
+                    epochs=20,
+                    callbacks=[evaluator])
+
+model.load_weights('best_model.weights')
+print(u'final test acc: %05f\n' % (evaluate(test_generator)))
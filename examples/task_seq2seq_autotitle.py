@@ -11,6 +11,7 @@ from bert4keras.tokenizer import Tokenizer, load_vocab
 from bert4keras.optimizers import Adam
 from bert4keras.snippets import sequence_padding, open
 from bert4keras.snippets import DataGenerator, AutoRegressiveDecoder
+from bert4keras.snippets import PrefixCache
 
 
 # 基本参数
@@ -63,21 +64,21 @@ class data_generator(DataGenerator):
                 batch_token_ids, batch_segment_ids = [], []
 
 
-model = build_bert_model(
+bert = build_bert_model(
     config_path,
     checkpoint_path,
     application='seq2seq',
     keep_tokens=keep_tokens,  # 只保留keep_tokens中的字，精简原字表
+    return_keras_model=False,
 )
+model = bert.model
+prefix_cache = PrefixCache(bert.build_step_model(), 'seq2seq')  # 公共前缀只算一次
 
 model.summary()
 
-# 交叉熵作为loss，并mask掉输入部分的预测
-y_in = model.input[0][:, 1:]  # 目标tokens
-y_mask = model.input[1][:, 1:]
-y = model.output[:, :-1]  # 预测tokens，预测与目标错开一位
-cross_entropy = K.sparse_categorical_crossentropy(y_in, y)
-cross_entropy = K.sum(cross_entropy * y_mask) / K.sum(y_mask)
+# 交叉熵作为loss，只在目标部分（segment_id为1）计算
+# 只取出目标位置再按词表分块计算，不构建完整的概率矩阵
+cross_entropy = bert.compute_lm_loss(model.input[1])
 
 model.add_loss(cross_entropy)
 model.compile(optimizer=Adam(1e-5))
@@ -90,7 +91,22 @@ class AutoTitle(AutoRegressiveDecoder):
         token_ids, segment_ids = inputs
         token_ids = np.concatenate([token_ids, output_ids], 1)
         segment_ids = np.concatenate([segment_ids, np.ones_like(output_ids)], 1)
-        probas = model.predict([token_ids, segment_ids])[:, -1]
+        probas = prefix_cache.predict([token_ids, segment_ids])
+        if rtype == 'probas':
+            return probas
+        else:
+            return np.log(probas)
+
+    def padded_predict(self, inputs, output_ids, lengths, steps, rtype='logits'):
+        """多个请求合并预测（见DecodingScheduler）：各行拼接真实部分后
+        右padding，一次算完，再取各行最后一个真实位置
+        """
+        (token_ids, segment_ids), (t_len, s_len, o_len) = inputs, lengths
+        token_ids, total = self.concatenate_padded([token_ids, output_ids],
+                                                   [t_len, o_len])
+        segment_ids, _ = self.concatenate_padded(
+            [segment_ids, np.ones_like(output_ids)], [s_len, o_len], 1)
+        probas = prefix_cache.predict([token_ids, segment_ids], total)
         if rtype == 'probas':
             return probas
         else:
@@ -14,6 +14,7 @@ from bert4keras.tokenizer import Tokenizer, load_vocab
 from bert4keras.optimizers import Adam
 from bert4keras.snippets import sequence_padding, open
 from bert4keras.snippets import DataGenerator, AutoRegressiveDecoder
+from bert4keras.snippets import PrefixCache
 from rouge import Rouge  # pip install rouge
 from nltk.translate.bleu_score import sentence_bleu, SmoothingFunction
 
@@ -74,12 +75,15 @@ class data_generator(DataGenerator):
                 batch_token_ids, batch_segment_ids = [], []
 
 
-model = build_bert_model(
+bert = build_bert_model(
     config_path,
     checkpoint_path,
     application='seq2seq',
     keep_tokens=keep_tokens,  # 只保留keep_tokens中的字，精简原字表
+    return_keras_model=False,
 )
+model = bert.model
+prefix_cache = PrefixCache(bert.build_step_model(), 'seq2seq')  # 公共前缀只算一次
 
 model.summary()
 
@@ -101,7 +105,7 @@ class AutoTitle(AutoRegressiveDecoder):
         token_ids, segment_ids = inputs
         token_ids = np.concatenate([token_ids, output_ids], 1)
         segment_ids = np.concatenate([segment_ids, np.ones_like(output_ids)], 1)
-        probas = model.predict([token_ids, segment_ids])[:, -1]
+        probas = prefix_cache.predict([token_ids, segment_ids])
         if rtype == 'probas':
             return probas
         else:
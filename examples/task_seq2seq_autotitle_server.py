@@ -0,0 +1,45 @@
+#! -*- coding: utf-8 -*-
+# 以http服务的形式部署task_seq2seq_autotitle.py训练好的模型
+# 通过DecodingScheduler实现连续批处理：多个请求的解码步合并预测
+# 用法：python task_seq2seq_autotitle_server.py，然后
+# curl -d '{"text": "...", "topk": 3}' http://127.0.0.1:8000
+
+from __future__ import print_function
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from bert4keras.snippets import DecodingScheduler
+from task_seq2seq_autotitle import autotitle, tokenizer, maxlen
+from task_seq2seq_autotitle import prefix_cache
+
+
+prefix_cache.max_memory = 2**30  # 跨请求保留前缀状态，重复的文本直接复用
+scheduler = DecodingScheduler(autotitle, max_batch_size=64)
+
+
+class Handler(BaseHTTPRequestHandler):
+    """每个请求提交给调度器后阻塞等待自己的结果
+    """
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        data = json.loads(self.rfile.read(length))
+        max_c_len = maxlen - autotitle.maxlen
+        token_ids, segment_ids = tokenizer.encode(data['text'],
+                                                  max_length=max_c_len)
+        future = scheduler.submit([token_ids, segment_ids],
+                                  topk=data.get('topk', 1))
+        title = tokenizer.decode(future.result())
+        body = json.dumps({'title': title}, ensure_ascii=False)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+
+if __name__ == '__main__':
+
+    scheduler.start()
+    server = ThreadingHTTPServer(('127.0.0.1', 8000), Handler)
+    try:
+        server.serve_forever()
+    finally:
+        scheduler.stop()
@@ -10,7 +10,7 @@ from bert4keras.bert import build_bert_model
 from bert4keras.tokenizer import Tokenizer
 from bert4keras.optimizers import Adam
 from bert4keras.snippets import sequence_padding, DataGenerator
-from bert4keras.snippets import open
+from bert4keras.snippets import open, viterbi_decode
 from bert4keras.layers import ConditionalRandomField
 from keras.layers import Dense
 from keras.models import Model
@@ -127,41 +127,35 @@ model.compile(loss=CRF.sparse_loss,
               metrics=[CRF.sparse_accuracy])
 
 
-def viterbi_decode(nodes, trans):
-    """Viterbi算法求最优路径
-    其中nodes.shape=[seq_len, num_labels],
-        trans.shape=[num_labels, num_labels].
-    """
-    labels = np.arange(num_labels).reshape((1, -1))
-    scores = nodes[0].reshape((-1, 1))
-    scores[1:] -= np.inf  # 第一个标签必然是0
-    paths = labels
-    for l in range(1, len(nodes)):
-        M = scores + trans + nodes[l].reshape((1, -1))
-        idxs = M.argmax(0)
-        scores = M.max(0).reshape((-1, 1))
-        paths = np.concatenate([paths[:, idxs], labels], 0)
-    return paths[:, scores[0].argmax()]
-
-
-def word_segment(text):
-    """分词函数
+start_mask = np.eye(num_labels)[0]  # 第一个标签必然是0
+
+
+def word_segment(texts):
+    """分词函数（批量）
     """
-    tokens = tokenizer.tokenize(text)
-    while len(tokens) > 512:
-        tokens.pop(-2)
-    token_ids = tokenizer.tokens_to_ids(tokens)
-    segment_ids = [0] * len(token_ids)
-    nodes = model.predict([[token_ids], [segment_ids]])[0]
+    batch_tokens, batch_token_ids = [], []
+    for text in texts:
+        tokens = tokenizer.tokenize(text)
+        while len(tokens) > 512:
+            tokens.pop(-2)
+        batch_tokens.append(tokens)
+        batch_token_ids.append(tokenizer.tokens_to_ids(tokens))
+    batch_token_ids = sequence_padding(batch_token_ids)
+    batch_segment_ids = np.zeros_like(batch_token_ids)
+    nodes = model.predict([batch_token_ids, batch_segment_ids])
     trans = K.eval(CRF.trans)
-    labels = viterbi_decode(nodes, trans)[1:-1]
-    words = []
-    for token, label in zip(tokens[1:-1], labels):
-        if label < 2 or len(words) == 0:
-            words.append([token])
-        else:
-            words[-1].append(token)
-    return [tokenizer.decode(w, w).replace(' ', '') for w in words]
+    mask = batch_token_ids > 0
+    batch_labels = viterbi_decode(nodes, trans, mask, start_mask=start_mask)
+    results = []
+    for tokens, labels in zip(batch_tokens, batch_labels):
+        words = []
+        for token, label in zip(tokens[1:-1], labels[1:]):
+            if label < 2 or len(words) == 0:
+                words.append([token])
+            else:
+                words[-1].append(token)
+        results.append([tokenizer.decode(w, w).replace(' ', '') for w in words])
+    return results
 
 
 def simple_evaluate(data):
@@ -170,12 +164,14 @@ def simple_evaluate(data):
     可以用来快速筛选模型。
     """
     total, right = 0., 0.
-    for w_true in tqdm(data):
-        w_pred = word_segment(''.join(w_true))
-        w_pred = set(w_pred)
-        w_true = set(w_true)
-        total += len(w_true)
-        right += len(w_true & w_pred)
+    for i in tqdm(range(0, len(data), batch_size)):
+        batch = data[i:i + batch_size]
+        texts = [''.join(w_true) for w_true in batch]
+        for w_true, w_pred in zip(batch, word_segment(texts)):
+            w_pred = set(w_pred)
+            w_true = set(w_true)
+            total += len(w_true)
+            right += len(w_true & w_pred)
     return right / total
 
 
@@ -188,12 +184,16 @@ def predict_to_file(in_file, out_file):
     $data_dir/scripts/score $data_dir/gold/pku_training_words.utf8 $data_dir/gold/pku_test_gold.utf8 myresult.txt > myscore.txt
     （执行完毕后查看myscore.txt的内容末尾）
     """
-    fw = open(out_file, 'w', encoding='utf-8')
     with open(in_file, encoding='utf-8') as fr:
-        for l in tqdm(fr):
-            l = l.strip()
+        lines = [l.strip() for l in fr]
+    fw = open(out_file, 'w', encoding='utf-8')
+    for i in tqdm(range(0, len(lines), batch_size)):
+        batch = lines[i:i + batch_size]
+        texts = [l for l in batch if l]
+        results = iter(word_segment(texts)) if texts else iter([])
+        for l in batch:
             if l:
-                l = ' '.join(word_segment(l))
+                l = ' '.join(next(results))
             fw.write(l + '\n')
     fw.close()
 
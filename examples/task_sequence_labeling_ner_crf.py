@@ -12,7 +12,7 @@ from bert4keras.optimizers import Adam
 from bert4keras.snippets import sequence_padding, DataGenerator
 from bert4keras.snippets import open
 from bert4keras.layers import ConditionalRandomField
-from keras.layers import Dense
+from keras.layers import Dense, Lambda
 from keras.models import Model
 from tqdm import tqdm
 
@@ -135,61 +135,64 @@ model.compile(loss=CRF.sparse_loss,
               optimizer=Adam(learing_rate),
               metrics=[CRF.sparse_accuracy])
 
+# 标签约束：I只能接在同类的B或I之后；第一个标签（[CLS]）必然是0
+trans_mask = np.ones((num_labels, num_labels))
+trans_mask[:, 2::2] = 0
+for i in range(len(classes)):
+    trans_mask[2 * i + 1:2 * i + 3, 2 * i + 2] = 1
+start_mask = np.eye(num_labels)[0]
 
-def viterbi_decode(nodes, trans):
-    """Viterbi算法求最优路径
-    其中nodes.shape=[seq_len, num_labels],
-        trans.shape=[num_labels, num_labels].
-    """
-    labels = np.arange(num_labels).reshape((1, -1))
-    scores = nodes[0].reshape((-1, 1))
-    scores[1:] -= np.inf  # 第一个标签必然是0
-    paths = labels
-    for l in range(1, len(nodes)):
-        M = scores + trans + nodes[l].reshape((1, -1))
-        idxs = M.argmax(0)
-        scores = M.max(0).reshape((-1, 1))
-        paths = np.concatenate([paths[:, idxs], labels], 0)
-    return paths[:, scores[0].argmax()]
-
-
-def named_entity_recognize(text):
-    """命名实体识别函数
+# 图内批量Viterbi解码的预测模型
+decoder = Model(
+    model.input,
+    Lambda(lambda x: CRF.viterbi_decode(x, trans_mask, start_mask))(output))
+
+
+def named_entity_recognize(texts):
+    """命名实体识别函数（批量）
     """
-    tokens = tokenizer.tokenize(text)
-    while len(tokens) > 512:
-        tokens.pop(-2)
-    token_ids = tokenizer.tokens_to_ids(tokens)
-    segment_ids = [0] * len(token_ids)
-    nodes = model.predict([[token_ids], [segment_ids]])[0]
-    trans = K.eval(CRF.trans)
-    labels = viterbi_decode(nodes, trans)[1:-1]
-    entities, starting = [], False
-    for token, label in zip(tokens[1:-1], labels):
-        if label > 0:
-            if label % 2 == 1:
-                starting = True
-                entities.append([[token], id2class[(label - 1) // 2]])
-            elif starting:
-                entities[-1][0].append(token)
+    batch_tokens, batch_token_ids = [], []
+    for text in texts:
+        tokens = tokenizer.tokenize(text)
+        while len(tokens) > 512:
+            tokens.pop(-2)
+        batch_tokens.append(tokens)
+        batch_token_ids.append(tokenizer.tokens_to_ids(tokens))
+    batch_token_ids = sequence_padding(batch_token_ids)
+    batch_segment_ids = np.zeros_like(batch_token_ids)
+    batch_labels = decoder.predict([batch_token_ids, batch_segment_ids])
+    results = []
+    for tokens, labels in zip(batch_tokens, batch_labels):
+        entities, starting = [], False
+        for token, label in zip(tokens[1:-1], labels[1:]):
+            if label > 0:
+                if label % 2 == 1:
+                    starting = True
+                    entities.append([[token], id2class[(label - 1) // 2]])
+                elif starting:
+                    entities[-1][0].append(token)
+                else:
+                    starting = False
             else:
                 starting = False
-        else:
-            starting = False
-    return [(tokenizer.decode(w, w).replace(' ', ''), l) for w, l in entities]
+        results.append([(tokenizer.decode(w, w).replace(' ', ''), l)
+                        for w, l in entities])
+    return results
 
 
 def evaluate(data):
     """评测函数
     """
     X, Y, Z = 1e-10, 1e-10, 1e-10
-    for d in tqdm(data):
-        text = ''.join([i[0] for i in d])
-        R = set(named_entity_recognize(text))
-        T = set([tuple(i) for i in d if i[1] != 'O'])
-        X += len(R & T)
-        Y += len(R)
-        Z += len(T)
+    for i in tqdm(range(0, len(data), batch_size)):
+        batch = data[i:i + batch_size]
+        texts = [''.join([j[0] for j in d]) for d in batch]
+        for d, R in zip(batch, named_entity_recognize(texts)):
+            R = set(R)
+            T = set([tuple(j) for j in d if j[1] != 'O'])
+            X += len(R & T)
+            Y += len(R)
+            Z += len(T)
     f1, precision, recall = 2 * X / (Y + Z), X / Y, X / Z
     return f1, precision, recall
 
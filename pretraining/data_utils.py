@@ -215,8 +215,16 @@ class TrainingDatasetRoBERTa(TrainingDataset):
         return super(TrainingDatasetRoBERTa, self).tfrecord_serialize(instances, instance_keys)
 
     @staticmethod
-    def load_tfrecord(record_names, sequence_length, batch_size):
+    def load_tfrecord(record_names,
+                      sequence_length,
+                      batch_size,
+                      max_predictions=None):
         """给原方法补上parse_function
+        max_predictions非None时，额外输出前max_predictions个被mask的位置
+        （masked_positions）、对应的目标id（masked_token_ids）及权重
+        （masked_weights，不足部分补0），形状固定，供只在被mask位置计算
+        MLM的模型使用；超出max_predictions的被mask位置会还原为原token，
+        保证输入中被改动的位置都参与预测。
         """
         def parse_function(serialized):
             features = {
@@ -228,6 +236,9 @@ class TrainingDatasetRoBERTa(TrainingDataset):
             mask_ids = features['mask_ids']
             segment_ids = K.zeros_like(token_ids, dtype='int64')
             is_masked = K.not_equal(mask_ids, 0)
+            if max_predictions is not None:
+                num_masked = K.cumsum(K.cast(is_masked, 'int32'))
+                is_masked = is_masked & (num_masked <= max_predictions)
             masked_token_ids = K.switch(is_masked, mask_ids - 1, token_ids)
             x = {
                 'Input-Token': masked_token_ids,
@@ -235,6 +246,21 @@ class TrainingDatasetRoBERTa(TrainingDataset):
                 'token_ids': token_ids,
                 'is_masked': K.cast(is_masked, K.floatx()),
             }
+            if max_predictions is not None:
+                positions = tf.where(is_masked)[:, 0]
+                weights = K.ones_like(positions, dtype=K.floatx())
+                paddings = [[0, max_predictions - K.shape(positions)[0]]]
+                positions = K.reshape(tf.pad(positions, paddings),
+                                      (max_predictions, ))
+                weights = K.reshape(tf.pad(weights, paddings),
+                                    (max_predictions, ))
+                x = {
+                    'Input-Token': masked_token_ids,
+                    'Input-Segment': segment_ids,
+                    'masked_positions': positions,
+                    'masked_token_ids': tf.gather(token_ids, positions),
+                    'masked_weights': weights,
+                }
             y = {
                 'mlm_loss': K.zeros_like(token_ids[..., 0]),
                 'mlm_acc': K.zeros_like(token_ids[..., 0]),
@@ -39,6 +39,7 @@ num_train_steps = 125000
 steps_per_epoch = 10000
 grad_accum_steps = 16  # 大于1即表明使用梯度累积
 loss_weight_of_identity = 0.  # 除去mask后剩下部分(恒等映射)的loss权重
+max_predictions = None  # 每个样本最多预测的mask个数（超出的mask会还原），None则所有位置都算MLM
 epochs = num_train_steps * grad_accum_steps // steps_per_epoch
 exclude_from_weight_decay = ['Norm', 'bias']
 tpu_address = 'grpc://xxx.xxx.xxx.xxx:8470'  # 如果用多GPU跑，直接设为None
@@ -57,6 +58,7 @@ if model == 'roberta':
         record_names=corpus_paths,
         sequence_length=sequence_length,
         batch_size=batch_size // grad_accum_steps,
+        max_predictions=max_predictions,
     )
 
 elif model == 'gpt':
@@ -117,6 +119,74 @@ def build_bert_model_with_mlm():
     return bert, train_model, loss
 
 
+def build_bert_model_with_masked_mlm():
+    """只在被mask的位置计算mlm的bert模型
+    先取出max_predictions个被mask位置的编码向量，再接MLM部分，省去
+    其余位置的词表投影与softmax（形状固定，适合TPU）。
+    """
+    assert loss_weight_of_identity == 0, 'identity loss needs all positions'
+    bert = build_bert_model(config_path,
+                            with_mlm='linear',
+                            return_keras_model=False)
+    get_layer = bert.model.get_layer
+
+    # 辅助输入
+    masked_positions = Input(shape=(max_predictions, ),
+                             dtype='int64',
+                             name='masked_positions')  # 被mask的位置
+    masked_token_ids = Input(shape=(max_predictions, ),
+                             dtype='int64',
+                             name='masked_token_ids')  # 目标id
+    masked_weights = Input(shape=(max_predictions, ),
+                           dtype=floatx,
+                           name='masked_weights')  # 区分补齐的位置
+
+    def gather_positions(inputs):
+        """取出被mask位置的向量，需要封装为一个层
+        """
+        x, positions = inputs
+        return tf.gather(x, positions, batch_dims=1)
+
+    # 复用MLM部分的层（权重不变，可正常加载、保存checkpoint）
+    x = Lambda(gather_positions,
+               name='MLM-Gather')([bert.sequence_output, masked_positions])
+    x = get_layer('MLM-Dense')(x)
+    x = get_layer('MLM-Norm')(x)
+    proba = get_layer('MLM-Proba')(x)
+
+    def mlm_loss(inputs):
+        """计算loss的函数，需要封装为一个层
+        """
+        y_true, y_pred, weights = inputs
+        loss = K.sparse_categorical_crossentropy(y_true,
+                                                 y_pred,
+                                                 from_logits=True)
+        return K.sum(loss * weights) / (K.sum(weights) + K.epsilon())
+
+    def mlm_acc(inputs):
+        """计算准确率的函数，需要封装为一个层
+        """
+        y_true, y_pred, weights = inputs
+        y_true = K.cast(y_true, floatx)
+        acc = keras.metrics.sparse_categorical_accuracy(y_true, y_pred)
+        return K.sum(acc * weights) / (K.sum(weights) + K.epsilon())
+
+    inputs = [masked_token_ids, proba, masked_weights]
+    mlm_loss = Lambda(mlm_loss, name='mlm_loss')(inputs)
+    mlm_acc = Lambda(mlm_acc, name='mlm_acc')(inputs)
+
+    train_model = Model(
+        bert.model.inputs + [masked_positions, masked_token_ids, masked_weights],
+        [mlm_loss, mlm_acc])
+
+    loss = {
+        'mlm_loss': lambda y_true, y_pred: y_pred,
+        'mlm_acc': lambda y_true, y_pred: K.stop_gradient(y_pred),
+    }
+
+    return bert, train_model, loss
+
+
 def build_bert_model_with_lm():
     """带lm的bert模型
     """
@@ -171,7 +241,10 @@ def build_bert_model_for_pretraining():
     时要格外留意。
     """
     if model == 'roberta':
-        bert, train_model, loss = build_bert_model_with_mlm()
+        if max_predictions is None:
+            bert, train_model, loss = build_bert_model_with_mlm()
+        else:
+            bert, train_model, loss = build_bert_model_with_masked_mlm()
     elif model == 'gpt':
         bert, train_model, loss = build_bert_model_with_lm()
 
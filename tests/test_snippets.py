@@ -0,0 +1,216 @@
+#! -*- coding: utf-8 -*-
+# snippets中解码相关工具的测试，只依赖numpy
+
+import unittest
+import unicodedata
+import numpy as np
+from bert4keras.snippets import AutoRegressiveDecoder, DecodingScheduler
+from bert4keras.snippets import SubstringConstraint
+
+
+def toy_model(token_ids):
+    """单向的玩具模型：每个位置的得分取决于它及之前的token与位置，
+    padding（放在末尾）不影响前面的位置；返回(batch_size, seq_len, 5)
+    """
+    positions = np.arange(token_ids.shape[1]) + 1
+    h = np.cumsum(token_ids * positions, 1)
+    return np.sin(h[:, :, None] * np.arange(1, 6))
+
+
+class ToyDecoder(AutoRegressiveDecoder):
+    """source与output_ids拼接后预测最后一个位置，类似seq2seq
+    """
+    def __init__(self):
+        super(ToyDecoder, self).__init__(None, 4, 5)
+        self.calls = 0
+
+    def predict(self, inputs, output_ids, step, rtype='logits'):
+        self.calls += 1
+        token_ids = np.concatenate([inputs[0], output_ids], 1)
+        scores = toy_model(token_ids)[:, -1]
+        return np.exp(scores) if rtype == 'probas' else scores
+
+
+class PaddedToyDecoder(ToyDecoder):
+    """合并的请求拼接后一次算完
+    """
+    def padded_predict(self, inputs, output_ids, lengths, steps,
+                       rtype='logits'):
+        self.calls += 1
+        token_ids, total = self.concatenate_padded([inputs[0], output_ids],
+                                                   [lengths[0], lengths[1]])
+        scores = self.gather_last(toy_model(token_ids), total)
+        return np.exp(scores) if rtype == 'probas' else scores
+
+
+class LabeledToyDecoder(ToyDecoder):
+    """inputs多一个一维的输入（每行一个标签），加到得分上
+    """
+    def predict(self, inputs, output_ids, step, rtype='logits'):
+        scores = super(LabeledToyDecoder, self).predict(inputs[:1], output_ids,
+                                                        step, 'logits')
+        scores = scores + inputs[1][:, None]
+        return np.exp(scores) if rtype == 'probas' else scores
+
+
+class RecordingToyDecoder(ToyDecoder):
+    """记录每一步合并预测的总行数
+    """
+    def __init__(self):
+        super(RecordingToyDecoder, self).__init__()
+        self.batch_sizes = []
+
+    def batch_predict(self, requests):
+        self.batch_sizes.append(sum([len(r[1]) for r in requests]))
+        return super(RecordingToyDecoder, self).batch_predict(requests)
+
+
+class BatchPredictTest(unittest.TestCase):
+    def requests(self):
+        """source长度、已生成长度（即step）、行数都不同的请求
+        """
+        rs = np.random.RandomState(0)
+        requests = []
+        for source_len, step, rows, rtype in [
+            (3, 0, 1, 'logits'),
+            (6, 2, 3, 'logits'),
+            (4, 1, 2, 'logits'),
+            (6, 4, 1, 'probas'),
+            (2, 3, 2, 'probas'),
+        ]:
+            source = np.repeat(rs.randint(1, 9, (1, source_len)), rows, 0)
+            output_ids = rs.randint(1, 9, (rows, step))
+            requests.append(([source], output_ids, step, rtype))
+        return requests
+
+    def check(self, decoder, num_calls):
+        requests = self.requests()
+        results = decoder.batch_predict(requests)
+        self.assertEqual(decoder.calls, num_calls)
+        reference = ToyDecoder()
+        for request, result in zip(requests, results):
+            expected = reference.predict(*request)
+            self.assertEqual(result.shape, expected.shape)
+            np.testing.assert_allclose(result, expected, rtol=1e-6)
+
+    def test_padded_predict(self):
+        # 每种rtype只调用一次
+        self.check(PaddedToyDecoder(), 2)
+
+    def test_default_padded_predict(self):
+        # 默认实现按真实长度分组，结果同样一致
+        self.check(ToyDecoder(), 5)
+
+    def test_non_sequence_inputs(self):
+        # 一维的输入不做padding，跟序列输入一起合并
+        decoder = LabeledToyDecoder()
+        requests = [([x[0], np.full(len(x[0]), i, dtype=float)], o, step, r)
+                    for i, (x, o, step, r) in enumerate(self.requests())]
+        results = decoder.batch_predict(requests)
+        for request, result in zip(requests, results):
+            expected = LabeledToyDecoder().predict(*request)
+            np.testing.assert_allclose(result, expected, rtol=1e-6)
+
+    def test_concatenate_padded(self):
+        a = np.array([[1, 2, 0], [3, 0, 0]])
+        b = np.array([[5, 0], [6, 7]])
+        x, total = AutoRegressiveDecoder.concatenate_padded(
+            [a, b], [np.array([2, 1]), np.array([1, 2])], padding=9)
+        np.testing.assert_array_equal(x, [[1, 2, 5], [3, 6, 7]])
+        np.testing.assert_array_equal(total, [3, 3])
+
+
+class DecodingSchedulerTest(unittest.TestCase):
+    def test_max_batch_size(self):
+        # beam search第1步只有1行，之后扩充为topk行，接纳时要按topk预留
+        decoder, reference = RecordingToyDecoder(), ToyDecoder()
+        decoder.end_id = reference.end_id = -1  # 都解码到最大长度
+        scheduler = DecodingScheduler(decoder, max_batch_size=4)
+        rs = np.random.RandomState(0)
+        requests = [([rs.randint(1, 4, 3)], topk) for topk in [3, 1, 1, 2, 1]]
+        futures = [scheduler.submit(x, topk=topk) for x, topk in requests]
+        while not all([f.done() for f in futures]):
+            scheduler.step()
+        self.assertTrue(max(decoder.batch_sizes) <= 4)
+        for (x, topk), future in zip(requests, futures):
+            expected = reference.beam_search(x, topk)
+            np.testing.assert_array_equal(future.result(), expected)
+
+
+class SubstringConstraintTest(unittest.TestCase):
+    def test_empty_sequences(self):
+        # 没有序列时只允许extra_ids
+        constraint = SubstringConstraint([], 6, extra_ids=[0])
+        states = constraint.initial_states(2)
+        mask = constraint.mask(states)
+        np.testing.assert_array_equal(mask.sum(1), [1, 1])
+        self.assertTrue(mask[:, 0].all())
+        states = constraint.advance(states, [1, 0])
+        np.testing.assert_array_equal(constraint.mask(states).sum(1), [1, 1])
+
+    def test_separate_roots(self):
+        constraint = SubstringConstraint([[1, 2], [3, 4]], 6, separate=True)
+        self.assertRaises(ValueError, constraint.initial_states, 2)
+        states = constraint.initial_states(2, [1, 0])
+        mask = constraint.mask(states)
+        np.testing.assert_array_equal(np.nonzero(mask[0])[0], [3, 4])
+        np.testing.assert_array_equal(np.nonzero(mask[1])[0], [1, 2])
+
+
+class ScriptedDecoder(AutoRegressiveDecoder):
+    """按预定的token序列逐个生成（概率为one hot）
+    """
+    def __init__(self, script, vocab_size=10):
+        super(ScriptedDecoder, self).__init__(None, 0, len(script) + 1)
+        self.script, self.vocab_size = script, vocab_size
+
+    def predict(self, inputs, output_ids, step, rtype='probas'):
+        i = output_ids.shape[1]
+        token_id = self.script[i] if i < len(self.script) else self.end_id
+        return np.tile(np.eye(self.vocab_size)[token_id], (len(output_ids), 1))
+
+
+def toy_detokenize(ids):
+    """玩具detokenizer：1、2、3、9为单词（词间有空格），4为##后缀（与前一
+    个词合并），5、6、7为“你”的三个utf-8字节，8为组合用的重音符（NFC
+    规范化后与前一个字母合成一个字符），0为结束符
+    """
+    pieces = {1: b' play', 2: b' now', 3: b' ,', 4: b'ing',
+              5: b'\xe4', 6: b'\xbd', 7: b'\xa0', 8: b'\xcc\x81', 9: b' e'}
+    text = b''.join([pieces[i] for i in ids if i in pieces])
+    text = text.decode('utf-8', 'replace').strip().replace(' ,', ',')
+    return unicodedata.normalize('NFC', text)
+
+
+class StreamTest(unittest.TestCase):
+    def run_stream(self, script):
+        decoder = ScriptedDecoder(script)
+        text, deltas = u'', []
+        for step, ids, offset, delta in decoder.random_sample_stream(
+                [np.zeros(1)], detokenize=toy_detokenize):
+            deltas.append((offset, len(text), delta))
+            text = text[:offset] + delta
+        return text, deltas
+
+    def test_rewritten_token(self):
+        # “play”在下一个token到来时变成“playing”，“now”后接“,”时空格被
+        # 去掉，“e”后接重音符时变成“é”（改写了上一个token的文本）
+        script = [1, 4, 2, 3, 9, 8, 1]
+        text, deltas = self.run_stream(script)
+        self.assertEqual(text, toy_detokenize(script + [0]))
+        # 只输出稳定的文本，已输出的部分从未被改写
+        for offset, length, delta in deltas:
+            self.assertEqual(offset, length)
+        self.assertEqual(u''.join([d for _, _, d in deltas]), text)
+
+    def test_partial_character(self):
+        script = [1, 5, 6, 7, 2]
+        text, deltas = self.run_stream(script)
+        self.assertEqual(text, toy_detokenize(script))
+        for offset, length, delta in deltas:
+            self.assertEqual(offset, length)
+            self.assertNotIn(u'\ufffd', delta)
+
+
+if __name__ == '__main__':
+    unittest.main()